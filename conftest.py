@@ -0,0 +1,24 @@
+"""Options of the test suite."""
+
+from __future__ import absolute_import
+
+import pytest
+
+
+def pytest_addoption(parser):
+    parser.addoption('--benchmark', action='store_true',
+                     help='run benchmarks which measure time')
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers',
+                            'benchmark: measures time, needs --benchmark')
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption('--benchmark'):
+        return
+    skip = pytest.mark.skip(reason='requires --benchmark')
+    for item in items:
+        if 'benchmark' in item.keywords:
+            item.add_marker(skip)
@@ -1,11 +1,55 @@
 
 from __future__ import absolute_import
 
+import sys
+
 __version__ = '0.2.dev'
 
-from kudzu.context import CONTEXT_VARS, get_remote_addr, get_request_id, \
-    RequestContext
-from kudzu.middleware import kudzify_app, LoggingMiddleware, \
-    RequestContextMiddleware, RequestIDMiddleware
-from kudzu.logging import kudzify_handler, kudzify_logger, \
-    RequestContextFilter
+
+# Public names and submodules which define them, submodules are imported
+# on first access, so `import kudzu` does not pay for unused features.
+_exports = {
+    'CONTEXT_VARS': 'kudzu.context',
+    'get_remote_addr': 'kudzu.context',
+    'get_request_id': 'kudzu.context',
+    'RequestContext': 'kudzu.context',
+    'ConcurrencyGauge': 'kudzu.middleware',
+    'ExceptionLimiter': 'kudzu.middleware',
+    'kudzify_app': 'kudzu.middleware',
+    'LoadController': 'kudzu.middleware',
+    'LoggingMiddleware': 'kudzu.middleware',
+    'LoggingRule': 'kudzu.middleware',
+    'ProfilingMiddleware': 'kudzu.middleware',
+    'RequestContextMiddleware': 'kudzu.middleware',
+    'RequestIDMiddleware': 'kudzu.middleware',
+    'kudzify_handler': 'kudzu.logging',
+    'kudzify_logger': 'kudzu.logging',
+    'install_record_factory': 'kudzu.logging',
+    'RequestContextFilter': 'kudzu.logging',
+    'RequestContextFormatter': 'kudzu.logging',
+    'TrustedProxies': 'kudzu.proxy',
+}
+
+__all__ = sorted(_exports)
+
+
+def __getattr__(name):
+    module = _exports.get(name)
+    if module is None:
+        raise AttributeError('module %r has no attribute %r'
+                             % (__name__, name))
+    __import__(module)
+    value = getattr(sys.modules[module], name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_exports))
+
+
+if sys.version_info < (3, 7):  # pragma: nocover
+    # Module __getattr__ is not supported (PEP 562), import eagerly
+    for _name in _exports:
+        __getattr__(_name)
+    del _name
@@ -0,0 +1,10 @@
+
+from __future__ import absolute_import
+
+import sys
+
+from kudzu.cli import main
+
+
+if __name__ == '__main__':
+    sys.exit(main())
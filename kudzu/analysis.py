@@ -0,0 +1,400 @@
+"""Streaming analysis of log files written by kudzified handlers.
+
+Log lines are parsed using the same format string which was passed
+to `kudzify_handler` or `kudzify_logger`. Messages of `LoggingMiddleware`
+are recognized to extract response status, duration and size.
+"""
+
+from __future__ import absolute_import
+
+import collections
+import heapq
+import os
+import re
+import struct
+import tempfile
+import zlib
+
+from kudzu.middleware import LoggingMiddleware
+
+
+# Compiled by `compile_format` on first use
+_placeholder_re = None
+
+
+def compile_format(format):
+    """Compiles %-style format string to a regular expression.
+
+    Every `%(name)s` placeholder is replaced by a named group which
+    matches any text. Repeated placeholders must match the same text.
+    """
+    global _placeholder_re
+    if _placeholder_re is None:
+        _placeholder_re = re.compile(r'%(?:\((?P<name>[^)]*)\)[#0+ -]*\d*'
+                                     r'(?:\.\d+)?[diouxXeEfFgGcrsa]|%)')
+    parts = []
+    seen = set()
+    pos = 0
+    for match in _placeholder_re.finditer(format):
+        parts.append(re.escape(format[pos:match.start()]))
+        pos = match.end()
+        name = match.group('name')
+        if name is None:
+            parts.append('%')
+        elif name in seen:
+            parts.append('(?P=%s)' % name)
+        else:
+            seen.add(name)
+            parts.append('(?P<%s>.*?)' % name)
+    parts.append(re.escape(format[pos:]))
+    return re.compile('^%s$' % ''.join(parts), re.DOTALL)
+
+
+class LogParser(object):
+    """Parses lines written with the given logging format.
+
+    `parse` returns a dictionary of placeholder values or `None`
+    if a line does not match the format (e.g. traceback lines).
+    If the format contains `%(message)s`, messages logged
+    by `LoggingMiddleware` are also parsed and their variables merged.
+    """
+
+    def __init__(self, format, middleware=LoggingMiddleware):
+        self.line_re = compile_format(format)
+        self.message_res = (
+            ('request', compile_format(middleware.request_format)),
+            ('response', compile_format(middleware.response_format)),
+            # Suppressed exceptions would also match `exception_format`
+            ('exception', compile_format(middleware.suppressed_format)),
+            ('exception', compile_format(middleware.exception_format)),
+            ('exception',
+             compile_format(middleware.iteration_exception_format)),
+            ('abort', compile_format(middleware.abort_format)),
+        )
+
+    def parse(self, line):
+        match = self.line_re.match(line.rstrip('\r\n'))
+        if match is None:
+            return None
+        rv = match.groupdict()
+        message = rv.get('message')
+        if message is not None:
+            for kind, message_re in self.message_res:
+                message_match = message_re.match(message)
+                if message_match is not None:
+                    rv['kind'] = kind
+                    for key, value in message_match.groupdict().items():
+                        if rv.get(key, '-') == '-':
+                            rv[key] = value
+                    break
+        return rv
+
+
+def iter_lines(path, start=0):
+    """Yields start and end byte offsets and decoded lines of a file."""
+    with open(path, 'rb') as stream:
+        stream.seek(start)
+        offset = start
+        for line in stream:
+            end = offset + len(line)
+            yield offset, end, line.decode('utf-8', 'replace')
+            offset = end
+
+
+def iter_records(parser, path, start=0):
+    """Yields start and end offsets, variables and text of log records.
+
+    Lines which cannot be parsed (like tracebacks) are joined
+    to a preceding record. Lines before the first record are skipped.
+    """
+    record = None
+    for offset, end, line in iter_lines(path, start):
+        values = parser.parse(line)
+        if values is None:
+            if record is not None:
+                record[2].append(line)
+        else:
+            if record is not None:
+                yield record[0], offset, record[1], ''.join(record[2])
+            record = (offset, values, [line])
+    if record is not None:
+        yield record[0], end, record[1], ''.join(record[2])
+
+
+class Histogram(object):
+    """Histogram of non-negative integers with bounded memory.
+
+    Values below `2 ** precision` are counted exactly, greater values
+    are counted in logarithmic buckets with relative error lower than
+    `2 ** (1 - precision)`. Memory does not depend on number of values.
+    """
+
+    def __init__(self, precision=7):
+        self.precision = precision
+        self.buckets = {}
+        self.count = 0
+
+    def add(self, value):
+        value = int(value)
+        shift = max(value.bit_length() - self.precision, 0)
+        key = (shift, value >> shift)
+        self.buckets[key] = self.buckets.get(key, 0) + 1
+        self.count += 1
+
+    def percentile(self, percent):
+        """Returns approximate value of the given percentile."""
+        if not self.count:
+            return None
+        rank = max(int(self.count * percent / 100.0 + 0.5), 1)
+        seen = 0
+        for key in sorted(self.buckets, key=self._bucket_start):
+            seen += self.buckets[key]
+            if seen >= rank:
+                return self._bucket_start(key)
+        return None  # pragma: nocover
+
+    @staticmethod
+    def _bucket_start(key):
+        shift, value = key
+        return value << shift
+
+
+class TopCounter(object):
+    """Approximate counter of most frequent keys with bounded memory.
+
+    Implements Space-Saving algorithm: at most `capacity` keys are
+    tracked, when a new key comes the least frequent one is replaced.
+    Each tracked key has its own `Histogram` of durations.
+
+    The least frequent key is found in a heap of counts which is updated
+    lazily: counts only grow, so outdated entries are refreshed when
+    they reach the top.
+    """
+
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.counts = {}
+        self.histograms = {}
+        self._heap = []
+
+    def add(self, key, duration=None):
+        counts = self.counts
+        if key not in counts:
+            if len(counts) >= self.capacity:
+                evicted = self._pop_least_common()
+                count = counts.pop(evicted)
+                del self.histograms[evicted]
+            else:
+                count = 0
+            counts[key] = count
+            self.histograms[key] = Histogram()
+            heapq.heappush(self._heap, (count, key))
+        counts[key] += 1
+        if duration is not None:
+            self.histograms[key].add(duration)
+
+    def most_common(self, n):
+        return sorted(self.counts.items(), key=lambda i: (-i[1], i[0]))[:n]
+
+    def _pop_least_common(self):
+        heap = self._heap
+        while True:
+            count, key = heap[0]
+            if self.counts[key] == count:
+                heapq.heappop(heap)
+                return key
+            heapq.heapreplace(heap, (self.counts[key], key))
+
+
+class LogStats(object):
+    """Aggregated statistics of responses logged by `LoggingMiddleware`.
+
+    Statistics are computed in a single pass with bounded memory.
+    URIs of responses are taken from the response line if the format
+    contains `%(uri)s`, from a preceding request line with the same
+    request ID otherwise.
+    """
+
+    percentiles = (50, 95, 99)
+
+    def __init__(self, top_capacity=1000, pending_capacity=10000):
+        self.responses = 0
+        self.exceptions = 0
+        self.aborts = 0
+        self.durations = Histogram()
+        self.statuses = collections.Counter()
+        self.uris = TopCounter(top_capacity)
+        self.pending_capacity = pending_capacity
+        self._pending = collections.OrderedDict()
+
+    def add(self, values):
+        kind = values.get('kind')
+        rid = values.get('rid', '-')
+        if kind == 'request':
+            if rid != '-':
+                self._pending[rid] = values.get('uri', '-')
+                if len(self._pending) > self.pending_capacity:
+                    self._pending.popitem(last=False)
+        elif kind == 'response':
+            uri = values.get('uri', '-')
+            pending_uri = self._pending.pop(rid, '-')
+            if uri == '-':
+                uri = pending_uri
+            duration = values.get('msecs', '-')
+            duration = int(duration) if duration.isdigit() else None
+            self.responses += 1
+            if duration is not None:
+                self.durations.add(duration)
+            self.statuses[values.get('status', '-')] += 1
+            self.uris.add(uri, duration)
+        elif kind == 'exception':
+            self.exceptions += 1
+            self._pending.pop(rid, None)
+        elif kind == 'abort':
+            self.aborts += 1
+
+    def summary(self, top=10):
+        """Returns statistics as a dictionary."""
+        def percentiles(histogram):
+            return dict(('p%s' % p, histogram.percentile(p))
+                        for p in self.percentiles)
+        top_uris = []
+        for uri, count in self.uris.most_common(top):
+            item = {'uri': uri, 'count': count}
+            item.update(percentiles(self.uris.histograms[uri]))
+            top_uris.append(item)
+        rv = {
+            'responses': self.responses,
+            'exceptions': self.exceptions,
+            'aborts': self.aborts,
+            'statuses': dict(self.statuses),
+            'top_uris': top_uris,
+        }
+        rv.update(percentiles(self.durations))
+        return rv
+
+
+INDEX_MAGIC = b'KZIX1\n'
+_index_header = struct.Struct('>QII')
+_index_bucket = struct.Struct('>QQ')
+
+
+def _rid_hash(rid):
+    return zlib.crc32(rid.encode('utf-8')) & 0xffffffff
+
+
+def index_path(log_path):
+    """Returns default path of an index of the given log file."""
+    return log_path + '.kzidx'
+
+
+def _head_hash(log_path, size=4096):
+    """Returns checksum of the beginning of a file to detect rotation."""
+    with open(log_path, 'rb') as stream:
+        return zlib.crc32(stream.read(size)) & 0xffffffff
+
+
+def build_index(parser, log_path, path=None, buckets=4096, partitions=16):
+    """Writes on-disk index from request IDs to byte offsets.
+
+    Index is a hash table stored in a file: a table of buckets followed
+    by sorted `rid offset` lines. Entries are first partitioned to
+    temporary files, so only one partition is held in memory.
+    Index remembers the indexed size and the beginning of the log file,
+    records appended later are found by `find_request` by scanning
+    the rest of the file.
+    """
+    if path is None:
+        path = index_path(log_path)
+    buckets -= buckets % partitions
+    parts = [tempfile.TemporaryFile() for __ in range(partitions)]
+    try:
+        indexed_size = 0
+        for offset, end, values, text in iter_records(parser, log_path):
+            indexed_size = end
+            rid = values.get('rid', '-')
+            if rid == '-':
+                continue
+            entry = ('%s %s\n' % (rid, offset)).encode('utf-8')
+            parts[_rid_hash(rid) % partitions].write(entry)
+        table = [(0, 0)] * buckets
+        with open(path + '.tmp', 'wb') as out:
+            data_offset = (len(INDEX_MAGIC) + _index_header.size +
+                           buckets * _index_bucket.size)
+            out.seek(data_offset)
+            for part in parts:
+                part.seek(0)
+                grouped = collections.defaultdict(list)
+                for line in part:
+                    rid = line.split(b' ', 1)[0].decode('utf-8')
+                    grouped[_rid_hash(rid) % buckets].append(line)
+                for bucket in sorted(grouped):
+                    data = b''.join(sorted(grouped[bucket]))
+                    table[bucket] = (data_offset, len(data))
+                    out.write(data)
+                    data_offset += len(data)
+            out.seek(0)
+            out.write(INDEX_MAGIC)
+            out.write(_index_header.pack(indexed_size, _head_hash(log_path),
+                                         buckets))
+            for entry in table:
+                out.write(_index_bucket.pack(*entry))
+        os.rename(path + '.tmp', path)
+    finally:
+        for part in parts:
+            part.close()
+    return path
+
+
+def _read_index(path, rid):
+    """Returns indexed size, checksum and offsets of the request ID."""
+    with open(path, 'rb') as stream:
+        if stream.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+            raise ValueError('Invalid index file %s.' % path)
+        indexed_size, head_hash, buckets = \
+            _index_header.unpack(stream.read(_index_header.size))
+        stream.seek(stream.tell() + _index_bucket.size *
+                    (_rid_hash(rid) % buckets))
+        offset, size = _index_bucket.unpack(stream.read(_index_bucket.size))
+        stream.seek(offset)
+        data = stream.read(size)
+    prefix = rid.encode('utf-8') + b' '
+    offsets = [int(line[len(prefix):]) for line in data.splitlines()
+               if line.startswith(prefix)]
+    return indexed_size, head_hash, sorted(offsets)
+
+
+def find_request(parser, log_path, rid, use_index=True):
+    """Yields text of all records with the given request ID.
+
+    Uses index created by `build_index` if it exists and it matches
+    the log file, scans the whole file otherwise.
+    """
+    start = 0
+    path = index_path(log_path)
+    if use_index and os.path.exists(path):
+        indexed_size, head_hash, offsets = _read_index(path, rid)
+        if indexed_size <= os.path.getsize(log_path) and \
+                head_hash == _head_hash(log_path):
+            for offset in offsets:
+                for __, __, __, text in iter_records(parser, log_path,
+                                                     offset):
+                    yield text
+                    break
+            start = indexed_size
+    lines = []
+    for __, __, line in iter_lines(log_path, start):
+        # Only lines containing the ID and their continuations are parsed
+        if lines or rid in line:
+            values = parser.parse(line)
+            if values is None:
+                if lines:
+                    lines.append(line)
+                continue
+            if lines:
+                yield ''.join(lines)
+                lines = []
+            if values.get('rid') == rid:
+                lines.append(line)
+    if lines:
+        yield ''.join(lines)
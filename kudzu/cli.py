@@ -0,0 +1,153 @@
+"""Command line utilities for working with Kudzu logs.
+
+Run `python -m kudzu --help` for the list of available commands.
+"""
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import json
+import sys
+
+from kudzu.analysis import build_index, find_request, iter_records, \
+    LogParser, LogStats
+from kudzu.codec import RecordDecoder
+from kudzu.logging import BASIC_FORMAT
+
+
+#: Default format used to convert compact records back to text
+TEXT_FORMAT = '%(ctime)s [%(addr)s|%(rid)s] %(levelname)s:%(name)s:%(message)s'
+
+
+class _LogVars(dict):
+    """Dictionary which formats missing variables as `-`."""
+
+    def __missing__(self, key):
+        return '-'
+
+
+def _open_binary(path):
+    if path == '-':
+        return getattr(sys.stdin, 'buffer', sys.stdin)
+    return open(path, 'rb')
+
+
+def decode_command(args, out):
+    """Converts compact binary logs to text or JSON lines."""
+    for path in args.files:
+        stream = _open_binary(path)
+        try:
+            for values in RecordDecoder(stream):
+                if args.json:
+                    line = json.dumps(values, sort_keys=True)
+                else:
+                    line = args.format % _LogVars(values)
+                out.write(line + '\n')
+        finally:
+            if stream is not getattr(sys.stdin, 'buffer', sys.stdin):
+                stream.close()
+    return 0
+
+
+def grep_command(args, out):
+    """Prints all records of one request."""
+    parser = LogParser(args.format)
+    for path in args.files:
+        for text in find_request(parser, path, args.rid,
+                                 use_index=not args.no_index):
+            out.write(text)
+    return 0
+
+
+def index_command(args, out):
+    """Builds indexes from request IDs to offsets in log files."""
+    parser = LogParser(args.format)
+    for path in args.files:
+        out.write('%s\n' % build_index(parser, path))
+    return 0
+
+
+def stats_command(args, out):
+    """Prints aggregated statistics of logged responses."""
+    parser = LogParser(args.format)
+    stats = LogStats(top_capacity=max(args.top * 10, 1000))
+    for path in args.files:
+        for __, __, values, __ in iter_records(parser, path):
+            stats.add(values)
+    summary = stats.summary(top=args.top)
+    if args.json:
+        out.write(json.dumps(summary, sort_keys=True) + '\n')
+        return 0
+    out.write('Responses: %(responses)s, exceptions: %(exceptions)s, '
+              'aborts: %(aborts)s\n' % summary)
+    out.write('Duration ms: p50 %(p50)s, p95 %(p95)s, p99 %(p99)s\n'
+              % summary)
+    out.write('Statuses:\n')
+    for status, count in sorted(summary['statuses'].items()):
+        out.write('  %s %s\n' % (status, count))
+    out.write('Top URIs:\n')
+    for item in summary['top_uris']:
+        out.write('  %(count)s %(uri)s (p50 %(p50)s, p95 %(p95)s, '
+                  'p99 %(p99)s)\n' % item)
+    return 0
+
+
+def _add_format_argument(parser):
+    parser.add_argument('--format', default=BASIC_FORMAT,
+                        help='logging format passed to kudzify_logger '
+                             '(default: %(default)r)')
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        prog='python -m kudzu',
+        description='Utilities for working with Kudzu logs.')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    decode = commands.add_parser(
+        'decode', help='convert compact binary logs to text or JSON')
+    decode.add_argument('files', nargs='+', metavar='FILE',
+                        help="compact log file, '-' for standard input")
+    output = decode.add_mutually_exclusive_group()
+    output.add_argument('--json', action='store_true',
+                        help='write one JSON object per record')
+    output.add_argument('--format', default=TEXT_FORMAT,
+                        help='format string with %%(var)s placeholders '
+                             '(default: %(default)r)')
+    decode.set_defaults(func=decode_command)
+
+    grep = commands.add_parser(
+        'grep', help='print all records of one request')
+    grep.add_argument('rid', metavar='RID', help='request ID')
+    grep.add_argument('files', nargs='+', metavar='FILE', help='log file')
+    grep.add_argument('--no-index', action='store_true',
+                      help='scan whole files even if index exists')
+    _add_format_argument(grep)
+    grep.set_defaults(func=grep_command)
+
+    index = commands.add_parser(
+        'index', help='index log files by request ID for fast grep')
+    index.add_argument('files', nargs='+', metavar='FILE', help='log file')
+    _add_format_argument(index)
+    index.set_defaults(func=index_command)
+
+    stats = commands.add_parser(
+        'stats', help='print duration percentiles, statuses and top URIs')
+    stats.add_argument('files', nargs='+', metavar='FILE', help='log file')
+    stats.add_argument('--top', type=int, default=10,
+                       help='number of top URIs (default: %(default)s)')
+    stats.add_argument('--json', action='store_true',
+                       help='write statistics as JSON')
+    _add_format_argument(stats)
+    stats.set_defaults(func=stats_command)
+    return parser
+
+
+def main(argv=None, out=None):
+    """Entry point of `python -m kudzu`."""
+    parser = make_parser()
+    args = parser.parse_args(argv)
+    if out is None:
+        out = sys.stdout
+    return args.func(args, out)
@@ -0,0 +1,125 @@
+"""Propagation of request ID to outgoing HTTP requests.
+
+Integrations in this module add X-Request-ID header with ID
+of the current `RequestContext` to requests sent by `urllib`,
+`http.client` and `requests`, so requests can be correlated
+across services. Headers set explicitly are never overwritten.
+
+All integrations are installed once (to an opener, a connection
+or a session) and read the request ID when each request is sent,
+so connection pools can be shared by all requests.
+"""
+
+from __future__ import absolute_import
+
+try:
+    from urllib.request import BaseHandler, build_opener as _build_opener
+except ImportError:  # pragma: nocover
+    from urllib2 import BaseHandler, build_opener as _build_opener
+
+try:
+    import http.client as http_client
+except ImportError:  # pragma: nocover
+    import httplib as http_client
+
+try:
+    from requests.adapters import HTTPAdapter
+except ImportError:  # pragma: nocover
+    HTTPAdapter = None
+
+from kudzu.context import get_request_id
+
+
+#: Name of header which is added to outgoing requests
+REQUEST_ID_HEADER = 'X-Request-ID'
+
+
+def _has_header(headers, name=REQUEST_ID_HEADER):
+    name = name.lower()
+    return any(key.lower() == name for key in headers)
+
+
+def add_request_id(headers):
+    """Returns headers with ID of the current request added.
+
+    Takes a dictionary (or `None`), which is returned unchanged
+    if there is no current request ID or if it already contains
+    X-Request-ID header. A copy is returned otherwise.
+    """
+    request_id = get_request_id()
+    if request_id is None:
+        return headers
+    if not headers:
+        return {REQUEST_ID_HEADER: request_id}
+    if _has_header(headers):
+        return headers
+    rv = dict(headers)
+    rv[REQUEST_ID_HEADER] = request_id
+    return rv
+
+
+class RequestIDHandler(BaseHandler):
+    """Handler which adds request ID to requests sent by `urllib` openers.
+
+    The header is also sent to redirect locations.
+    """
+
+    def http_request(self, request):
+        request_id = get_request_id()
+        if request_id is not None and \
+                not request.has_header(REQUEST_ID_HEADER.capitalize()):
+            request.add_header(REQUEST_ID_HEADER, request_id)
+        return request
+
+    https_request = http_request
+
+
+def build_opener(*handlers):
+    """Returns `urllib` opener with `RequestIDHandler` installed."""
+    return _build_opener(RequestIDHandler, *handlers)
+
+
+class HTTPConnection(http_client.HTTPConnection):
+    """`http.client.HTTPConnection` which adds request ID to requests"""
+
+    def request(self, method, url, body=None, headers={}, **kwargs):
+        headers = add_request_id(headers)
+        http_client.HTTPConnection.request(self, method, url, body, headers,
+                                           **kwargs)
+
+
+class HTTPSConnection(http_client.HTTPSConnection):
+    """`http.client.HTTPSConnection` which adds request ID to requests"""
+
+    def request(self, method, url, body=None, headers={}, **kwargs):
+        headers = add_request_id(headers)
+        http_client.HTTPSConnection.request(self, method, url, body, headers,
+                                            **kwargs)
+
+
+class RequestIDAdapter(HTTPAdapter if HTTPAdapter else object):
+    """Transport adapter for `requests` which adds request ID to requests.
+
+    Mount the adapter to a long living session using `mount_adapter`,
+    connection pool of the adapter is shared by all requests.
+    Requires `requests` package.
+    """
+
+    def add_headers(self, request, **kwargs):
+        request_id = get_request_id()
+        if request_id is not None and REQUEST_ID_HEADER not in request.headers:
+            request.headers[REQUEST_ID_HEADER] = request_id
+
+
+def mount_adapter(session, prefixes=('http://', 'https://'), **kwargs):
+    """Mounts `RequestIDAdapter` to a `requests` session.
+
+    Keyword arguments are passed to the adapter (e.g. `pool_maxsize`).
+    Returns the session.
+    """
+    if HTTPAdapter is None:
+        raise RuntimeError('Package requests is not installed.')
+    adapter = RequestIDAdapter(**kwargs)
+    for prefix in prefixes:
+        session.mount(prefix, adapter)
+    return session
@@ -0,0 +1,327 @@
+
+from __future__ import absolute_import
+
+import logging
+import re
+import uuid
+
+from kudzu.context import CONTEXT_VARS
+from kudzu.logging import get_record_context
+
+
+#: Magic bytes which start each compact log stream
+MAGIC = b'KZC1'
+
+#: Marker which precedes a header of a stream appended to another one
+SEGMENT_SEPARATOR = b'\x00'
+
+#: Fields written by `CompactHandler`
+RECORD_FIELDS = CONTEXT_VARS + ('levelname', 'name', 'message')
+
+#: Fields with repeated values which are dictionary encoded by default
+DICTIONARY_FIELDS = ('method', 'user', 'addr', 'host', 'proto', 'uagent',
+                     'referer', 'ctype', 'route', 'levelname', 'name')
+
+# Value tokens, table references are encoded as `_TOKEN_TABLE + index`
+_TOKEN_EMPTY = 0
+_TOKEN_LITERAL = 1
+_TOKEN_CACHED = 2
+_TOKEN_INTEGER = 3
+_TOKEN_UUID = 4
+_TOKEN_TABLE = 5
+
+_integer_re = re.compile(r'[0-9]+\Z')
+# Longer numbers are written as literals, conversion of very long
+# strings to `int` is slow and limited since Python 3.11
+_MAX_INTEGER_DIGITS = 19
+_INTEGER_LIMIT = 10 ** _MAX_INTEGER_DIGITS
+_uuid_re = re.compile('^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-'
+                      '[0-9a-f]{12}$')
+
+
+class CodecError(ValueError):
+    """Raised when a compact log stream cannot be decoded."""
+
+
+def _write_varint(buf, value):
+    """Appends unsigned LEB128 encoded integer to a bytearray."""
+    while value > 0x7f:
+        buf.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+
+def _read_varint(data, pos):
+    """Reads unsigned LEB128 integer, returns value and new position."""
+    result = shift = 0
+    while True:
+        try:
+            byte = data[pos]
+        except IndexError:
+            raise CodecError('Truncated integer.')
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _is_integer(value):
+    """Tests whether string round-trips through `int` unchanged."""
+    # Unlike `str.isdigit`, non-ASCII digits are not accepted
+    return (len(value) <= _MAX_INTEGER_DIGITS and
+            _integer_re.match(value) is not None and
+            (value[0] != '0' or value == '0'))
+
+
+class RecordEncoder(object):
+    """Encodes dictionaries of log variables to compact binary frames.
+
+    Each frame contains one value per field, values which are not known
+    are encoded as `-`. Decimal numbers are stored as variable length
+    integers, UUIDs (request IDs) as 16 bytes, and strings
+    of `dictionary_fields` are written only once per stream and referenced
+    by an index later.
+
+    Encoder is stateful, frames must be decoded in the same order by
+    one `RecordDecoder` starting with the `header`. Frames are never empty
+    so a zero byte followed by a new header can start another segment.
+    """
+
+    def __init__(self, fields=RECORD_FIELDS,
+                 dictionary_fields=DICTIONARY_FIELDS, max_table_size=65536):
+        if not fields:
+            raise ValueError('At least one field must be encoded.')
+        self.fields = tuple(fields)
+        self.dictionary_fields = frozenset(dictionary_fields)
+        self.max_table_size = max_table_size
+        self._table = {}
+
+    @property
+    def header(self):
+        """Stream header which describes encoded fields"""
+        buf = bytearray(MAGIC)
+        _write_varint(buf, len(self.fields))
+        for field in self.fields:
+            self._write_string(buf, field)
+        return bytes(buf)
+
+    def encode(self, values):
+        """Returns one length-prefixed frame with the given values."""
+        payload = bytearray()
+        table = self._table
+        for field in self.fields:
+            value = values.get(field, '-')
+            if value == '-' or value is None:
+                payload.append(_TOKEN_EMPTY)
+                continue
+            value = '%s' % value
+            if _is_integer(value):
+                payload.append(_TOKEN_INTEGER)
+                _write_varint(payload, int(value))
+            elif len(value) == 36 and _uuid_re.match(value):
+                payload.append(_TOKEN_UUID)
+                payload.extend(uuid.UUID(value).bytes)
+            elif field in self.dictionary_fields:
+                index = table.get(value)
+                if index is not None:
+                    _write_varint(payload, _TOKEN_TABLE + index)
+                elif len(table) < self.max_table_size:
+                    table[value] = len(table)
+                    payload.append(_TOKEN_CACHED)
+                    self._write_string(payload, value)
+                else:
+                    payload.append(_TOKEN_LITERAL)
+                    self._write_string(payload, value)
+            else:
+                payload.append(_TOKEN_LITERAL)
+                self._write_string(payload, value)
+        buf = bytearray()
+        _write_varint(buf, len(payload))
+        buf.extend(payload)
+        return bytes(buf)
+
+    @staticmethod
+    def _write_string(buf, value):
+        data = value.encode('utf-8')
+        _write_varint(buf, len(data))
+        buf.extend(data)
+
+
+class RecordDecoder(object):
+    """Decodes compact binary frames written by `RecordEncoder`.
+
+    Takes a binary file object positioned at the beginning of a stream.
+    Iteration yields one dictionary of log variables per frame.
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.fields = None
+        self._table = []
+        self._buffer = bytearray()
+        self._pos = 0
+
+    def __iter__(self):
+        if self.fields is None:
+            self._read_header()
+        while True:
+            frame = self._read_frame()
+            if frame is None:
+                return
+            yield frame
+
+    def _fill(self, size):
+        """Makes sure that `size` bytes are buffered, False on EOF."""
+        while len(self._buffer) - self._pos < size:
+            chunk = self.stream.read(self.chunk_size)
+            if not chunk:
+                return False
+            if self._pos:
+                del self._buffer[:self._pos]
+                self._pos = 0
+            self._buffer.extend(chunk)
+        return True
+
+    def _read_header(self):
+        magic_end = self._pos + len(MAGIC)
+        if not self._fill(len(MAGIC)) or \
+                self._buffer[self._pos:magic_end] != bytearray(MAGIC):
+            raise CodecError('Not a compact log stream.')
+        self._pos += len(MAGIC)
+        self._fill(4096)
+        self._table = []
+        data = self._buffer
+        count, pos = _read_varint(data, self._pos)
+        fields = []
+        for __ in range(count):
+            field, pos = self._read_string(data, pos)
+            fields.append(field)
+        self.fields = tuple(fields)
+        self._pos = pos
+
+    def _read_frame(self):
+        if not self._fill(1):
+            return None
+        self._fill(10)
+        size, start = _read_varint(self._buffer, self._pos)
+        self._pos = start
+        if size == 0:
+            self._read_header()
+            return self._read_frame()
+        if not self._fill(size):
+            raise CodecError('Truncated frame.')
+        data = self._buffer
+        pos = start = self._pos
+        end = start + size
+        table = self._table
+        rv = {}
+        for field in self.fields:
+            token, pos = _read_varint(data, pos)
+            if token == _TOKEN_EMPTY:
+                value = '-'
+            elif token == _TOKEN_INTEGER:
+                number, pos = _read_varint(data, pos)
+                if number >= _INTEGER_LIMIT:
+                    raise CodecError('Integer is too long.')
+                value = '%s' % number
+            elif token == _TOKEN_UUID:
+                if pos + 16 > end:
+                    raise CodecError('Truncated UUID.')
+                value = str(uuid.UUID(bytes=bytes(data[pos:pos + 16])))
+                pos += 16
+            elif token == _TOKEN_LITERAL:
+                value, pos = self._read_string(data, pos)
+            elif token == _TOKEN_CACHED:
+                value, pos = self._read_string(data, pos)
+                table.append(value)
+            else:
+                try:
+                    value = table[token - _TOKEN_TABLE]
+                except IndexError:
+                    raise CodecError('Unknown table reference.')
+            rv[field] = value
+        if pos != end:
+            raise CodecError('Corrupted frame.')
+        self._pos = end
+        return rv
+
+    @staticmethod
+    def _read_string(data, pos):
+        size, pos = _read_varint(data, pos)
+        end = pos + size
+        if end > len(data):
+            raise CodecError('Truncated string.')
+        return bytes(data[pos:end]).decode('utf-8'), end
+
+
+class CompactHandler(logging.Handler):
+    """Logging handler which writes records in a compact binary format.
+
+    Each record is written as one frame with `RECORD_FIELDS`: variables
+    of the current `RequestContext` and record level, logger name and
+    message. Frames can be converted back to text or JSON using
+    `python -m kudzu decode`.
+
+    Takes a binary stream or a file name. Each handler starts a new
+    segment with its own header, so it is safe to append to existing files,
+    but frames must be always decoded from the beginning of a file.
+    """
+
+    def __init__(self, stream, fields=RECORD_FIELDS, **encoder_kwargs):
+        logging.Handler.__init__(self)
+        if hasattr(stream, 'write'):
+            self.stream = stream
+        else:
+            self.stream = open(stream, 'ab')
+        self.encoder = RecordEncoder(fields, **encoder_kwargs)
+        self._header_written = False
+
+    def _write_header(self):
+        try:
+            position = self.stream.tell()
+        except (AttributeError, IOError, OSError):
+            position = 0
+        if position > 0:
+            # Zero sized frame separates segments in one file
+            self.stream.write(SEGMENT_SEPARATOR)
+        self.stream.write(self.encoder.header)
+        self._header_written = True
+
+    def emit(self, record):
+        try:
+            context = get_record_context(record)
+            values = context.log_vars if context else {}
+            values.update({
+                'levelname': record.levelname,
+                'name': record.name,
+                'message': record.getMessage(),
+            })
+            if not self._header_written:
+                self._write_header()
+            self.stream.write(self.encoder.encode(values))
+            self.flush()
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        self.acquire()
+        try:
+            if self.stream and hasattr(self.stream, 'flush'):
+                self.stream.flush()
+        finally:
+            self.release()
+
+    def close(self):
+        self.acquire()
+        try:
+            try:
+                if self.stream is not None:
+                    self.stream.close()
+            finally:
+                self.stream = None
+                logging.Handler.close(self)
+        finally:
+            self.release()
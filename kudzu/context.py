@@ -1,7 +1,11 @@
 
 from __future__ import absolute_import
 
+import math
+import os
+import sys
 import time
+import weakref
 
 try:
     import threading
@@ -9,6 +13,23 @@ except ImportError:  # pragma: nocover
     import dummy_threading as threading
 
 
+# Module tracemalloc (or False if unavailable), imported on first use
+# because its import is slower than the import of this package
+_tracemalloc = None
+
+
+def import_tracemalloc():
+    """Returns module `tracemalloc` or `None` if it is not available."""
+    global _tracemalloc
+    if _tracemalloc is None:
+        try:
+            import tracemalloc
+        except ImportError:  # pragma: nocover
+            tracemalloc = False
+        _tracemalloc = tracemalloc
+    return _tracemalloc or None
+
+
 #: List of all variables from request context available for logging
 CONTEXT_VARS = (
     # http://uwsgi-docs.readthedocs.org/en/latest/LogFormat.html#offsetof
@@ -16,10 +37,173 @@ CONTEXT_VARS = (
     # http://uwsgi-docs.readthedocs.org/en/latest/LogFormat.html#functions
     'status', 'micros', 'msecs', 'time', 'ctime', 'epoch', 'rsize',
     # Custom
-    'rid',
+    'rid', 'ctype', 'bsent', 'mem_kb', 'alloc_kb', 'qtime', 'inflight',
+    'route',
 )
 
 
+# Variables computed when log variables are read
+_COMPUTED_VARS = frozenset(['micros', 'msecs', 'epoch', 'bsent', 'mem_kb',
+                            'alloc_kb'])
+
+# Variables stored in a context
+_STORED_VARS = frozenset(CONTEXT_VARS) - _COMPUTED_VARS
+
+
+try:
+    _PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+except (AttributeError, ValueError, OSError):  # pragma: nocover
+    _PAGE_SIZE = 4096
+
+
+# Process ID and descriptor of its statm file, kept open for fast reads
+_statm = (None, None)
+_statm_lock = threading.Lock()
+
+
+def _read_statm():
+    global _statm
+    pid = os.getpid()
+    if _statm[0] != pid:
+        # Descriptor inherited from a parent process refers to its file
+        with _statm_lock:
+            if _statm[0] != pid:
+                if _statm[1] is not None:
+                    os.close(_statm[1])
+                _statm = (pid, os.open('/proc/self/statm', os.O_RDONLY))
+    return os.pread(_statm[1], 128, 0)
+
+
+def get_rss_kb():
+    """Returns resident set size of this process in kB or `None`.
+
+    Reads `/proc/self/statm`, returns `None` on systems without procfs.
+    """
+    try:
+        if hasattr(os, 'pread'):
+            data = _read_statm()
+        else:  # pragma: nocover
+            with open('/proc/self/statm', 'rb') as statm:
+                data = statm.read()
+        pages = int(data.split()[1])
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+    return pages * _PAGE_SIZE // 1024
+
+
+def get_traced_kb():
+    """Returns memory traced by `tracemalloc` in kB or `None`."""
+    tracemalloc = import_tracemalloc()
+    if tracemalloc is None or not tracemalloc.is_tracing():
+        return None
+    return tracemalloc.get_traced_memory()[0] // 1024
+
+
+class GreenletLocal(object):
+    """Attributes local to the current greenlet.
+
+    Drop-in replacement of `threading.local` for servers which run
+    requests in greenlets (gevent, eventlet). Attributes are stored
+    in dictionaries keyed by weak references to `getcurrent()`,
+    so greenlet switches cost nothing and attributes are dropped
+    with their greenlet.
+    """
+
+    __slots__ = ('_getcurrent', '_dicts', '_remove')
+
+    def __init__(self, getcurrent=None):
+        if getcurrent is None:
+            from greenlet import getcurrent
+        dicts = {}
+
+        def remove(ref):
+            dicts.pop(ref, None)
+
+        object.__setattr__(self, '_getcurrent', getcurrent)
+        object.__setattr__(self, '_dicts', dicts)
+        object.__setattr__(self, '_remove', remove)
+
+    def __getattribute__(self, name, get=object.__getattribute__,
+                         ref=weakref.ref):
+        # Normal lookup is skipped, stored attributes are read most often
+        try:
+            return get(self, '_dicts')[ref(get(self, '_getcurrent')())][name]
+        except KeyError:
+            return get(self, name)
+
+    def __setattr__(self, name, value):
+        current = self._getcurrent()
+        try:
+            self._dicts[weakref.ref(current)][name] = value
+        except KeyError:
+            key = weakref.ref(current, self._remove)
+            self._dicts[key] = {name: value}
+
+    def __delattr__(self, name):
+        try:
+            del self._dicts[weakref.ref(self._getcurrent())][name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+def _is_green():
+    """Tests whether threads were monkey-patched by gevent or eventlet."""
+    monkey = sys.modules.get('gevent.monkey')
+    if monkey is not None and monkey.is_module_patched('threading'):
+        return True
+    patcher = sys.modules.get('eventlet.patcher')
+    if patcher is not None and patcher.is_monkey_patched('thread'):
+        return True
+    return False
+
+
+class _Stack(list):
+    """Stack of request contexts which can be referenced weakly."""
+
+    __slots__ = ('__weakref__',)
+
+
+# Weak references to context stacks of all threads and greenlets,
+# so `select_storage` can tell whether any context is pushed
+_stacks = {}
+
+
+def _new_stack():
+    """Creates a context stack and registers it to `_stacks`."""
+    stack = _Stack()
+    key = id(stack)
+    _stacks[key] = weakref.ref(stack, lambda ref: _stacks.pop(key, None))
+    return stack
+
+
+def _get_queue_time(environ, start_time):
+    """Returns milliseconds spent since a front server received a request.
+
+    Front servers can add X-Request-Start or X-Queue-Start header with
+    time when they received the request, optionally prefixed by `t=`.
+    Time can be in seconds, milliseconds or microseconds since epoch,
+    the unit is guessed from the magnitude. Returns `-` if the header
+    is missing or invalid.
+    """
+    value = environ.get('HTTP_X_REQUEST_START') or \
+        environ.get('HTTP_X_QUEUE_START')
+    if not value:
+        return '-'
+    if value.startswith('t='):
+        value = value[2:]
+    try:
+        queue_start = float(value)
+    except ValueError:
+        return '-'
+    if math.isnan(queue_start) or math.isinf(queue_start):
+        return '-'
+    if queue_start > 1e14:
+        queue_start /= 1e6
+    elif queue_start > 1e11:
+        queue_start /= 1e3
+    return str(max(int((start_time - queue_start) * 1e3), 0))
+
+
 def _get_request_uri(environ):
     """Returns REQUEST_URI from WSGI environ
 
@@ -45,13 +229,58 @@ class RequestContext(object):
 
     Instance of this class is created from WSGI environ and later
     updated using arguments passed to `start_response` function.
+
+    If `trusted_proxies` (a `kudzu.proxy.TrustedProxies` instance)
+    is given, remote address is resolved from X-Forwarded-For
+    or Forwarded headers. The resolution is deferred until the address
+    is read for the first time.
+
+    Context stacks are local to threads, or to greenlets if threads
+    were monkey-patched by gevent or eventlet (see `set_storage`).
     """
 
     _local = threading.local()
 
-    def __init__(self, environ):
+    def __init__(self, environ, trusted_proxies=None):
         self._start_time = time.time()
+        self._forwarded = None
         self._log_vars = self._environ_log_vars(environ)
+        if trusted_proxies is not None:
+            forwarded = environ.get('HTTP_FORWARDED')
+            forwarded_for = environ.get('HTTP_X_FORWARDED_FOR')
+            if forwarded or forwarded_for:
+                self._forwarded = (trusted_proxies, self._log_vars['addr'],
+                                   forwarded, forwarded_for)
+        self.response_headers = None
+        self._sent_bytes = None
+        self._memory = None
+        self._close_callbacks = None
+
+    @classmethod
+    def from_log_vars(cls, log_vars):
+        """Creates a context from a dictionary of log variables.
+
+        This is used to restore a context outside of a WSGI request,
+        e.g. in a worker which executes a background job. Unknown
+        variables are `-`, start time is set to the current time.
+        Computed variables and keys which are not in `CONTEXT_VARS`
+        are ignored.
+        """
+        self = cls.__new__(cls)
+        self._start_time = time.time()
+        self._forwarded = None
+        self._log_vars = dict.fromkeys(CONTEXT_VARS, '-')
+        self._log_vars.update({
+            'time': str(int(self._start_time)),
+            'ctime': time.ctime(self._start_time),
+        })
+        self._log_vars.update((key, log_vars[key]) for key in log_vars
+                              if key in _STORED_VARS)
+        self.response_headers = None
+        self._sent_bytes = None
+        self._memory = None
+        self._close_callbacks = None
+        return self
 
     def __enter__(self):
         self.push()
@@ -74,7 +303,7 @@ class RequestContext(object):
         try:
             stack = RequestContext._local.stack
         except AttributeError:
-            stack = RequestContext._local.stack = []
+            stack = RequestContext._local.stack = _new_stack()
         if not stack:
             return None
         return stack[-1]
@@ -92,6 +321,52 @@ class RequestContext(object):
         except AttributeError:
             pass
 
+    @staticmethod
+    def set_storage(storage=None):
+        """Sets storage of context stacks and returns it.
+
+        Storage is an object like `threading.local` whose attributes
+        are local to the current thread or greenlet. If `storage`
+        is `None`, `GreenletLocal` is used when threads were patched
+        by gevent or eventlet, `threading.local` otherwise.
+
+        Context stack of the current thread is moved to the new storage.
+        Contexts pushed by other threads to the previous storage are
+        forgotten and popping them raises `RuntimeError`, so storage
+        should be set before requests are handled.
+        """
+        if storage is None:
+            storage = GreenletLocal() if _is_green() else threading.local()
+        try:
+            stack = RequestContext._local.stack
+        except AttributeError:
+            stack = None
+        RequestContext._local = storage
+        if stack:
+            storage.stack = stack
+        return storage
+
+    @staticmethod
+    def select_storage():
+        """Switches to `GreenletLocal` if threads were patched.
+
+        Patching is detected when this module is imported
+        and when `RequestContextMiddleware` is created, this method
+        must be called if threads are patched later.
+
+        Storage is not switched while contexts are pushed by other
+        threads, because their stacks would be lost.
+        """
+        if isinstance(RequestContext._local, GreenletLocal) or \
+                not _is_green():
+            return RequestContext._local
+        current = getattr(RequestContext._local, 'stack', None)
+        for ref in list(_stacks.values()):
+            stack = ref()
+            if stack and stack is not current:
+                return RequestContext._local
+        return RequestContext.set_storage(GreenletLocal())
+
     def push(self):
         """Sets this context for current thread.
 
@@ -100,7 +375,7 @@ class RequestContext(object):
         try:
             stack = RequestContext._local.stack
         except AttributeError:
-            stack = RequestContext._local.stack = []
+            stack = RequestContext._local.stack = _new_stack()
         stack.append(self)
 
     def pop(self):
@@ -112,7 +387,7 @@ class RequestContext(object):
         try:
             stack = RequestContext._local.stack
         except AttributeError:
-            stack = RequestContext._local.stack = []
+            stack = RequestContext._local.stack = _new_stack()
         if not stack:
             raise RuntimeError('RequestContext stack is empty.')
         if stack[-1] is not self:
@@ -122,6 +397,8 @@ class RequestContext(object):
     @property
     def log_vars(self):
         """Dictionary of variables to be formatted to log messages"""
+        if self._forwarded is not None:
+            self._resolve_addr()
         duration = time.time() - self._start_time
         rv = self._log_vars.copy()
         rv.update({
@@ -129,11 +406,43 @@ class RequestContext(object):
             'msecs': str(int(duration * 1e3)),
             'epoch': str(int(self._start_time)),
         })
+        if self._sent_bytes is not None:
+            rv['bsent'] = str(self._sent_bytes)
+        if self._memory is not None:
+            rv['mem_kb'] = self._memory_delta(0, get_rss_kb)
+            rv['alloc_kb'] = self._memory_delta(2, get_traced_kb)
         return rv
 
+    def get_log_var(self, key):
+        """Returns one variable of `log_vars` or `-` if it is not known.
+
+        This is cheaper than `log_vars` when only a few variables
+        are needed because the dictionary is not copied.
+        """
+        if key not in _COMPUTED_VARS:
+            if key == 'addr' and self._forwarded is not None:
+                self._resolve_addr()
+            return self._log_vars.get(key, '-')
+        if key == 'epoch':
+            return str(int(self._start_time))
+        if key == 'bsent':
+            if self._sent_bytes is None:
+                return '-'
+            return str(self._sent_bytes)
+        if key == 'mem_kb':
+            return self._memory_delta(0, get_rss_kb)
+        if key == 'alloc_kb':
+            return self._memory_delta(2, get_traced_kb)
+        duration = time.time() - self._start_time
+        if key == 'micros':
+            return str(int(duration * 1e6))
+        return str(int(duration * 1e3))
+
     @property
     def remote_addr(self):
         """Remote address of this context request"""
+        if self._forwarded is not None:
+            self._resolve_addr()
         addr = self._log_vars['addr']
         if addr == '-':
             return None
@@ -147,6 +456,20 @@ class RequestContext(object):
             return None
         return rid
 
+    def _resolve_addr(self):
+        """Replaces remote address by a client address forwarded by proxies.
+        """
+        # Contexts can be read by other threads, so the address is set
+        # before the header values are cleared
+        forwarded = self._forwarded
+        if forwarded is None:
+            return
+        trusted_proxies, addr, forwarded, forwarded_for = forwarded
+        if addr != '-':
+            self._log_vars['addr'] = trusted_proxies.resolve(
+                addr, forwarded, forwarded_for)
+        self._forwarded = None
+
     def set_status(self, status):
         """Sets response status line.
 
@@ -159,6 +482,20 @@ class RequestContext(object):
         else:
             self._log_vars['status'] = '%s' % status_code
 
+    def set_in_flight(self, count):
+        """Sets number of requests in progress when this one started.
+
+        This method is called by `RequestContextMiddleware`.
+        """
+        self._log_vars['inflight'] = '%s' % count
+
+    def set_route(self, route):
+        """Sets normalized path of the request.
+
+        This method is called by `RequestContextMiddleware`.
+        """
+        self._log_vars['route'] = route
+
     def set_response_size(self, value):
         """Sets size of response body (without headers) in bytes.
 
@@ -172,6 +509,92 @@ class RequestContext(object):
         else:
             self._log_vars['rsize'] = '%s' % size
 
+    def add_sent_bytes(self, size):
+        """Adds size of a chunk of response body passed to the server.
+
+        This method is called when response body is iterated.
+        """
+        if self._sent_bytes is None:
+            self._sent_bytes = size
+        else:
+            self._sent_bytes += size
+
+    def add_close_callback(self, callback):
+        """Registers function to be called when the request ends.
+
+        Callbacks are called by `close` with this context as an argument.
+        """
+        if self._close_callbacks is None:
+            self._close_callbacks = []
+        self._close_callbacks.append(callback)
+
+    def close(self):
+        """Calls close callbacks with this context pushed.
+
+        This method is called by `RequestContextMiddleware` when
+        the response is closed. Each callback is called only once.
+        All callbacks are called even if some of them fail, the first
+        exception is raised afterwards.
+        """
+        callbacks = self._close_callbacks
+        if callbacks:
+            self._close_callbacks = None
+            errors = []
+            with self:
+                for callback in callbacks:
+                    try:
+                        callback(self)
+                    except Exception as e:
+                        errors.append(e)
+            if errors:
+                raise errors[0]
+
+    def start_memory_tracking(self, allocations=True):
+        """Starts to track changes of process memory during this request.
+
+        Log variable `mem_kb` is set to change of resident set size.
+        If `allocations` is truthy, `alloc_kb` is set to change of memory
+        traced by `tracemalloc` if tracing is active; the caller must
+        keep tracing active until `stop_memory_tracking` is called,
+        because stopping it clears all traces. Values are computed when
+        they are read until `stop_memory_tracking` is called.
+        """
+        # Start and end values of RSS and traced memory
+        traced_kb = get_traced_kb() if allocations else None
+        self._memory = [get_rss_kb(), None, traced_kb, None]
+
+    def stop_memory_tracking(self):
+        """Freezes values of memory log variables."""
+        memory = self._memory
+        if memory is not None and memory[1] is None:
+            memory[1] = get_rss_kb()
+            memory[3] = get_traced_kb()
+
+    def _memory_delta(self, index, getter):
+        if self._memory is None:
+            return '-'
+        start, end = self._memory[index:index + 2]
+        if end is None:
+            end = getter()
+        if start is None or end is None:
+            return '-'
+        return str(end - start)
+
+    def set_response_headers(self, headers):
+        """Sets values of response headers found in start_response.
+
+        Takes a dictionary which maps lower-case header names to lists
+        of values. Values are available in `response_headers` attribute,
+        response size and content type are also set as log variables.
+        """
+        self.response_headers = headers
+        content_length = headers.get('content-length')
+        if content_length:
+            self.set_response_size(content_length[0])
+        content_type = headers.get('content-type')
+        if content_type:
+            self._log_vars['ctype'] = content_type[0]
+
     def _environ_log_vars(self, environ):
         rv = dict.fromkeys(CONTEXT_VARS, '-')
         get_env_var = environ.get
@@ -187,10 +610,14 @@ class RequestContext(object):
             'time': str(int(self._start_time)),
             'ctime': time.ctime(self._start_time),
             'rid': get_env_var('HTTP_X_REQUEST_ID', '-'),
+            'qtime': _get_queue_time(environ, self._start_time),
         })
         return rv
 
 
+RequestContext.select_storage()
+
+
 def get_remote_addr():
     """Returns remote address of the the current thread request.
 
@@ -0,0 +1,331 @@
+"""Logging handlers which work with request context."""
+
+from __future__ import absolute_import
+
+import collections
+import logging
+import os
+import socket
+import time
+import weakref
+
+try:
+    import queue
+except ImportError:  # pragma: nocover
+    import Queue as queue
+
+try:
+    import threading
+except ImportError:  # pragma: nocover
+    import dummy_threading as threading
+
+from kudzu.logging import CONTEXT_ATTR, get_record_context
+
+
+class RequestBufferHandler(logging.Handler):
+    """Logging handler which emits detailed logs only of failed requests.
+
+    Records with level lower than `pass_level` are kept per request ID
+    in a ring buffer with the given `capacity`. If the request logs
+    a record with `flush_level` or higher, or if its duration exceeds
+    `latency_threshold` milliseconds, buffered records are passed
+    to the `target` handler. Otherwise they are discarded when the request
+    ends. Other records and records logged outside of requests are passed
+    to the target immediately.
+
+    Records are buffered unformatted with the request context attached,
+    so target formatters see the same variables. Level of this handler
+    and of the target must be low enough to accept detailed records.
+
+    Buffers are kept per request context (not per request ID, which
+    can be sent by clients) and released when `RequestContextMiddleware`
+    closes the context. Buffered records do not reference their context,
+    so buffers of contexts which are never closed are released when
+    the context is garbage collected. At most `max_requests` buffers
+    are kept, the oldest one is discarded if a new request logs a record
+    when the limit is reached.
+    """
+
+    def __init__(self, target, capacity=1000, pass_level=logging.INFO,
+                 flush_level=logging.ERROR, latency_threshold=None,
+                 max_requests=1000):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.capacity = capacity
+        self.pass_level = pass_level
+        self.flush_level = flush_level
+        self.latency_threshold = latency_threshold
+        self.max_requests = max_requests
+        # Context ID -> [weak reference to context, buffer], buffer
+        # is `None` in flushed requests
+        self._buffers = collections.OrderedDict()
+
+    def emit(self, record):
+        try:
+            self._emit(record)
+        except Exception:
+            self.handleError(record)
+
+    def _emit(self, record):
+        context = get_record_context(record)
+        if context is None or context.request_id is None:
+            self.target.handle(record)
+            return
+        try:
+            entry = self._buffers[id(context)]
+        except KeyError:
+            entry = self._add_buffer(context)
+        buffer = entry[1]
+        if buffer is None:
+            self.target.handle(record)
+        elif record.levelno >= self.flush_level:
+            self._flush(context)
+            self.target.handle(record)
+        elif record.levelno >= self.pass_level:
+            self.target.handle(record)
+        else:
+            # Context is attached again when the record is flushed
+            record.__dict__.pop(CONTEXT_ATTR, None)
+            buffer.append(record)
+
+    def _add_buffer(self, context):
+        buffers = self._buffers
+        while len(buffers) >= self.max_requests:
+            buffers.popitem(last=False)
+        key = id(context)
+
+        def release(ref):
+            buffers.pop(key, None)
+
+        entry = buffers[key] = [weakref.ref(context, release),
+                                collections.deque(maxlen=self.capacity)]
+        context.add_close_callback(self._close_request)
+        return entry
+
+    def _flush(self, context):
+        """Passes buffered records of the request to the target."""
+        entry = self._buffers.get(id(context))
+        if entry is None:
+            entry = self._add_buffer(context)
+        buffer, entry[1] = entry[1], None
+        for record in buffer or ():
+            record.__dict__[CONTEXT_ATTR] = context
+            self.target.handle(record)
+
+    def _close_request(self, context):
+        """Flushes buffer of a slow request and releases it."""
+        self.acquire()
+        try:
+            if self.latency_threshold is not None and \
+                    int(context.get_log_var('msecs')) >= \
+                    self.latency_threshold:
+                self._flush(context)
+            self._buffers.pop(id(context), None)
+        finally:
+            self.release()
+
+    def flush(self):
+        self.target.flush()
+
+    def close(self):
+        self.acquire()
+        try:
+            self._buffers.clear()
+        finally:
+            self.release()
+        logging.Handler.close(self)
+
+
+def _truncate(data, size):
+    """Truncates UTF-8 encoded record to `size` bytes.
+
+    Partial characters are removed and the newline is kept.
+    """
+    data = data[:size - 1].decode('utf-8', 'ignore').encode('utf-8')
+    return data + b'\n'
+
+
+# Messages for the sender thread of `BatchingSocketHandler`
+_FLUSH = object()
+_STOP = object()
+
+
+class BatchingSocketHandler(logging.Handler):
+    """Logging handler which sends batches of records from a background thread.
+
+    Records are formatted in the logging thread (so formatters can read
+    the request context) and put to a queue with `queue_size` entries.
+    Records are dropped and counted in `dropped` when the queue is full,
+    so requests are never blocked by a slow collector.
+
+    A background thread joins newline terminated records to batches
+    of at most `max_size` bytes and sends each batch as one datagram
+    or one write to a stream socket. A batch is sent when it is full
+    or `flush_interval` seconds after its first record.
+
+    `address` is a (host, port) tuple or a path of a Unix domain socket,
+    `socktype` is `socket.SOCK_DGRAM` (default) or `socket.SOCK_STREAM`.
+    Default `max_size` is 1400 bytes for UDP (to fit Ethernet MTU) and
+    8 kB otherwise, longer records are truncated in datagrams. When
+    a connection or a send fails, the batch is dropped and the socket
+    is reconnected after a delay which doubles up to `max_reconnect_delay`.
+    Records emitted after `close` are ignored.
+    """
+
+    def __init__(self, address, socktype=socket.SOCK_DGRAM, max_size=None,
+                 flush_interval=0.2, queue_size=10000, reconnect_delay=1.0,
+                 max_reconnect_delay=30.0, timeout=5.0):
+        logging.Handler.__init__(self)
+        self.address = address
+        self.socktype = socktype
+        if max_size is None:
+            udp = socktype == socket.SOCK_DGRAM and \
+                not isinstance(address, str)
+            max_size = 1400 if udp else 8192
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self.queue_size = queue_size
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.timeout = timeout
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+        self.queue = None
+        self._closed = False
+        self._pid = None
+        self._thread = None
+        self._sock = None
+        self._delay = reconnect_delay
+        self._next_connect = 0
+
+    def emit(self, record):
+        if self._closed:
+            return
+        try:
+            data = (self.format(record) + '\n').encode('utf-8')
+            if self._pid != os.getpid():
+                self._start()
+            self.queue.put_nowait(data)
+        except queue.Full:
+            self._drop(1)
+        except Exception:
+            self.handleError(record)
+
+    def _drop(self, count):
+        """Counts dropped records, called by logging and sender threads."""
+        with self._dropped_lock:
+            self.dropped += count
+
+    def _start(self):
+        """Starts sender thread, also in a forked process."""
+        self._pid = os.getpid()
+        self._sock = None
+        self.queue = queue.Queue(self.queue_size)
+        self._thread = threading.Thread(target=self._run,
+                                        name='kudzu-log-sender')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        batch = []
+        size = 0
+        deadline = None
+        stream = self.socktype == socket.SOCK_STREAM
+        while True:
+            try:
+                if deadline is None:
+                    data = self.queue.get()
+                else:
+                    timeout = deadline - time.time()
+                    if timeout <= 0:
+                        raise queue.Empty
+                    data = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                data = _FLUSH
+            if data is _FLUSH or data is _STOP:
+                if batch:
+                    self._send(batch)
+                batch, size, deadline = [], 0, None
+                if data is _STOP:
+                    self._close_socket()
+                    return
+                continue
+            if not stream and len(data) > self.max_size:
+                data = _truncate(data, self.max_size)
+            if batch and size + len(data) > self.max_size:
+                self._send(batch)
+                batch, size, deadline = [], 0, None
+            batch.append(data)
+            size += len(data)
+            if deadline is None:
+                deadline = time.time() + self.flush_interval
+
+    def _connect(self):
+        if isinstance(self.address, str):
+            family, address = socket.AF_UNIX, self.address
+        else:
+            host, port = self.address
+            family, __, __, __, address = socket.getaddrinfo(
+                host, port, 0, self.socktype)[0]
+        sock = socket.socket(family, self.socktype)
+        try:
+            sock.settimeout(self.timeout)
+            sock.connect(address)
+        except:
+            sock.close()
+            raise
+        return sock
+
+    def _send(self, batch):
+        """Sends records, drops them if the socket is not available."""
+        try:
+            if self._sock is None:
+                if time.time() < self._next_connect:
+                    self._drop(len(batch))
+                    return
+                self._sock = self._connect()
+            data = b''.join(batch)
+            if self.socktype == socket.SOCK_STREAM:
+                self._sock.sendall(data)
+            else:
+                self._sock.send(data)
+        except (OSError, socket.error):
+            self._drop(len(batch))
+            self._close_socket()
+            self._next_connect = time.time() + self._delay
+            self._delay = min(self._delay * 2, self.max_reconnect_delay)
+        else:
+            self._delay = self.reconnect_delay
+
+    def _close_socket(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except (OSError, socket.error):  # pragma: nocover
+                pass
+            self._sock = None
+
+    def flush(self):
+        """Asks the sender thread to send the current batch."""
+        if self._pid == os.getpid():
+            try:
+                self.queue.put_nowait(_FLUSH)
+            except queue.Full:
+                pass
+
+    def close(self):
+        """Sends queued records and stops the sender thread."""
+        self.acquire()
+        try:
+            self._closed = True
+            if self._pid == os.getpid() and self._thread is not None and \
+                    self._thread.is_alive():
+                try:
+                    self.queue.put(_STOP, timeout=self.timeout)
+                except queue.Full:
+                    pass
+                self._thread.join(self.timeout)
+            self._pid = None
+        finally:
+            self.release()
+        logging.Handler.close(self)
@@ -2,10 +2,24 @@
 from __future__ import absolute_import
 
 import logging
+import re
+import string
 
 from kudzu.context import CONTEXT_VARS, RequestContext
 
 
+#: Name of log record attribute which holds `RequestContext`
+CONTEXT_ATTR = 'kudzu_context'
+
+
+def get_record_context(record):
+    """Returns `RequestContext` attached to a record or the current one."""
+    try:
+        return record.__dict__[CONTEXT_ATTR]
+    except KeyError:
+        return RequestContext.get()
+
+
 class RequestContextFilter(object):
     """Logging filter which injects information about a current request.
 
@@ -19,43 +33,290 @@ class RequestContextFilter(object):
     `RequestContextFilter` depends on `RequestContextMiddleware`
     to make `RequestContext` globally available.
 
-    Functions `kudzify_handler` and `kudzify_logger` simplify configuration
-    of loggers with this instances of this class.
+    Each record is enriched only once: the request context is attached
+    to the `kudzu_context` attribute and keys which were already added
+    by another filter (e.g. on another handler) are skipped.
+    If no keys are given, only the context is attached and variables
+    are resolved lazily by `RequestContextFormatter`.
     """
 
-    def __init__(self, keys):
-        self.keys = tuple(keys)
+    def __init__(self, keys=()):
+        self.keys = frozenset(keys)
 
     def filter(self, record):
-        context = RequestContext.get()
-        log_vars = context.log_vars if context else {}
-        for key in self.keys:
-            value = log_vars.get(key, '-')
-            setattr(record, key, value)
+        attrs = record.__dict__
+        try:
+            context = attrs[CONTEXT_ATTR]
+        except KeyError:
+            context = attrs[CONTEXT_ATTR] = RequestContext.get()
+        if not self.keys:
+            return True
+        done = attrs.get('_kudzu_keys', frozenset())
+        if self.keys <= done:
+            return True
+        keys = self.keys - done
+        if context is None:
+            attrs.update(dict.fromkeys(keys, '-'))
+        else:
+            get_log_var = context.get_log_var
+            attrs.update((key, get_log_var(key)) for key in keys)
+        attrs['_kudzu_keys'] = done | keys
         return True
 
 
+class ContextLogRecord(logging.LogRecord):
+    """Log record which captures `RequestContext` when it is created.
+
+    Variables of the captured context are resolved lazily when they
+    are accessed as attributes which do not exist on the record.
+    Note that `logging.Formatter` does not access attributes, so
+    use `RequestContextFormatter` to format these records.
+
+    Installed as a log record factory by `install_record_factory`.
+    """
+
+    def __init__(self, *args, **kwargs):
+        logging.LogRecord.__init__(self, *args, **kwargs)
+        self.__dict__[CONTEXT_ATTR] = RequestContext.get()
+
+    def __getattr__(self, name):
+        if name not in CONTEXT_VARS:
+            raise AttributeError(name)
+        context = self.__dict__.get(CONTEXT_ATTR)
+        if context is None:
+            return '-'
+        return context.get_log_var(name)
+
+
+def install_record_factory():
+    """Makes all log records capture `RequestContext` when created.
+
+    The context is attached to records once in the thread which logs
+    them, so it is available even if records are formatted later
+    in another thread (e.g. by `QueueListener`) and no filter
+    has to enrich records for each handler.
+
+    Default factory is replaced by `ContextLogRecord`, custom factories
+    are wrapped. Requires Python 3.2 or later.
+    """
+    factory = logging.getLogRecordFactory()
+    if factory is ContextLogRecord or hasattr(factory, 'kudzu_wrapped'):
+        return
+    if factory is logging.LogRecord:
+        logging.setLogRecordFactory(ContextLogRecord)
+        return
+    def record_factory(*args, **kwargs):
+        record = factory(*args, **kwargs)
+        record.__dict__.setdefault(CONTEXT_ATTR, RequestContext.get())
+        return record
+    record_factory.kudzu_wrapped = factory
+    logging.setLogRecordFactory(record_factory)
+
+
+def uninstall_record_factory():
+    """Restores log record factory replaced by `install_record_factory`."""
+    factory = logging.getLogRecordFactory()
+    if factory is ContextLogRecord:
+        logging.setLogRecordFactory(logging.LogRecord)
+    elif hasattr(factory, 'kudzu_wrapped'):
+        logging.setLogRecordFactory(factory.kudzu_wrapped)
+
+
 BASIC_FORMAT = "[%(addr)s|%(rid)s] %(levelname)s:%(name)s:%(message)s"
 
+# Regular expressions compiled by `_compile_patterns` on first use
+_percent_re = None
+_name_re = None
+
+
+def _compile_patterns():
+    global _percent_re, _name_re
+    _percent_re = re.compile(r'%(?:\((?P<name>[^)]*)\)(?P<spec>[#0+ -]*\d*'
+                             r'(?:\.\d+)?[diouxXeEfFgGcrsa])|%)')
+    _name_re = re.compile(r'^[^\W\d]\w*$')
+
+
+# Kinds of placeholders in compiled formats
+_CONTEXT = 'context'
+_MESSAGE = 'message'
+_ASCTIME = 'asctime'
+_RECORD = 'record'
+
+def _format_text(value):
+    """Formats a value like `%s`, keeps unicode strings on Python 2."""
+    return '%s' % (value,)
+
+
+def _format_empty_spec(value):
+    """Formats a value like `{}`, keeps unicode strings on Python 2."""
+    return format(value, '')
+
+
+try:
+    _conversions = {None: None, 's': str, 'r': repr, 'a': ascii}
+except NameError:  # pragma: nocover
+    _conversions = {None: None, 's': str, 'r': repr}
+
+
+class RequestContextFormatter(logging.Formatter):
+    """Logging formatter which reads placeholders from a request context.
+
+    Format string is compiled once to a tuple of literal chunks and
+    getters. Placeholders from `CONTEXT_VARS` are read directly from
+    a `RequestContext` attached to the record by `RequestContextFilter`
+    or `install_record_factory` or from the current one, other placeholders
+    from the log record, so no variables have to be set on records.
+
+    Supports `%`, `{` and `$` format styles like `logging.Formatter`.
+    Placeholders with attribute access or indexing are not supported.
+    """
+
+    def __init__(self, fmt=BASIC_FORMAT, datefmt=None, style='%'):
+        if style == '%':
+            logging.Formatter.__init__(self, fmt, datefmt)
+        else:
+            logging.Formatter.__init__(self, fmt, datefmt, style)
+        self.format_style = style
+        self._plan = tuple(self._compile(fmt, style))
+
+    def usesTime(self):
+        return any(kind is _ASCTIME for __, kind, __, __ in self._plan)
+
+    def _compile(self, fmt, style):
+        """Yields tuples of a literal, placeholder name and formatter."""
+        if style == '%':
+            items = self._parse_percent(fmt)
+        elif style == '{':
+            items = self._parse_braces(fmt)
+        elif style == '$':
+            items = self._parse_template(fmt)
+        else:
+            raise ValueError('Style must be one of: %, {, $')
+        literal = ''
+        for text, key, formatter in items:
+            literal += text
+            if key is None:
+                continue
+            if key in CONTEXT_VARS:
+                kind = _CONTEXT
+            elif key == 'message':
+                kind = _MESSAGE
+            elif key == 'asctime':
+                kind = _ASCTIME
+            else:
+                kind = _RECORD
+            yield literal, kind, key, formatter
+            literal = ''
+        if literal:
+            yield literal, None, None, None
+
+    @staticmethod
+    def _parse_percent(fmt):
+        if _percent_re is None:
+            _compile_patterns()
+        pos = 0
+        for match in _percent_re.finditer(fmt):
+            text = fmt[pos:match.start()]
+            pos = match.end()
+            if match.group('name') is None:
+                yield text + '%', None, None
+                continue
+            spec = match.group('spec')
+            if spec == 's':
+                formatter = _format_text
+            else:
+                formatter = ('%' + spec).__mod__
+            yield text, match.group('name'), formatter
+        yield fmt[pos:], None, None
+
+    @staticmethod
+    def _parse_braces(fmt):
+        if _name_re is None:
+            _compile_patterns()
+        for text, name, spec, conversion in string.Formatter().parse(fmt):
+            if name is None:
+                yield text, None, None
+                continue
+            if not _name_re.match(name):
+                raise ValueError('Unsupported placeholder {%s}' % name)
+            convert = _conversions[conversion]
+            if not spec and convert is not None:
+                formatter = convert
+            elif not spec:
+                formatter = _format_empty_spec
+            elif convert is None:
+                formatter = lambda value, spec=spec: format(value, spec)
+            else:
+                formatter = lambda value, spec=spec, convert=convert: \
+                    format(convert(value), spec)
+            yield text, name, formatter
+
+    @staticmethod
+    def _parse_template(fmt):
+        pos = 0
+        for match in string.Template.pattern.finditer(fmt):
+            text = fmt[pos:match.start()]
+            pos = match.end()
+            if match.group('escaped') is not None:
+                yield text + '$', None, None
+                continue
+            name = match.group('named') or match.group('braced')
+            if name is None:
+                raise ValueError('Invalid placeholder in %r' % fmt)
+            yield text, name, _format_text
+        yield fmt[pos:], None, None
+
+    def format(self, record):
+        context = get_record_context(record)
+        chunks = []
+        append = chunks.append
+        for literal, kind, key, formatter in self._plan:
+            append(literal)
+            if kind is _CONTEXT:
+                if context is None:
+                    value = '-'
+                else:
+                    value = context.get_log_var(key)
+            elif kind is None:
+                continue
+            elif kind is _MESSAGE:
+                value = record.getMessage()
+            elif kind is _ASCTIME:
+                value = self.formatTime(record, self.datefmt)
+            else:
+                try:
+                    value = record.__dict__[key]
+                except KeyError:
+                    raise ValueError('Formatting field not found in '
+                                     'record: %r' % key)
+            append(formatter(value))
+        rv = ''.join(chunks)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            if rv[-1:] != '\n':
+                rv += '\n'
+            rv += record.exc_text
+        stack_info = getattr(record, 'stack_info', None)
+        if stack_info:
+            if rv[-1:] != '\n':
+                rv += '\n'
+            rv += self.formatStack(stack_info)
+        return rv
+
 
-def kudzify_handler(handler, format=BASIC_FORMAT):
+def kudzify_handler(handler, format=BASIC_FORMAT, style='%'):
     """Extends format string of a handler by request context placeholders.
 
     Takes a logging handler instance format string with `CONTEXT_VARS`
-    placeholders. It configures `RequestContextFilter` to extract necessary
-    variables from a `RequestContext`, attaches the filter to the given
-    handler, and replaces handler formatter.
+    placeholders. It replaces handler formatter by
+    `RequestContextFormatter` which reads necessary variables
+    from a `RequestContext` when records are formatted.
     """
-    keys = []
-    for key in CONTEXT_VARS:
-        if '%%(%s)' % key in format:
-            keys.append(key)
-    context_filter = RequestContextFilter(keys)
-    handler.formatter = logging.Formatter(format)
-    handler.addFilter(context_filter)
+    handler.formatter = RequestContextFormatter(format, style=style)
 
 
-def kudzify_logger(logger=None, format=BASIC_FORMAT):
+def kudzify_logger(logger=None, format=BASIC_FORMAT, style='%'):
     """Extends format string of a logger by request context placeholders.
 
     It calls `kudzify_handler` on each handler registered to the given
@@ -64,4 +325,4 @@ def kudzify_logger(logger=None, format=BASIC_FORMAT):
     if not isinstance(logger, logging.Logger):
         logger = logging.getLogger(logger)
     for handler in logger.handlers:
-        kudzify_handler(handler, format=format)
+        kudzify_handler(handler, format=format, style=style)
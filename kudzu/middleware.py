@@ -2,10 +2,20 @@
 from __future__ import absolute_import
 
 import logging
+import os
 import re
-import uuid
+import signal
+import sys
+import time
+import weakref
+import zlib
 
-from kudzu.context import RequestContext
+try:
+    import threading
+except ImportError:  # pragma: nocover
+    import dummy_threading as threading
+
+from kudzu.context import import_tracemalloc, RequestContext
 
 
 uuid_re = re.compile('^[0-9a-f]{8}-?'
@@ -15,12 +25,492 @@ uuid_re = re.compile('^[0-9a-f]{8}-?'
                      '[0-9a-f]{12}$')
 
 
+# Functions of modules random and uuid, imported on first use
+_random = None
+_uuid4 = None
+
+
+def _sample(rate):
+    """Returns True with probability `rate`."""
+    global _random
+    if _random is None:
+        import random
+        _random = random.random
+    return _random() < rate
+
+
+def _record_file_wrappers(environ):
+    """Makes responses created by a function `wsgi.file_wrapper` known.
+
+    Servers like uWSGI provide a function instead of a class, so its
+    responses cannot be recognized by type. Such a function is replaced
+    by one which remembers the responses it returns in the environ.
+    """
+    file_wrapper = environ.get('wsgi.file_wrapper')
+    if file_wrapper is None or isinstance(file_wrapper, type) or \
+            'kudzu.file_responses' in environ:
+        return
+    responses = environ['kudzu.file_responses'] = []
+
+    def recording_file_wrapper(*args, **kwargs):
+        rv = file_wrapper(*args, **kwargs)
+        responses.append(rv)
+        return rv
+    environ['wsgi.file_wrapper'] = recording_file_wrapper
+
+
+def _is_file_wrapper(environ, response):
+    """Tests whether response was created by server `wsgi.file_wrapper`.
+
+    Such responses are not wrapped, so servers can send them efficiently.
+    Function file wrappers are recognized if `_record_file_wrappers`
+    was called before the application.
+    """
+    file_wrapper = environ.get('wsgi.file_wrapper')
+    if isinstance(file_wrapper, type):
+        return isinstance(response, file_wrapper)
+    for file_response in environ.get('kudzu.file_responses', ()):
+        if response is file_response:
+            return True
+    return False
+
+
+class _SizedResponse(object):
+    """Mixin of response wrappers which forwards `len` of the response.
+
+    Servers use length of a response list, e.g. to set Content-Length.
+    """
+
+    def __len__(self):
+        return len(self.iterable)
+
+
+class ScannedHeaders(dict):
+    """Values of selected response headers.
+
+    Maps lower-case header names to lists of values. Remembers the list
+    of headers it was created from and the names which were looked up,
+    so other middlewares can reuse it.
+    """
+
+    def __init__(self, headers, names):
+        dict.__init__(self)
+        self.headers = headers
+        self.headers_length = len(headers)
+        self.names = names
+
+    def is_scan_of(self, headers, name):
+        """Tests whether the header was looked up in the given headers."""
+        return (headers is self.headers and
+                len(headers) == self.headers_length and
+                name in self.names)
+
+
+class HeaderScanner(object):
+    """Extracts values of selected headers in one pass over response headers.
+
+    Header names are compared case-insensitively. Headers with lengths
+    different from all selected names are skipped without any
+    allocation and usual spellings (as given, lower-case, upper-case,
+    title-case) are looked up directly, other spellings are lowered.
+    """
+
+    def __init__(self, names):
+        self.names = frozenset(name.lower() for name in names)
+        self._lengths = frozenset(len(name) for name in self.names)
+        self._spellings = {}
+        for name in names:
+            lower = name.lower()
+            for spelling in (name, lower, name.upper(), name.title(),
+                             lower.capitalize()):
+                self._spellings[spelling] = lower
+
+    def scan(self, headers):
+        """Returns `ScannedHeaders` from a list of (name, value) pairs."""
+        rv = ScannedHeaders(headers, self.names)
+        lengths = self._lengths
+        spellings = self._spellings
+        for key, value in headers:
+            if len(key) not in lengths:
+                continue
+            name = spellings.get(key)
+            if name is None:
+                name = key.lower()
+                if name not in self.names:
+                    continue
+            values = rv.get(name)
+            if values is None:
+                rv[name] = [value]
+            else:
+                values.append(value)
+        return rv
+
+
+class LoggingRule(object):
+    """Rule which changes how `LoggingMiddleware` logs matching requests.
+
+    A rule matches requests whose path (`SCRIPT_NAME` and `PATH_INFO`)
+    starts with `prefix`, whose method is one of `methods` and whose
+    response status is one of `statuses`. Statuses can be given
+    as integers or as classes like `'5xx'`. `None` matches anything.
+
+    Matching requests are not logged if `exclude` is truthy, otherwise
+    they are logged with the given `level` and formats if not `None`.
+    Rules with `statuses` apply only to response messages.
+    """
+
+    def __init__(self, prefix='', methods=None, statuses=None, level=None,
+                 exclude=False, request_format=None, response_format=None):
+        self.prefix = prefix
+        if methods is not None:
+            methods = frozenset(method.upper() for method in methods)
+        self.methods = methods
+        if statuses is not None:
+            statuses = frozenset('%s' % status for status in statuses)
+        self.statuses = statuses
+        self.level = level
+        self.exclude = exclude
+        self.request_format = request_format
+        self.response_format = response_format
+
+    def match_status(self, status):
+        """Tests whether rule applies to the response status."""
+        return (self.statuses is None or status in self.statuses or
+                status[:1] + 'xx' in self.statuses)
+
+
+class LoggingRules(object):
+    """Ordered list of `LoggingRule` instances compiled to a prefix trie.
+
+    All rules which match a request path and method are found
+    by one walk of the trie and the first matching rule applies.
+    """
+
+    def __init__(self, rules):
+        self.rules = tuple(rules)
+        # Node is a tuple of children dictionary and list of rule indexes
+        self._root = ({}, [])
+        for index, rule in enumerate(self.rules):
+            node = self._root
+            for char in rule.prefix:
+                node = node[0].setdefault(char, ({}, []))
+            node[1].append(index)
+
+    def match(self, method, path):
+        """Returns rules matching the request path and method in order."""
+        node = self._root
+        indexes = list(node[1])
+        for char in path:
+            node = node[0].get(char)
+            if node is None:
+                break
+            indexes.extend(node[1])
+        if not indexes:
+            return ()
+        rules = self.rules
+        return tuple(rules[index] for index in sorted(indexes)
+                     if rules[index].methods is None or
+                     method in rules[index].methods)
+
+
+class ExceptionLimiter(object):
+    """Limits number of logged tracebacks of repeated exceptions.
+
+    Exceptions are fingerprinted by their type and the code location
+    where they were raised. Each fingerprint has a token bucket which
+    allows bursts of `tracebacks` full tracebacks and refills at rate
+    of `tracebacks` per `window` seconds. Other exceptions with the same
+    fingerprint are counted, together with the last request ID, and
+    returned by `summaries` once `window` seconds elapse since the first
+    of them.
+
+    At most `max_fingerprints` fingerprints are remembered.
+    """
+
+    def __init__(self, tracebacks=10, window=60.0, max_fingerprints=1000,
+                 clock=time.time):
+        self.tracebacks = tracebacks
+        self.window = window
+        self.max_fingerprints = max_fingerprints
+        self.clock = clock
+        self._lock = threading.Lock()
+        # Fingerprint -> [tokens, last refill time, suppressed count,
+        # last suppressed request ID, time when summary is due]
+        self._buckets = {}
+        # Earliest time when any summary is due
+        self._next_summary = float('inf')
+
+    @staticmethod
+    def fingerprint(exc_info):
+        """Returns string which identifies exception type and location."""
+        exc_type, exc_value, tb = exc_info
+        name = getattr(exc_type, '__name__', '%s' % exc_type)
+        if tb is None:
+            return name
+        while tb.tb_next is not None:
+            tb = tb.tb_next
+        code = tb.tb_frame.f_code
+        return '%s at %s:%s' % (name, code.co_filename, tb.tb_lineno)
+
+    def check(self, fingerprint, rid='-'):
+        """Registers an exception occurrence in the request `rid`.
+
+        Returns whether traceback should be logged. Suppressed
+        occurrences are reported by `summaries`.
+        """
+        now = self.clock()
+        with self._lock:
+            bucket = self._buckets.get(fingerprint)
+            if bucket is None:
+                if len(self._buckets) >= self.max_fingerprints:
+                    del self._buckets[next(iter(self._buckets))]
+                bucket = self._buckets[fingerprint] = \
+                    [self.tracebacks, now, 0, None, None]
+            else:
+                refill = (now - bucket[1]) * self.tracebacks / self.window
+                bucket[0] = min(bucket[0] + refill, self.tracebacks)
+                bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return True
+            if not bucket[2]:
+                bucket[4] = now + self.window
+                self._next_summary = min(self._next_summary, bucket[4])
+            bucket[2] += 1
+            bucket[3] = rid
+            return False
+
+    def summaries(self):
+        """Returns suppressed exceptions whose summary is due.
+
+        Returns a list of (fingerprint, count, last request ID) tuples
+        and resets their counts. This is cheap if no summary is due.
+        """
+        now = self.clock()
+        if now < self._next_summary:
+            return []
+        rv = []
+        next_summary = float('inf')
+        with self._lock:
+            for fingerprint, bucket in self._buckets.items():
+                if not bucket[2]:
+                    continue
+                if bucket[4] <= now:
+                    rv.append((fingerprint, bucket[2], bucket[3]))
+                    bucket[2], bucket[3] = 0, None
+                else:
+                    next_summary = min(next_summary, bucket[4])
+            self._next_summary = next_summary
+        return rv
+
+
+class ConcurrencyGauge(object):
+    """Counts requests in progress in this process.
+
+    Tracks number of requests in flight, its high-water mark and number
+    of started requests. If `interval` (in seconds) is given, a snapshot
+    of these values and of number of active threads is reported
+    at the end of the first request after each interval: passed
+    to `callback` if it is given, logged to `logger` otherwise.
+    High-water mark is reset after each report.
+    """
+
+    report_format = ('Concurrency %(inflight)s, max %(max_inflight)s, '
+                     '%(requests)s requests, %(threads)s threads')
+
+    def __init__(self, interval=None, callback=None, logger='kudzu.gauges',
+                 clock=time.time):
+        self.interval = interval
+        self.callback = callback
+        if isinstance(logger, logging.Logger):
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger(logger)
+        self.clock = clock
+        self.inflight = 0
+        self.max_inflight = 0
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._next_report = None if interval is None else clock() + interval
+
+    def enter(self):
+        """Registers started request, returns number of requests in flight.
+        """
+        with self._lock:
+            self.inflight += 1
+            self.requests += 1
+            if self.inflight > self.max_inflight:
+                self.max_inflight = self.inflight
+            return self.inflight
+
+    def exit(self):
+        """Registers finished request, reports snapshot if it is time."""
+        snapshot = None
+        with self._lock:
+            self.inflight -= 1
+            if self._next_report is not None:
+                now = self.clock()
+                if now >= self._next_report:
+                    self._next_report = now + self.interval
+                    snapshot = self._snapshot(reset=True)
+        if snapshot is not None:
+            self.report(snapshot)
+
+    def snapshot(self, reset=False):
+        """Returns dictionary with current values.
+
+        If `reset` is truthy, high-water mark is reset to the current number
+        of requests in flight.
+        """
+        with self._lock:
+            return self._snapshot(reset)
+
+    def _snapshot(self, reset):
+        rv = {
+            'inflight': self.inflight,
+            'max_inflight': self.max_inflight,
+            'requests': self.requests,
+            'threads': threading.active_count(),
+        }
+        if reset:
+            self.max_inflight = self.inflight
+        return rv
+
+    def report(self, snapshot):
+        """Reports snapshot. Can be overridden in subclasses."""
+        if self.callback is not None:
+            self.callback(snapshot)
+        else:
+            self.logger.info(self.report_format, snapshot)
+
+
+class LoadController(object):
+    """Sheds access logs of `LoggingMiddleware` when the process is overloaded.
+
+    Load is evaluated every `interval` seconds from request rate (requests
+    per second), maximal number of requests in flight (requires
+    `RequestContextMiddleware`) and maximal size of `queues` (e.g. queues
+    of `QueueHandler` instances, anything with `qsize` method).
+    The process is overloaded when any value exceeds its limit (`max_rate`,
+    `max_inflight` or `max_queue`) and it recovers when all values
+    drop to `recover_ratio` of their limits.
+
+    While overloaded, request and response messages with level lower
+    than `min_level` are logged only for a `sample_rate` fraction
+    of requests. Exceptions are always logged. One notice is logged
+    to `logger` when the process degrades and when it recovers.
+    """
+
+    degrade_format = ('Access logs degraded: %(rate)s requests/s, '
+                      '%(inflight)s in flight, queue %(queue)s')
+    recover_format = ('Access logs recovered: %(rate)s requests/s, '
+                      '%(inflight)s in flight, queue %(queue)s')
+
+    def __init__(self, max_rate=None, max_inflight=None, max_queue=None,
+                 queues=(), recover_ratio=0.8, interval=1.0,
+                 min_level=logging.WARNING, sample_rate=0.0,
+                 logger='kudzu.load', clock=time.time):
+        self.limits = {'rate': max_rate, 'inflight': max_inflight,
+                       'queue': max_queue}
+        self.queues = tuple(queues)
+        self.recover_ratio = recover_ratio
+        self.interval = interval
+        self.min_level = min_level
+        self.sample_rate = sample_rate
+        if isinstance(logger, logging.Logger):
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger(logger)
+        self.clock = clock
+        self.degraded = False
+        self._lock = threading.Lock()
+        self._last_check = clock()
+        self._requests = 0
+        self._max_inflight = 0
+
+    def observe(self, context):
+        """Registers a request, evaluates load if the interval elapsed."""
+        inflight = context.get_log_var('inflight')
+        now = self.clock()
+        with self._lock:
+            self._requests += 1
+            if inflight != '-' and int(inflight) > self._max_inflight:
+                self._max_inflight = int(inflight)
+            elapsed = now - self._last_check
+            # Rate is not known until the clock advances
+            if elapsed < self.interval or elapsed <= 0:
+                return
+            values = {
+                'rate': int(self._requests / elapsed),
+                'inflight': self._max_inflight,
+                'queue': max([q.qsize() for q in self.queues] or [0]),
+            }
+            self._last_check = now
+            self._requests = 0
+            self._max_inflight = 0
+            changed = self._update(values)
+        if changed:
+            if self.degraded:
+                self.logger.warning(self.degrade_format, values)
+            else:
+                self.logger.info(self.recover_format, values)
+
+    def _update(self, values):
+        """Updates state from load values, returns whether it changed."""
+        limits = [(values[key], limit) for key, limit in self.limits.items()
+                  if limit is not None]
+        if not self.degraded:
+            self.degraded = any(value > limit for value, limit in limits)
+            return self.degraded
+        if all(value <= limit * self.recover_ratio
+               for value, limit in limits):
+            self.degraded = False
+            return True
+        return False
+
+    def sheds(self, context, level):
+        """Returns whether access log message should be dropped."""
+        if not self.degraded or level >= self.min_level:
+            return False
+        if not self.sample_rate:
+            return True
+        # Requests are sampled by ID, so both messages are kept or dropped
+        rid = context.get_log_var('rid')
+        if rid == '-':
+            # All requests without ID would have the same hash
+            return not _sample(self.sample_rate)
+        rid = rid.encode('utf-8')
+        return (zlib.crc32(rid) & 0xffff) >= self.sample_rate * 0x10000
+
+
 class LoggingMiddleware(object):
     """WSGI middleware which logs all requests and responses
 
     Before and after each request this middleware emits messages to
     Python standard logging.
 
+    Requests can be excluded or logged with a different level
+    or format using `LoggingRule` instances passed as `rules`.
+    Rules are evaluated once per request, before messages are formatted.
+    Exceptions are always logged, rules do not apply to them.
+
+    If `exception_limiter` is given, repeated exceptions are logged with
+    a traceback only a limited number of times. Other occurrences are
+    logged on one line using `suppressed_format` and their count
+    is periodically summarized using `summary_format`.
+
+    If `load_controller` is given, access logs are shed when the process
+    is overloaded, see `LoadController`.
+
+    Level, formats and rules can be changed while the application runs
+    using `configure` or `configure_logging`.
+
+    Exceptions raised while response body is iterated or closed are
+    logged too, as well as responses which were closed before the whole
+    body was sent (e.g. when a client disconnects). If the application
+    has not called `start_response` yet when it returns (generators),
+    response is logged when the body is iterated.
+
     Requires `RequestContextMiddleware` to be executed before this
     middleware: `app = RequestContextMiddleware(LoggingMiddleware(app))`
     """
@@ -30,13 +520,61 @@ class LoggingMiddleware(object):
     response_format = ('Response status %(status)s in %(msecs)s ms, '
                        'size %(rsize)s bytes')
     exception_format = 'Exception in %(msecs)s ms'
+    iteration_exception_format = ('Exception after %(bsent)s bytes '
+                                  'in %(msecs)s ms, status %(status)s')
+    abort_format = ('Response aborted after %(bsent)s bytes in %(msecs)s ms, '
+                    'status %(status)s')
+    suppressed_format = ('Exception in %(msecs)s ms, request %(rid)s, '
+                         'traceback of %(fingerprint)s suppressed')
+    summary_format = ('Suppressed %(suppressed)s tracebacks of '
+                      '%(fingerprint)s, last in request %(rid)s')
+    level = logging.INFO
+
+    #: All existing instances by their `id`, which are configured
+    #: by `configure_logging` (`WeakSet` is not available on Python 2.6)
+    instances = weakref.WeakValueDictionary()
 
-    def __init__(self, app, logger='wsgi'):
+    _options = frozenset([
+        'level', 'rules', 'exception_limiter', 'load_controller',
+        'request_format', 'response_format', 'exception_format',
+        'iteration_exception_format', 'abort_format', 'suppressed_format',
+        'summary_format',
+    ])
+
+    def __init__(self, app, logger='wsgi', rules=(), exception_limiter=None,
+                 load_controller=None):
         self.app = app
         if isinstance(logger, logging.Logger):
             self.logger = logger
         else:
             self.logger = logging.getLogger(logger)
+        self.rules = LoggingRules(rules) if rules else None
+        self.exception_limiter = exception_limiter
+        self.load_controller = load_controller
+        self.instances[id(self)] = self
+
+    def configure(self, **options):
+        """Changes options of this middleware while it is running.
+
+        Takes `level` (a number or a name), `rules`, `exception_limiter`,
+        `load_controller` and any of the `*_format` attributes. Each option
+        is replaced atomically, requests in progress may use old or new
+        values.
+        """
+        unknown = set(options) - self._options
+        if unknown:
+            raise TypeError('Unknown options: %s' % ', '.join(sorted(unknown)))
+        if 'level' in options:
+            level = options['level']
+            if not isinstance(level, int):
+                level = logging.getLevelName(level.upper())
+                if not isinstance(level, int):
+                    raise ValueError('Unknown level %r' % options['level'])
+            options['level'] = level
+        if 'rules' in options:
+            rules = options['rules']
+            options['rules'] = LoggingRules(rules) if rules else None
+        self.__dict__.update(options)
 
     def __call__(self, environ, start_response):
         try:
@@ -45,30 +583,185 @@ class LoggingMiddleware(object):
             msg = ('RequestContext is not present in environ dictionary. '
                    'LoggingMiddleware requires RequestContextMiddleware.')
             raise RuntimeError(msg)
-        self.log_request(context)
+        if self.load_controller is not None:
+            self.load_controller.observe(context)
+        if self.exception_limiter is not None:
+            self.log_summaries(context)
+        if self.rules is None:
+            rules = ()
+            self.log_request(context)
+        else:
+            rules = self._match_rules(environ)
+            rule = self._find_rule(rules)
+            if rule is None:
+                self.log_request(context)
+            elif not rule.exclude:
+                self.log_request(context, rule)
+        _record_file_wrappers(environ)
         try:
             rv = self.app(environ, start_response)
         except:
             self.log_exception(context)
             raise
-        else:
+        response_logged = context.get_log_var('status') != '-'
+        if response_logged:
+            self._log_response(context, rules)
+        if _is_file_wrapper(environ, rv):
+            return rv
+        head = environ['REQUEST_METHOD'] == 'HEAD'
+        if hasattr(rv, '__len__'):
+            return self._SizedLoggingIterable(rv, self, context, rules,
+                                              response_logged, head)
+        return self._LoggingIterable(rv, self, context, rules,
+                                     response_logged, head)
+
+    def _log_response(self, context, rules):
+        """Logs response using the first rule which applies to it."""
+        if not rules:
             self.log_response(context)
-        return rv
+            return
+        rule = self._find_rule(rules, context.get_log_var('status'))
+        if rule is None:
+            self.log_response(context)
+        elif not rule.exclude:
+            self.log_response(context, rule)
+
+    class _LoggingIterable(object):
+        """Response body which logs errors and aborts during iteration"""
 
-    def log_request(self, context):
+        def __init__(self, iterable, middleware, context, rules,
+                     response_logged, head):
+            self.iterable = iterable
+            self.middleware = middleware
+            self.context = context
+            self.rules = rules
+            self.response_logged = response_logged
+            # Servers do not have to send body of HEAD responses
+            self.finished = head
+            self.failed = False
+            self.iterator = None
+
+        def __iter__(self):
+            return self
+
+        def __next__(self):
+            try:
+                if self.iterator is None:
+                    self.iterator = iter(self.iterable)
+                return next(self.iterator)
+            except StopIteration:
+                self.finished = True
+                raise
+            except:
+                self.failed = True
+                self.middleware.log_iteration_exception(self.context)
+                raise
+
+        next = __next__
+
+        def close(self):
+            try:
+                close = getattr(self.iterable, 'close', None)
+                if close is not None:
+                    close()
+            except:
+                if not self.failed:
+                    self.failed = True
+                    self.middleware.log_iteration_exception(self.context)
+                raise
+            finally:
+                if not self.failed:
+                    if not self.response_logged:
+                        self.middleware._log_response(self.context,
+                                                      self.rules)
+                    if not self.finished:
+                        self.middleware.log_abort(self.context)
+
+    class _SizedLoggingIterable(_SizedResponse, _LoggingIterable):
+        pass
+
+    def _match_rules(self, environ):
+        path = environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', '')
+        return self.rules.match(environ['REQUEST_METHOD'], path)
+
+    @staticmethod
+    def _find_rule(rules, status=None):
+        """Returns first rule which applies to the request or response."""
+        for rule in rules:
+            if status is None:
+                if rule.statuses is None:
+                    return rule
+            elif rule.match_status(status):
+                return rule
+        return None
+
+    def log_request(self, context, rule=None):
         """Logs request. Can be overridden in subclasses."""
-        request_message = self.request_format % context.log_vars
-        self.logger.info(request_message)
+        level, request_format = self.level, self.request_format
+        if rule is not None:
+            level = level if rule.level is None else rule.level
+            request_format = rule.request_format or request_format
+        if self.load_controller is not None and \
+                self.load_controller.sheds(context, level):
+            return
+        if self.logger.isEnabledFor(level):
+            request_message = request_format % context.log_vars
+            self.logger.log(level, request_message)
 
-    def log_response(self, context):
+    def log_response(self, context, rule=None):
         """Logs response. Can be overridden in subclasses."""
-        response_message = self.response_format % context.log_vars
-        self.logger.info(response_message)
+        level, response_format = self.level, self.response_format
+        if rule is not None:
+            level = level if rule.level is None else rule.level
+            response_format = rule.response_format or response_format
+        if self.load_controller is not None and \
+                self.load_controller.sheds(context, level):
+            return
+        if self.logger.isEnabledFor(level):
+            response_message = response_format % context.log_vars
+            self.logger.log(level, response_message)
+
+    def log_iteration_exception(self, context):
+        """Logs exception raised by response body. Can be overridden."""
+        if self._limit_exception(context):
+            message = self.iteration_exception_format % context.log_vars
+            self.logger.exception(message)
+
+    def log_abort(self, context):
+        """Logs response closed before its body was sent. Can be overridden."""
+        message = self.abort_format % context.log_vars
+        self.logger.warning(message)
 
     def log_exception(self, context):
         """Logs exception. Can be overridden in subclasses."""
-        exception_message = self.exception_format % context.log_vars
-        self.logger.exception(exception_message)
+        if self._limit_exception(context):
+            exception_message = self.exception_format % context.log_vars
+            self.logger.exception(exception_message)
+
+    def log_summaries(self, context):
+        """Logs due summaries of suppressed tracebacks. Can be overridden."""
+        for fingerprint, suppressed, rid in \
+                self.exception_limiter.summaries():
+            log_vars = context.log_vars
+            log_vars.update(fingerprint=fingerprint, suppressed=suppressed,
+                            rid=rid)
+            self.logger.error(self.summary_format % log_vars)
+
+    def _limit_exception(self, context):
+        """Tests whether traceback of the current exception can be logged.
+
+        Logs one line without traceback if the exception is suppressed.
+        """
+        if self.exception_limiter is None:
+            return True
+        fingerprint = self.exception_limiter.fingerprint(sys.exc_info())
+        rid = context.get_log_var('rid')
+        if self.exception_limiter.check(fingerprint, rid):
+            return True
+        log_vars = context.log_vars
+        log_vars['fingerprint'] = fingerprint
+        self.logger.error(self.suppressed_format % log_vars)
+        return False
 
 
 class RequestContextMiddleware(object):
@@ -76,42 +769,200 @@ class RequestContextMiddleware(object):
 
     This middleware creates a `RequestContext` instance, adds it
     to `environ` and makes it globally in the current thread.
+    The context is also made available while the response body is iterated
+    and closed, and sizes of body chunks are added to the context.
+    The context is closed after the response is closed.
+
+    Values of `response_headers` and of headers given in the constructor
+    are extracted from each response and set to the context.
+
+    If `trusted_proxies` are given (addresses or networks in CIDR notation
+    or a `TrustedProxies` instance), client address is resolved
+    from X-Forwarded-For or Forwarded headers added by these proxies.
+
+    If `track_memory` is truthy, change of resident set size of the process
+    during each request is set to `mem_kb` log variable. Requests sampled
+    with probability `alloc_rate` are also executed with `tracemalloc`
+    tracing and memory allocated (and not freed) by them is set
+    to `alloc_kb`. Both values include memory used by concurrent requests
+    of the same process, so they are useful mainly in aggregates.
+
+    Requests in progress are counted by a `ConcurrencyGauge`, which can be
+    given to report periodic snapshots. Number of requests in flight
+    when a request starts is set to `inflight` log variable. Time spent
+    in a queue is set to `qtime` if a front server adds X-Request-Start
+    or X-Queue-Start header.
+
+    If `route_normalizer` (a `kudzu.routes.RouteNormalizer` instance)
+    is given, path of each request is normalized to `route` log variable.
     """
 
-    def __init__(self, app):
+    response_headers = ('Content-Length', 'Content-Type', 'X-Request-ID')
+
+    def __init__(self, app, response_headers=(), trusted_proxies=None,
+                 track_memory=False, alloc_rate=0.0, gauge=None,
+                 route_normalizer=None):
         self.app = app
+        RequestContext.select_storage()
+        self.route_normalizer = route_normalizer
+        self.gauge = ConcurrencyGauge() if gauge is None else gauge
+        self.header_scanner = HeaderScanner(self.response_headers +
+                                            tuple(response_headers))
+        if trusted_proxies is not None:
+            from kudzu.proxy import TrustedProxies
+            if not isinstance(trusted_proxies, TrustedProxies):
+                trusted_proxies = TrustedProxies(trusted_proxies)
+        self.trusted_proxies = trusted_proxies
+        self.track_memory = track_memory
+        if alloc_rate and import_tracemalloc() is None:
+            raise RuntimeError('Module tracemalloc is not available.')
+        self.alloc_rate = alloc_rate
 
     def __call__(self, environ, start_response):
         if 'kudzu.context' in environ:
             msg = ('RequestContext is already present in environ dictionary. '
                    'RequestContextMiddleware must be used only once.')
             raise RuntimeError(msg)
-        context = environ['kudzu.context'] = RequestContext(environ)
+        context = environ['kudzu.context'] = RequestContext(
+            environ, self.trusted_proxies)
+        if self.route_normalizer is not None:
+            path = (environ.get('SCRIPT_NAME', '') +
+                    environ.get('PATH_INFO', ''))
+            context.set_route(self.route_normalizer.normalize(path))
+        if self.track_memory or self.alloc_rate:
+            self._start_memory_tracking(context)
+        gauge = self.gauge
+        context.set_in_flight(gauge.enter())
         mw_start_response = self._make_start_response(start_response, context)
-        with context:
-            rv = self.app(environ, mw_start_response)
-        return rv
+        _record_file_wrappers(environ)
+        try:
+            with context:
+                rv = self.app(environ, mw_start_response)
+        except:
+            self._finish(context)
+            raise
+        if _is_file_wrapper(environ, rv):
+            self._finish(context)
+            return rv
+        if hasattr(rv, '__len__'):
+            return self._SizedContextIterable(rv, context, self)
+        return self._ContextIterable(rv, context, self)
+
+    def _finish(self, context):
+        """Closes the context and unregisters the request."""
+        try:
+            context.close()
+        finally:
+            self.gauge.exit()
+
+    def _start_memory_tracking(self, context):
+        """Starts memory tracking which is stopped when context is closed."""
+        traced = self.alloc_rate > 0 and _sample(self.alloc_rate)
+        if traced:
+            _allocation_tracer.acquire()
+        # Tracing may stop during other requests, which would corrupt
+        # their allocations, so only sampled requests measure them
+        context.start_memory_tracking(allocations=traced)
+
+        def stop(context):
+            context.stop_memory_tracking()
+            if traced:
+                _allocation_tracer.release()
+        context.add_close_callback(stop)
+
+    class _ContextIterable(object):
+        """Response body which is iterated and closed with request context"""
+
+        def __init__(self, iterable, context, middleware):
+            self.iterable = iterable
+            self.context = context
+            self.middleware = middleware
+            self.iterator = None
+            self.closed = False
+
+        def __iter__(self):
+            return self
+
+        def __next__(self):
+            context = self.context
+            context.push()
+            try:
+                if self.iterator is None:
+                    self.iterator = iter(self.iterable)
+                chunk = next(self.iterator)
+            finally:
+                context.pop()
+            context.add_sent_bytes(len(chunk))
+            return chunk
+
+        next = __next__
+
+        def close(self):
+            if self.closed:
+                return
+            self.closed = True
+            try:
+                close = getattr(self.iterable, 'close', None)
+                if close is not None:
+                    with self.context:
+                        close()
+            finally:
+                self.middleware._finish(self.context)
+
+    class _SizedContextIterable(_SizedResponse, _ContextIterable):
+        pass
 
     def _make_start_response(self, start_response, context):
         """Decorates `start_response` function."""
-        return self._StartResponseWrapper(start_response, context)
+        return self._StartResponseWrapper(start_response, context,
+                                          self.header_scanner)
 
     class _StartResponseWrapper(object):
         """Decorator which extracts information from response headers"""
 
-        def __init__(self, start_response, context):
+        def __init__(self, start_response, context, header_scanner):
             self.start_response = start_response
             self.context = context
+            self.header_scanner = header_scanner
 
         def __call__(self, status, response_headers, exc_info=None):
             self.context.set_status(status)
-            for key, value in response_headers:
-                if key.upper() == 'CONTENT-LENGTH':
-                    self.context.set_response_size(value)
-                    break
+            headers = self.header_scanner.scan(response_headers)
+            self.context.set_response_headers(headers)
             return self.start_response(status, response_headers, exc_info)
 
 
+class _AllocationTracer(object):
+    """Traces memory allocations while any sampled request is in progress.
+
+    Tracing started by someone else is never stopped.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._count = 0
+        self._started = False
+
+    def acquire(self):
+        tracemalloc = import_tracemalloc()
+        with self._lock:
+            if self._count == 0 and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started = True
+            self._count += 1
+
+    def release(self):
+        tracemalloc = import_tracemalloc()
+        with self._lock:
+            self._count -= 1
+            if self._count == 0 and self._started:
+                tracemalloc.stop()
+                self._started = False
+
+
+_allocation_tracer = _AllocationTracer()
+
+
 class RequestIDMiddleware(object):
     """WSGI middleware which adds X-Request-ID to request/response headers
 
@@ -121,10 +972,13 @@ class RequestIDMiddleware(object):
     to `environ` otherwise.
 
     If `send_request_id` is truthy (which is default) it adds X-Request-ID
-    header to all responses.
+    header to all responses. Response headers extracted
+    by `RequestContextMiddleware` are reused if it is applied inside
+    this middleware, headers are scanned otherwise.
     """
 
     request_id_re = uuid_re
+    header_scanner = HeaderScanner(['X-Request-ID'])
 
     def __init__(self, app, accept_request_id=True, send_request_id=True):
         self.app = app
@@ -134,12 +988,16 @@ class RequestIDMiddleware(object):
     def __call__(self, environ, start_response):
         request_id = self._process_environ(environ)
         mw_start_response = self._make_start_response(start_response,
-                                                      request_id)
+                                                      request_id, environ)
         return self.app(environ, mw_start_response)
 
     def generate_request_id(self):
         """Generates random request ID"""
-        return str(uuid.uuid4())
+        global _uuid4
+        if _uuid4 is None:
+            import uuid
+            _uuid4 = uuid.uuid4
+        return str(_uuid4())
 
     def validate_request_id(self, value):
         """Validates incoming request ID"""
@@ -156,34 +1014,276 @@ class RequestIDMiddleware(object):
         environ['HTTP_X_REQUEST_ID'] = request_id
         return request_id
 
-    def _make_start_response(self, start_response, request_id):
+    def _make_start_response(self, start_response, request_id, environ):
         """Decorates `start_response` function to send request ID."""
         if self.send_request_id:
-            return self._StartResponseWrapper(start_response, request_id)
+            return self._StartResponseWrapper(start_response, request_id,
+                                              environ, self.header_scanner)
         return start_response
 
     class _StartResponseWrapper(object):
         """Decorator which adds header with request ID"""
 
-        def __init__(self, start_response, request_id):
+        def __init__(self, start_response, request_id, environ,
+                     header_scanner):
             self.start_response = start_response
             self.request_id = request_id
+            self.environ = environ
+            self.header_scanner = header_scanner
 
         def __call__(self, status, response_headers, exc_info=None):
-            for key, value in response_headers:
-                if key.upper() == 'X-REQUEST-ID' and value == self.request_id:
-                    break
-            else:
+            context = self.environ.get('kudzu.context')
+            headers = getattr(context, 'response_headers', None)
+            if headers is None or \
+                    not headers.is_scan_of(response_headers, 'x-request-id'):
+                headers = self.header_scanner.scan(response_headers)
+            if self.request_id not in headers.get('x-request-id', ()):
                 header = ('X-Request-ID', self.request_id)
                 response_headers.append(header)
             return self.start_response(status, response_headers, exc_info)
 
 
+def _enable_profiler(profiler):
+    """Enables profiler, returns False if another profiler is active."""
+    try:
+        profiler.enable()
+    except ValueError:
+        return False
+    return True
+
+
+class ProfilingMiddleware(object):
+    """WSGI middleware which profiles a sample of requests.
+
+    Requests are selected randomly with probability `rate`, or if they
+    contain `trigger_header` (disabled by default, it should be enabled
+    only if clients cannot set it). Selected requests are executed
+    under `cProfile` including iteration of the response body.
+
+    Profiles are written to `directory` in the `pstats` format, named
+    by request ID, so they can be found from access logs. Oldest profiles
+    are removed when total size of the directory exceeds `max_size` bytes.
+
+    Request ID is taken from `RequestContext`, so this middleware should
+    be applied inside `RequestContextMiddleware`. A request is not profiled
+    if another profiler is active (only one is allowed since Python 3.12).
+
+    Profiling never changes the response, errors of writing profiles
+    are logged to `logger`.
+    """
+
+    suffix = '.prof'
+
+    def __init__(self, app, directory, rate=0.001, trigger_header=None,
+                 max_size=100 * 1024 * 1024, logger='kudzu.profiling'):
+        self.app = app
+        if isinstance(logger, logging.Logger):
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger(logger)
+        self.directory = directory
+        self.rate = rate
+        if trigger_header is not None:
+            trigger_header = 'HTTP_' + trigger_header.upper().replace('-', '_')
+        self.trigger_header = trigger_header
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def __call__(self, environ, start_response):
+        if not self.is_selected(environ):
+            return self.app(environ, start_response)
+        try:
+            import cProfile as profile
+        except ImportError:  # pragma: nocover
+            import profile
+        profiler = profile.Profile()
+        if not _enable_profiler(profiler):
+            return self.app(environ, start_response)
+        _record_file_wrappers(environ)
+        try:
+            rv = self.app(environ, start_response)
+        except:
+            profiler.disable()
+            self._save_profile(profiler, environ)
+            raise
+        profiler.disable()
+        if _is_file_wrapper(environ, rv):
+            self._save_profile(profiler, environ)
+            return rv
+        if hasattr(rv, '__len__'):
+            return self._SizedProfilingIterable(rv, self, profiler, environ)
+        return self._ProfilingIterable(rv, self, profiler, environ)
+
+    def is_selected(self, environ):
+        """Returns whether the request should be profiled."""
+        if self.trigger_header is not None and \
+                environ.get(self.trigger_header):
+            return True
+        return self.rate > 0 and _sample(self.rate)
+
+    class _ProfilingIterable(object):
+        """Response body which is iterated and closed under a profiler"""
+
+        def __init__(self, iterable, middleware, profiler, environ):
+            self.iterable = iterable
+            self.middleware = middleware
+            self.profiler = profiler
+            self.environ = environ
+            self.iterator = None
+
+        def __iter__(self):
+            return self
+
+        def __next__(self):
+            enabled = _enable_profiler(self.profiler)
+            try:
+                if self.iterator is None:
+                    self.iterator = iter(self.iterable)
+                return next(self.iterator)
+            finally:
+                if enabled:
+                    self.profiler.disable()
+
+        next = __next__
+
+        def close(self):
+            try:
+                close = getattr(self.iterable, 'close', None)
+                if close is not None:
+                    enabled = _enable_profiler(self.profiler)
+                    try:
+                        close()
+                    finally:
+                        if enabled:
+                            self.profiler.disable()
+            finally:
+                self.middleware._save_profile(self.profiler, self.environ)
+
+    class _SizedProfilingIterable(_SizedResponse, _ProfilingIterable):
+        pass
+
+    def _save_profile(self, profiler, environ):
+        """Saves profile, logs errors instead of raising them."""
+        try:
+            self.save_profile(profiler, environ)
+        except Exception:
+            self.logger.exception('Cannot save profile to %s',
+                                  self.directory)
+
+    def save_profile(self, profiler, environ):
+        """Writes profile to the directory and returns its path."""
+        context = environ.get('kudzu.context')
+        request_id = context.request_id if context is not None else None
+        if request_id is None:
+            request_id = environ.get('HTTP_X_REQUEST_ID') or 'unknown'
+        name = '%s-%s%s' % (re.sub(r'[^\w.-]', '_', request_id)[:64],
+                            int(time.time() * 1000), self.suffix)
+        path = os.path.join(self.directory, name)
+        profiler.dump_stats(path)
+        with self._lock:
+            self._rotate()
+        return path
+
+    def _rotate(self):
+        """Removes oldest profiles until their size fits `max_size`."""
+        profiles = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.suffix):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            profiles.append((stat.st_mtime, name, stat.st_size))
+            total += stat.st_size
+        profiles.sort()
+        for mtime, name, size in profiles[:-1]:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            total -= size
+
+
+def configure_logging(**options):
+    """Changes options of all existing `LoggingMiddleware` instances.
+
+    See `LoggingMiddleware.configure` for supported options.
+    """
+    for middleware in list(LoggingMiddleware.instances.values()):
+        middleware.configure(**options)
+
+
+_enabled = True
+
+
+def enable():
+    """Enables middlewares applied by `kudzify_app` in this process."""
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    """Disables middlewares applied by `kudzify_app` in this process.
+
+    Requests are passed directly to the original application,
+    no context is created and nothing is logged.
+    """
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    """Returns whether middlewares applied by `kudzify_app` are enabled."""
+    return _enabled
+
+
+def install_signal_toggle(signum=getattr(signal, 'SIGUSR2', None)):
+    """Installs signal handler which toggles `enable` and `disable`.
+
+    Must be called from the main thread. Returns the previous handler.
+    """
+    def toggle(signum, frame):
+        if _enabled:
+            disable()
+        else:
+            enable()
+    return signal.signal(signum, toggle)
+
+
+class _SwitchMiddleware(object):
+    """Calls kudzified application only if Kudzu is enabled."""
+
+    def __init__(self, app, kudzified_app):
+        self.app = app
+        self.kudzified_app = kudzified_app
+
+    def __call__(self, environ, start_response):
+        if _enabled:
+            return self.kudzified_app(environ, start_response)
+        return self.app(environ, start_response)
+
+
 def kudzify_app(app, logger='wsgi', accept_request_id=True,
-                send_request_id=True):
-    """Helper, which applies all Kudzu middlewares to the given application"""
-    app = LoggingMiddleware(app, logger=logger)
-    app = RequestContextMiddleware(app)
-    app = RequestIDMiddleware(app, accept_request_id=accept_request_id,
-                              send_request_id=send_request_id)
-    return app
+                send_request_id=True, rules=(), exception_limiter=None,
+                trusted_proxies=None, gauge=None, load_controller=None,
+                route_normalizer=None):
+    """Helper, which applies all Kudzu middlewares to the given application
+
+    Middlewares can be switched off at runtime using `disable`.
+    """
+    kudzified_app = LoggingMiddleware(app, logger=logger, rules=rules,
+                                      exception_limiter=exception_limiter,
+                                      load_controller=load_controller)
+    kudzified_app = RequestContextMiddleware(
+        kudzified_app, trusted_proxies=trusted_proxies, gauge=gauge,
+        route_normalizer=route_normalizer)
+    kudzified_app = RequestIDMiddleware(kudzified_app,
+                                        accept_request_id=accept_request_id,
+                                        send_request_id=send_request_id)
+    return _SwitchMiddleware(app, kudzified_app)
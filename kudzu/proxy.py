@@ -0,0 +1,130 @@
+"""Resolution of client addresses behind trusted reverse proxies.
+
+Proxies add the address of their client to X-Forwarded-For or Forwarded
+request headers. Only hops added by trusted proxies can be believed,
+so the client address is the rightmost address which was not added
+by a trusted proxy.
+"""
+
+from __future__ import absolute_import
+
+import binascii
+import bisect
+import socket
+
+
+def _parse_ip(value):
+    """Returns IP version and integer value of an address or `None`."""
+    for family, version in ((socket.AF_INET, 4), (socket.AF_INET6, 6)):
+        try:
+            packed = socket.inet_pton(family, value)
+        except (socket.error, ValueError, UnicodeError):
+            continue
+        number = int(binascii.hexlify(packed), 16)
+        if version == 6 and number >> 32 == 0xffff:
+            # IPv4-mapped IPv6 address
+            return 4, number & 0xffffffff
+        return version, number
+    return None
+
+
+def _strip_port(value):
+    """Removes brackets and port from an address in a forwarding header."""
+    value = value.strip().strip('"')
+    if value.startswith('['):
+        return value[1:].split(']', 1)[0]
+    if value.count(':') == 1:
+        return value.split(':', 1)[0]
+    return value
+
+
+class TrustedProxies(object):
+    """Set of trusted proxy networks compiled to integer range tables.
+
+    Takes addresses or networks in CIDR notation, IPv4 and IPv6 can
+    be mixed. Networks are merged to sorted tables of ranges, so each
+    lookup is a binary search.
+    """
+
+    def __init__(self, networks):
+        ranges = {4: [], 6: []}
+        for network in networks:
+            address, __, prefix = network.partition('/')
+            parsed = _parse_ip(address.strip())
+            if parsed is None:
+                raise ValueError('Invalid network %r' % network)
+            version, number = parsed
+            bits = 32 if version == 4 else 128
+            if ':' in address and version == 4:
+                # Prefix of IPv4-mapped network is given for 128 bits
+                bits = 128
+            prefix = int(prefix) if prefix else bits
+            if not 0 <= prefix <= bits:
+                raise ValueError('Invalid network %r' % network)
+            if bits == 128 and version == 4:
+                prefix = max(prefix - 96, 0)
+                bits = 32
+            size = 1 << (bits - prefix)
+            start = number & ~(size - 1)
+            ranges[version].append((start, start + size - 1))
+        self._tables = dict((version, self._merge(items))
+                            for version, items in ranges.items())
+
+    @staticmethod
+    def _merge(ranges):
+        """Returns lists of starts and ends of merged ranges."""
+        starts = []
+        ends = []
+        for start, end in sorted(ranges):
+            if ends and start <= ends[-1] + 1:
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+        return starts, ends
+
+    def __contains__(self, address):
+        parsed = _parse_ip(address)
+        if parsed is None:
+            return False
+        version, number = parsed
+        starts, ends = self._tables[version]
+        index = bisect.bisect_right(starts, number) - 1
+        return index >= 0 and number <= ends[index]
+
+    def resolve(self, remote_addr, forwarded=None, forwarded_for=None):
+        """Returns client address from the remote address and headers.
+
+        Uses `for` parameters of the standard Forwarded header if it is
+        given, X-Forwarded-For header otherwise.
+        """
+        if remote_addr not in self:
+            return remote_addr
+        if forwarded:
+            hops = parse_forwarded(forwarded)
+        elif forwarded_for:
+            hops = [_strip_port(hop) for hop in forwarded_for.split(',')]
+        else:
+            return remote_addr
+        addr = remote_addr
+        for hop in reversed(hops):
+            if not hop:
+                break
+            addr = hop
+            if hop not in self:
+                break
+        return addr
+
+
+def parse_forwarded(value):
+    """Returns list of `for` addresses from Forwarded header (RFC 7239)."""
+    rv = []
+    for element in value.split(','):
+        for pair in element.split(';'):
+            name, __, param = pair.partition('=')
+            if name.strip().lower() == 'for':
+                rv.append(_strip_port(param))
+                break
+        else:
+            rv.append('')
+    return rv
@@ -0,0 +1,73 @@
+"""Normalization of request paths to routes with low cardinality.
+
+Path segments which look like identifiers (numbers, UUIDs, long hex
+strings) are replaced by placeholders, so requests of one endpoint
+share one route: `/users/42/orders` becomes `/users/{id}/orders`.
+"""
+
+from __future__ import absolute_import
+
+import collections
+import re
+
+try:
+    import threading
+except ImportError:  # pragma: nocover
+    import dummy_threading as threading
+
+
+#: Default patterns of path segments and their placeholders
+DEFAULT_PATTERNS = (
+    (r'[0-9]+', '{id}'),
+    (r'[0-9a-fA-F]{8}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?'
+     r'[0-9a-fA-F]{12}', '{uuid}'),
+    (r'[0-9a-fA-F]{16,}', '{hex}'),
+)
+
+
+class RouteNormalizer(object):
+    """Replaces path segments matching `patterns` by placeholders.
+
+    Takes a list of (regular expression, placeholder) pairs, the first
+    pattern which matches a whole segment is used. Normalized paths
+    are kept in a LRU cache with `cache_size` entries.
+    """
+
+    def __init__(self, patterns=DEFAULT_PATTERNS, cache_size=1024):
+        self.patterns = tuple(patterns)
+        self.placeholders = {}
+        groups = []
+        for index, (pattern, placeholder) in enumerate(self.patterns):
+            name = 'p%s' % index
+            groups.append('(?P<%s>%s)' % (name, pattern))
+            self.placeholders[name] = placeholder
+        self._segment_re = re.compile('(?:%s)$' % '|'.join(groups))
+        self.cache_size = cache_size
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def normalize(self, path):
+        """Returns route of the given path (without a query string)."""
+        cache = self._cache
+        with self._lock:
+            route = cache.pop(path, None)
+            if route is not None:
+                cache[path] = route
+                return route
+        route = self._normalize(path)
+        with self._lock:
+            cache[path] = route
+            if len(cache) > self.cache_size:
+                cache.popitem(last=False)
+        return route
+
+    def _normalize(self, path):
+        match = self._segment_re.match
+        placeholders = self.placeholders
+        segments = path.split('/')
+        for index, segment in enumerate(segments):
+            if segment:
+                segment_match = match(segment)
+                if segment_match is not None:
+                    segments[index] = placeholders[segment_match.lastgroup]
+        return '/'.join(segments)
@@ -0,0 +1,66 @@
+"""Serialization of request context for background jobs.
+
+A snapshot is a small dictionary of selected log variables
+of a `RequestContext`. It can be embedded into a job payload (as is
+or serialized to bytes) and restored as a context in a worker,
+so log records of the job contain ID of the request which created it.
+
+    payload = {'args': args, 'kudzu': take_snapshot()}
+    ...
+    with restore_snapshot(payload['kudzu']):
+        run_job(payload['args'])
+"""
+
+from __future__ import absolute_import
+
+import json
+
+from kudzu.context import RequestContext
+
+
+#: Variables included in a snapshot by default
+SNAPSHOT_VARS = ('rid', 'addr', 'uri', 'method', 'host')
+
+_encoder = json.JSONEncoder(separators=(',', ':'))
+_decoder = json.JSONDecoder()
+
+
+def take_snapshot(context=None, keys=SNAPSHOT_VARS):
+    """Returns dictionary with variables of the current or given context.
+
+    Unknown variables are omitted. Returns `None` if there is no context.
+    """
+    if context is None:
+        context = RequestContext.get()
+        if context is None:
+            return None
+    rv = {}
+    for key in keys:
+        value = context.get_log_var(key)
+        if value != '-':
+            rv[key] = value
+    return rv
+
+
+def restore_snapshot(snapshot):
+    """Returns `RequestContext` restored from a snapshot.
+
+    The returned context is not pushed, use it in the `with` statement.
+    Snapshot can be a dictionary, bytes returned by `dumps` or `None`.
+    """
+    if isinstance(snapshot, bytes):
+        snapshot = loads(snapshot)
+    return RequestContext.from_log_vars(snapshot or {})
+
+
+def dumps(snapshot):
+    """Serializes snapshot dictionary to compact JSON bytes."""
+    return _encoder.encode(snapshot).encode('utf-8')
+
+
+def loads(data):
+    """Deserializes snapshot from bytes returned by `dumps`."""
+    rv = _decoder.decode(data.decode('utf-8'))
+    if not isinstance(rv, dict):
+        raise ValueError('Invalid snapshot.')
+    return rv
@@ -0,0 +1,92 @@
+"""Helpers which propagate `RequestContext` to other threads.
+
+`RequestContext` is stored per thread, so work offloaded to other threads
+does not know which request it belongs to. These helpers capture
+a reference to the current context and push it in a worker thread.
+If there is no current context, work is executed unchanged.
+"""
+
+from __future__ import absolute_import
+
+import functools
+
+try:
+    import threading
+except ImportError:  # pragma: nocover
+    import dummy_threading as threading
+
+try:
+    from concurrent import futures
+except ImportError:  # pragma: nocover
+    futures = None
+
+from kudzu.context import RequestContext
+
+
+def bind_context(func, context=None):
+    """Binds callable to the current or the given `RequestContext`.
+
+    Returns a callable which pushes the context before `func` is called
+    and pops it afterwards, even if `func` raises. The context is
+    not copied, so variables set later (like response status) are seen.
+    Returns `func` unchanged if there is no context.
+
+    Can be also used as a decorator of functions defined inside
+    a request.
+    """
+    if context is None:
+        context = RequestContext.get()
+        if context is None:
+            return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        context.push()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            context.pop()
+    return wrapper
+
+
+class ContextThread(threading.Thread):
+    """Thread which runs with `RequestContext` of its creator.
+
+    The context which is current when the thread is created
+    is pushed in the new thread before `run` is called.
+    """
+
+    def __init__(self, *args, **kwargs):
+        threading.Thread.__init__(self, *args, **kwargs)
+        self.request_context = RequestContext.get()
+
+    def run(self):
+        context = self.request_context
+        if context is None:
+            return threading.Thread.run(self)
+        with context:
+            return threading.Thread.run(self)
+
+
+class ContextExecutor(futures.Executor if futures else object):
+    """Executor which runs submitted callables with `RequestContext`.
+
+    Wraps another executor (typically `ThreadPoolExecutor`). Callables
+    are bound by `bind_context` when they are submitted, so they
+    run with the context of the submitting thread.
+
+    The wrapped executor can be shared by many `ContextExecutor`
+    instances, for example one long-lived pool for the whole process.
+    """
+
+    def __init__(self, executor):
+        self.executor = executor
+
+    def submit(self, fn, *args, **kwargs):
+        return self.executor.submit(bind_context(fn), *args, **kwargs)
+
+    def map(self, fn, *iterables, **kwargs):
+        return self.executor.map(bind_context(fn), *iterables, **kwargs)
+
+    def shutdown(self, wait=True, **kwargs):
+        self.executor.shutdown(wait, **kwargs)
@@ -0,0 +1,177 @@
+
+from __future__ import absolute_import
+
+import io
+import json
+import logging
+
+import pytest
+from werkzeug.test import EnvironBuilder, run_wsgi_app
+
+from kudzu import kudzify_app, kudzify_handler
+from kudzu.analysis import build_index, compile_format, find_request, \
+    Histogram, iter_records, LogParser, LogStats, TopCounter
+from kudzu.cli import main
+from kudzu.logging import BASIC_FORMAT
+
+
+def make_app(status='200 OK'):
+    def app(environ, start_response):
+        if environ['PATH_INFO'] == '/error':
+            logging.getLogger('test_analysis').error('Boom')
+            raise ZeroDivisionError
+        start_response(status, [('Content-Length', '2')])
+        return [b'OK']
+    return app
+
+
+@pytest.fixture
+def log_path(tmpdir):
+    """Writes log file with three requests."""
+    path = str(tmpdir.join('app.log'))
+    handler = logging.FileHandler(path)
+    kudzify_handler(handler)
+    logger = logging.getLogger('test_analysis')
+    logger.addHandler(handler)
+    logger.level = logging.DEBUG
+    try:
+        app = kudzify_app(make_app(), logger=logger)
+        for i, path_info in enumerate(['/foo', '/bar', '/foo', '/error']):
+            rid = '00000000-0000-0000-0000-00000000000%s' % i
+            environ = EnvironBuilder(path=path_info,
+                                     headers={'X-Request-ID': rid},
+                                     environ_base={'REMOTE_ADDR': '1.2.3.4'}
+                                     ).get_environ()
+            try:
+                run_wsgi_app(app, environ)
+            except ZeroDivisionError:
+                pass
+    finally:
+        logger.removeHandler(handler)
+        handler.close()
+    return path
+
+
+class TestLogParser(object):
+    """Tests `LogParser` class."""
+
+    def test_compile_format(self):
+        regex = compile_format('%(levelname)-8s %(rid)s 100%% %(rid)s')
+        match = regex.match('INFO     xyz 100% xyz')
+        assert match.groupdict() == {'levelname': 'INFO    ', 'rid': 'xyz'}
+        assert regex.match('INFO     xyz 100% abc') is None
+
+    def test_response_message_is_parsed(self):
+        parser = LogParser(BASIC_FORMAT)
+        values = parser.parse('[1.2.3.4|xyz] INFO:wsgi:Response status 200 '
+                              'in 7 ms, size 13 bytes\n')
+        assert values['kind'] == 'response'
+        assert values['rid'] == 'xyz'
+        assert values['status'] == '200'
+        assert values['msecs'] == '7'
+        assert values['rsize'] == '13'
+
+    def test_suppressed_exception_is_parsed(self):
+        parser = LogParser(BASIC_FORMAT)
+        values = parser.parse('[1.2.3.4|xyz] ERROR:wsgi:Exception in 7 ms, '
+                              'request xyz, traceback of ZeroDivisionError '
+                              'at app.py:3 suppressed\n')
+        assert values['kind'] == 'exception'
+        assert values['msecs'] == '7'
+        assert values['fingerprint'] == 'ZeroDivisionError at app.py:3'
+
+    def test_other_line_is_not_parsed(self):
+        parser = LogParser(BASIC_FORMAT)
+        assert parser.parse('Traceback (most recent call last):\n') is None
+
+    def test_tracebacks_are_joined_to_records(self, log_path):
+        parser = LogParser(BASIC_FORMAT)
+        records = list(iter_records(parser, log_path))
+        assert len(records) == 9
+        assert 'Traceback' in records[-1][3]
+        assert 'ZeroDivisionError' in records[-1][3]
+
+
+class TestStats(object):
+    """Tests aggregation of log statistics."""
+
+    def test_histogram(self):
+        histogram = Histogram()
+        for value in range(1, 1001):
+            histogram.add(value)
+        assert histogram.percentile(50) == 500
+        assert 940 <= histogram.percentile(95) <= 950
+        assert len(histogram.buckets) < 400
+
+    def test_top_counter_is_bounded(self):
+        counter = TopCounter(capacity=2)
+        for key in ['a', 'a', 'a', 'b', 'c', 'c']:
+            counter.add(key, 1)
+        assert len(counter.counts) == 2
+        assert counter.most_common(1) == [('a', 3)]
+
+    def test_top_counter_evicts_least_common(self):
+        counter = TopCounter(capacity=3)
+        for key in ['a', 'b', 'b', 'c', 'c', 'c', 'a', 'a', 'a', 'd']:
+            counter.add(key, 1)
+        assert counter.counts == {'a': 4, 'c': 3, 'd': 3}
+        assert counter.histograms['d'].count == 1
+        assert len(counter._heap) == 3
+
+    def test_log_stats(self, log_path):
+        stats = LogStats()
+        for __, __, values, __ in iter_records(LogParser(BASIC_FORMAT),
+                                               log_path):
+            stats.add(values)
+        summary = stats.summary()
+        assert summary['responses'] == 3
+        assert summary['exceptions'] == 1
+        assert summary['statuses'] == {'200': 3}
+        assert summary['top_uris'][0]['uri'] == '/foo'
+        assert summary['top_uris'][0]['count'] == 2
+        assert summary['p50'] is not None
+
+    def test_stats_command(self, log_path):
+        out = io.StringIO()
+        assert main(['stats', '--json', log_path], out=out) == 0
+        summary = json.loads(out.getvalue())
+        assert summary['responses'] == 3
+
+
+class TestFindRequest(object):
+    """Tests lookup of records by request ID."""
+
+    rid = '00000000-0000-0000-0000-000000000003'
+
+    def test_find_request_wo_index(self, log_path):
+        parser = LogParser(BASIC_FORMAT)
+        texts = list(find_request(parser, log_path, self.rid))
+        assert len(texts) == 3
+        assert 'Boom' in texts[1]
+        assert 'ZeroDivisionError' in texts[2]
+
+    def test_find_request_w_index(self, log_path):
+        parser = LogParser(BASIC_FORMAT)
+        build_index(parser, log_path, buckets=32, partitions=4)
+        with open(log_path, 'a') as stream:
+            stream.write('[-|%s] INFO:late:Appended\n' % self.rid)
+        texts = list(find_request(parser, log_path, self.rid))
+        assert texts == list(find_request(parser, log_path, self.rid,
+                                          use_index=False))
+        assert len(texts) == 4
+        assert texts[-1].endswith('Appended\n')
+
+    def test_index_of_rotated_file_is_ignored(self, log_path):
+        parser = LogParser(BASIC_FORMAT)
+        build_index(parser, log_path)
+        with open(log_path, 'r+') as stream:
+            stream.write('[x')
+        texts = list(find_request(parser, log_path, self.rid))
+        assert len(texts) == 3
+
+    def test_grep_command(self, log_path):
+        assert main(['index', log_path], out=io.StringIO()) == 0
+        out = io.StringIO()
+        assert main(['grep', self.rid, log_path], out=out) == 0
+        assert 'Boom' in out.getvalue()
+        assert 'Traceback' in out.getvalue()
@@ -0,0 +1,130 @@
+
+from __future__ import absolute_import
+
+try:
+    import threading
+except ImportError:
+    import dummy_threading as threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+try:
+    from urllib.request import Request
+except ImportError:
+    from urllib2 import Request
+
+import pytest
+from werkzeug.test import EnvironBuilder
+
+from kudzu import RequestContext
+from kudzu.client import add_request_id, build_opener, HTTPConnection, \
+    RequestIDHandler
+
+
+class EchoHandler(BaseHTTPRequestHandler):
+    """Responds with value of X-Request-ID header."""
+
+    def do_GET(self):
+        body = (self.headers.get('X-Request-ID') or '-').encode('ascii')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope='module')
+def server():
+    server = HTTPServer(('127.0.0.1', 0), EchoHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield 'http://127.0.0.1:%s/' % server.server_port
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def context():
+    builder = EnvironBuilder(headers={'X-Request-ID': 'abc'})
+    context = RequestContext(builder.get_environ())
+    with context:
+        yield context
+    RequestContext.reset()
+
+
+class TestAddRequestID(object):
+    """Tests `add_request_id` function."""
+
+    def test_without_context(self):
+        headers = {'Accept': 'text/plain'}
+        assert add_request_id(headers) is headers
+        assert add_request_id(None) is None
+
+    def test_with_context(self, context):
+        headers = {'Accept': 'text/plain'}
+        assert add_request_id(headers) == {'Accept': 'text/plain',
+                                           'X-Request-ID': 'abc'}
+        assert headers == {'Accept': 'text/plain'}
+        assert add_request_id(None) == {'X-Request-ID': 'abc'}
+
+    def test_explicit_header(self, context):
+        headers = {'x-request-id': 'def'}
+        assert add_request_id(headers) is headers
+
+
+class TestRequestIDHandler(object):
+    """Tests `RequestIDHandler` class."""
+
+    def test_header_added(self, context):
+        request = RequestIDHandler().http_request(Request('http://example/'))
+        assert request.get_header('X-request-id') == 'abc'
+
+    def test_explicit_header(self, context):
+        request = Request('http://example/', headers={'X-Request-ID': 'def'})
+        request = RequestIDHandler().https_request(request)
+        assert request.get_header('X-request-id') == 'def'
+
+    def test_without_context(self):
+        request = RequestIDHandler().http_request(Request('http://example/'))
+        assert not request.has_header('X-request-id')
+
+    def test_opener(self, server, context):
+        response = build_opener().open(server)
+        assert response.read() == b'abc'
+        response.close()
+
+
+class TestHTTPConnection(object):
+    """Tests `HTTPConnection` class."""
+
+    def test_header_per_request(self, server):
+        port = int(server.rsplit(':', 1)[1].strip('/'))
+        connection = HTTPConnection('127.0.0.1', port)
+        try:
+            connection.request('GET', '/')
+            assert connection.getresponse().read() == b'-'
+            for rid in ['abc', 'def']:
+                builder = EnvironBuilder(headers={'X-Request-ID': rid})
+                with RequestContext(builder.get_environ()):
+                    connection.request('GET', '/')
+                assert connection.getresponse().read() == rid.encode()
+        finally:
+            connection.close()
+
+
+class TestRequestIDAdapter(object):
+    """Tests `RequestIDAdapter` class."""
+
+    def test_session(self, server, context):
+        requests = pytest.importorskip('requests')
+        from kudzu.client import mount_adapter
+        session = mount_adapter(requests.Session())
+        assert session.get(server).content == b'abc'
+        response = session.get(server, headers={'X-Request-ID': 'def'})
+        assert response.content == b'def'
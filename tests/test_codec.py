@@ -0,0 +1,156 @@
+
+from __future__ import absolute_import
+
+import io
+import json
+import logging
+
+import pytest
+from werkzeug.test import EnvironBuilder
+
+from kudzu import RequestContext
+from kudzu.cli import main
+from kudzu.codec import _write_varint, CodecError, CompactHandler, \
+    RecordDecoder, RecordEncoder
+
+
+def decode(data):
+    return list(RecordDecoder(io.BytesIO(data)))
+
+
+class TestRecordEncoder(object):
+    """Tests `RecordEncoder` and `RecordDecoder` classes."""
+
+    fields = ('method', 'uri', 'status', 'rsize', 'uagent')
+
+    def test_round_trip(self):
+        encoder = RecordEncoder(self.fields)
+        records = [
+            {'method': 'GET', 'uri': '/', 'status': '200', 'rsize': '0',
+             'uagent': 'testbot'},
+            {'method': 'POST', 'uri': '/foo?x=ž', 'status': '???',
+             'rsize': '-', 'uagent': 'testbot'},
+            {'method': 'GET', 'uri': '/bar', 'status': '404',
+             'rsize': '007'},
+        ]
+        data = encoder.header + b''.join(encoder.encode(r) for r in records)
+        decoded = decode(data)
+        assert decoded[0] == records[0]
+        assert decoded[1] == records[1]
+        assert decoded[2] == dict(records[2], uagent='-')
+
+    def test_non_ascii_digits_are_strings(self):
+        encoder = RecordEncoder(('status', 'rsize'))
+        # Superscript two and Arabic-Indic digits
+        record = {'status': u'\u00b2', 'rsize': u'\u0661\u0662'}
+        data = encoder.header + encoder.encode(record)
+        assert decode(data) == [record]
+
+    def test_long_numbers_are_strings(self):
+        encoder = RecordEncoder(('rsize', 'user'))
+        record = {'rsize': '9' * 19, 'user': '1' * 5000}
+        data = encoder.header + encoder.encode(record)
+        assert decode(data) == [record]
+
+    def test_repeated_strings_are_written_once(self):
+        encoder = RecordEncoder(self.fields)
+        values = {'method': 'GET', 'uagent': 'x' * 100}
+        first = encoder.encode(values)
+        second = encoder.encode(values)
+        assert len(first) > 100
+        assert len(second) < 10
+        expected = dict.fromkeys(self.fields, '-')
+        expected.update(values)
+        assert decode(encoder.header + first + second) == [expected] * 2
+
+    def test_request_id_is_packed(self):
+        encoder = RecordEncoder(('rid',))
+        rid = '2fae06c0-e2c7-46e4-9dfc-019ecd8d6c82'
+        frame = encoder.encode({'rid': rid})
+        assert len(frame) == 18
+        assert decode(encoder.header + frame) == [{'rid': rid}]
+
+    def test_table_size_is_limited(self):
+        encoder = RecordEncoder(self.fields, max_table_size=1)
+        records = [{'method': 'GET'}, {'method': 'PUT'}, {'method': 'PUT'},
+                   {'method': 'GET'}]
+        data = encoder.header + b''.join(encoder.encode(r) for r in records)
+        assert [r['method'] for r in decode(data)] == \
+            ['GET', 'PUT', 'PUT', 'GET']
+
+    def test_fields_are_read_from_header(self):
+        encoder = RecordEncoder(('rid', 'uri'))
+        data = encoder.header + encoder.encode({'rid': 'xyz', 'uri': '/'})
+        decoder = RecordDecoder(io.BytesIO(data))
+        assert list(decoder) == [{'rid': 'xyz', 'uri': '/'}]
+        assert decoder.fields == ('rid', 'uri')
+
+    def test_invalid_stream_raises(self):
+        with pytest.raises(CodecError):
+            decode(b'GET / HTTP/1.1\n')
+
+    def test_truncated_frame_raises(self):
+        encoder = RecordEncoder(self.fields)
+        data = encoder.header + encoder.encode({'uri': '/foo'})
+        with pytest.raises(CodecError):
+            decode(data[:-1])
+
+    def test_too_long_integer_raises(self):
+        encoder = RecordEncoder(('rsize',))
+        payload = bytearray([3])  # Integer token
+        _write_varint(payload, 10 ** 5000)
+        frame = bytearray()
+        _write_varint(frame, len(payload))
+        with pytest.raises(CodecError):
+            decode(encoder.header + bytes(frame + payload))
+
+
+class TestCompactHandler(object):
+    """Tests `CompactHandler` class."""
+
+    def setup_method(self, method):
+        self.logger = logging.getLogger('test_codec')
+        self.logger.level = logging.DEBUG
+
+    def log(self, handler, message):
+        self.logger.addHandler(handler)
+        try:
+            builder = EnvironBuilder(path='/foo',
+                                     headers={'X-Request-ID': 'xyz'})
+            with RequestContext(builder.get_environ()):
+                self.logger.info(message)
+        finally:
+            self.logger.removeHandler(handler)
+
+    def test_records_are_written(self):
+        stream = io.BytesIO()
+        self.log(CompactHandler(stream), 'Hello Kudzu')
+        records = decode(stream.getvalue())
+        assert len(records) == 1
+        assert records[0]['uri'] == '/foo'
+        assert records[0]['rid'] == 'xyz'
+        assert records[0]['levelname'] == 'INFO'
+        assert records[0]['name'] == 'test_codec'
+        assert records[0]['message'] == 'Hello Kudzu'
+
+    def test_appended_segments_are_decoded(self, tmpdir):
+        path = str(tmpdir.join('access.kzc'))
+        for message in ['first', 'second']:
+            handler = CompactHandler(path)
+            self.log(handler, message)
+            handler.close()
+        with open(path, 'rb') as stream:
+            records = list(RecordDecoder(stream))
+        assert [r['message'] for r in records] == ['first', 'second']
+
+    def test_decode_command(self, tmpdir):
+        path = str(tmpdir.join('access.kzc'))
+        handler = CompactHandler(path)
+        self.log(handler, 'Hello Kudzu')
+        handler.close()
+        out = io.StringIO()
+        assert main(['decode', '--json', path], out=out) == 0
+        assert json.loads(out.getvalue())['message'] == 'Hello Kudzu'
+        out = io.StringIO()
+        main(['decode', '--format', '%(rid)s %(message)s', path], out=out)
+        assert out.getvalue() == 'xyz Hello Kudzu\n'
@@ -1,8 +1,12 @@
 
 from __future__ import absolute_import
 
+import gc
+import os
 import re
+import sys
 import time
+import types
 
 try:
     import threading
@@ -12,7 +16,12 @@ except ImportError:
 import pytest
 from werkzeug.test import EnvironBuilder
 
+import kudzu.context
 from kudzu import get_remote_addr, get_request_id, RequestContext
+from kudzu.context import get_rss_kb, GreenletLocal, import_tracemalloc
+
+
+tracemalloc = import_tracemalloc()
 
 
 class TestRequestContext(object):
@@ -149,6 +158,92 @@ class TestRequestContext(object):
         context = RequestContext(builder.get_environ())
         assert context.log_vars['rid'] == 'xyz'
 
+    @pytest.mark.parametrize('header', [
+        'X-Request-Start', 'X-Queue-Start',
+    ])
+    @pytest.mark.parametrize('value,scale', [
+        ('t=%.3f', 1), ('%d', 1e3), ('t=%d', 1e6),
+    ])
+    def test_queue_time(self, header, value, scale):
+        start = (time.time() - 0.25) * scale
+        builder = EnvironBuilder(headers={header: value % start})
+        context = RequestContext(builder.get_environ())
+        assert abs(int(context.log_vars['qtime']) - 250) < 50
+
+    @pytest.mark.parametrize('value', [
+        '', 'foo', 't=%s' % 1e20, 'nan', 'inf', 't=-inf', '1e400',
+    ])
+    def test_invalid_queue_time(self, value):
+        builder = EnvironBuilder(headers={'X-Request-Start': value})
+        context = RequestContext(builder.get_environ())
+        assert context.log_vars['qtime'] in ('-', '0')
+
+    def test_close_callbacks(self):
+        context = RequestContext(EnvironBuilder().get_environ())
+        calls = []
+        def callback(context):
+            calls.append((context, RequestContext.get()))
+        context.add_close_callback(callback)
+        context.add_close_callback(callback)
+        context.close()
+        context.close()
+        assert calls == [(context, context)] * 2
+        assert RequestContext.get() is None
+
+    def test_failing_close_callback(self):
+        context = RequestContext(EnvironBuilder().get_environ())
+        calls = []
+        def callback(context):
+            calls.append(context)
+            raise ValueError(len(calls))
+        context.add_close_callback(callback)
+        context.add_close_callback(callback)
+        with pytest.raises(ValueError) as excinfo:
+            context.close()
+        assert excinfo.value.args == (1,)
+        assert calls == [context] * 2
+        assert RequestContext.get() is None
+
+    def test_untracked_memory(self):
+        context = RequestContext(EnvironBuilder().get_environ())
+        assert context.log_vars['mem_kb'] == '-'
+        assert context.get_log_var('alloc_kb') == '-'
+
+    @pytest.mark.skipif(get_rss_kb() is None, reason='requires procfs')
+    def test_memory(self):
+        context = RequestContext(EnvironBuilder().get_environ())
+        context.start_memory_tracking()
+        data = b'x' * (8 * 1024 * 1024)
+        assert int(context.get_log_var('mem_kb')) >= 8 * 1024
+        context.stop_memory_tracking()
+        del data
+        assert int(context.log_vars['mem_kb']) >= 8 * 1024
+        assert context.log_vars['alloc_kb'] == '-'
+
+    @pytest.mark.skipif(get_rss_kb() is None, reason='requires procfs')
+    def test_statm_descriptor_of_parent_is_closed(self, monkeypatch):
+        get_rss_kb()
+        pid = kudzu.context._statm[0]
+        descriptors = len(os.listdir('/proc/self/fd'))
+        # Simulates a child process after fork
+        monkeypatch.setattr(os, 'getpid', lambda: pid + 1)
+        assert get_rss_kb() is not None
+        assert kudzu.context._statm[0] == pid + 1
+        assert len(os.listdir('/proc/self/fd')) == descriptors
+
+    @pytest.mark.skipif(tracemalloc is None, reason='requires tracemalloc')
+    def test_allocations(self):
+        context = RequestContext(EnvironBuilder().get_environ())
+        tracemalloc.start()
+        try:
+            context.start_memory_tracking()
+            data = [object() for i in range(10000)]
+            context.stop_memory_tracking()
+        finally:
+            tracemalloc.stop()
+        del data
+        assert int(context.get_log_var('alloc_kb')) >= 100
+
 
 class TestRequestContextStack(object):
     """Tests access to thread local `RequestContext` instance."""
@@ -232,6 +327,167 @@ class TestRequestContextStack(object):
         assert RequestContext.get() is None
 
 
+class FakeGreenlet(object):
+    """Greenlet of `FakeHub` which runs a generator function."""
+
+    def __init__(self, run):
+        self.run = run
+
+
+class FakeHub(object):
+    """Round-robin scheduler of fake greenlets.
+
+    Greenlets are generators, each `yield` switches to the next one.
+    """
+
+    def __init__(self):
+        self.main = self.current = FakeGreenlet(None)
+        self.switches = 0
+
+    def getcurrent(self):
+        return self.current
+
+    def run(self, functions):
+        running = [(FakeGreenlet(f), f()) for f in functions]
+        while running:
+            pending = []
+            for greenlet, iterator in running:
+                self.current = greenlet
+                try:
+                    next(iterator)
+                except StopIteration:
+                    continue
+                finally:
+                    self.current = self.main
+                self.switches += 1
+                pending.append((greenlet, iterator))
+            running = pending
+
+
+class TestGreenletStorage(object):
+    """Tests `RequestContext` stored in `GreenletLocal`."""
+
+    greenlets = 5000
+
+    def setup_method(self, method):
+        self.hub = FakeHub()
+        self.getcurrent_calls = 0
+        self.saved_storage = RequestContext._local
+        self.storage = RequestContext.set_storage(
+            GreenletLocal(self.getcurrent))
+
+    def teardown_method(self, method):
+        RequestContext.set_storage(self.saved_storage)
+
+    def getcurrent(self):
+        self.getcurrent_calls += 1
+        return self.hub.getcurrent()
+
+    def test_greenlets(self):
+        environ = EnvironBuilder().get_environ()
+        checked = []
+
+        def run():
+            assert RequestContext.get() is None
+            with RequestContext(environ) as context:
+                yield
+                assert RequestContext.get() is context
+                with RequestContext(environ) as inner:
+                    yield
+                    assert RequestContext.get() is inner
+                yield
+                assert RequestContext.get() is context
+            assert RequestContext.get() is None
+            checked.append(context)
+
+        self.hub.run([run] * self.greenlets)
+        assert len(checked) == self.greenlets
+        assert len(set(checked)) == self.greenlets
+        assert RequestContext.get() is None
+
+    def test_storage_is_dropped_with_greenlets(self):
+        environ = EnvironBuilder().get_environ()
+
+        def run():
+            RequestContext(environ).push()
+            yield
+
+        self.hub.run([run] * 100)
+        gc.collect()
+        assert len(self.storage._dicts) == 0
+
+    def test_switches_are_not_tracked(self):
+        def run():
+            for __ in range(10):
+                yield
+
+        self.hub.run([run] * 100)
+        assert self.hub.switches == 1000
+        assert self.getcurrent_calls == 0
+
+    def test_reset(self):
+        environ = EnvironBuilder().get_environ()
+        RequestContext(environ).push()
+        RequestContext.reset()
+        assert RequestContext.get() is None
+        RequestContext.reset()
+
+    @pytest.mark.parametrize('name, attr, module', [
+        ('gevent.monkey', 'is_module_patched', 'threading'),
+        ('eventlet.patcher', 'is_monkey_patched', 'thread'),
+    ])
+    def test_select_storage(self, monkeypatch, name, attr, module):
+        RequestContext.set_storage(threading.local())
+        assert not isinstance(RequestContext.select_storage(), GreenletLocal)
+        patched = types.ModuleType(name)
+        setattr(patched, attr, lambda name: name == module)
+        greenlet = types.ModuleType('greenlet')
+        greenlet.getcurrent = self.hub.getcurrent
+        monkeypatch.setitem(sys.modules, name, patched)
+        monkeypatch.setitem(sys.modules, 'greenlet', greenlet)
+        storage = RequestContext.select_storage()
+        assert isinstance(storage, GreenletLocal)
+        assert RequestContext.select_storage() is storage
+        assert RequestContext._local is storage
+
+    def patch_gevent(self, monkeypatch):
+        patched = types.ModuleType('gevent.monkey')
+        patched.is_module_patched = lambda name: name == 'threading'
+        greenlet = types.ModuleType('greenlet')
+        greenlet.getcurrent = self.hub.getcurrent
+        monkeypatch.setitem(sys.modules, 'gevent.monkey', patched)
+        monkeypatch.setitem(sys.modules, 'greenlet', greenlet)
+
+    def test_set_storage_moves_current_stack(self):
+        RequestContext.set_storage(threading.local())
+        with RequestContext(EnvironBuilder().get_environ()) as context:
+            storage = RequestContext.set_storage(self.storage)
+            assert RequestContext.get() is context
+        assert RequestContext.get() is None
+        assert RequestContext._local is storage
+
+    def test_select_storage_keeps_pushed_contexts(self, monkeypatch):
+        storage = RequestContext.set_storage(threading.local())
+        pushed = threading.Event()
+        release = threading.Event()
+
+        def run():
+            with RequestContext(EnvironBuilder().get_environ()):
+                pushed.set()
+                release.wait(5)
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        pushed.wait(5)
+        self.patch_gevent(monkeypatch)
+        try:
+            assert RequestContext.select_storage() is storage
+        finally:
+            release.set()
+            thread.join()
+        assert isinstance(RequestContext.select_storage(), GreenletLocal)
+
+
 class TestContextGetters(object):
 
     def test_remote_addr_is_returned(self):
@@ -0,0 +1,275 @@
+
+from __future__ import absolute_import
+
+import gc
+import logging
+import os
+import socket
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import pytest
+from werkzeug.test import EnvironBuilder
+
+from kudzu import RequestContext, RequestContextMiddleware
+from kudzu.handlers import BatchingSocketHandler, RequestBufferHandler
+
+
+class HandlerMock(logging.Handler):
+    """Logging handler which saves all logged records."""
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+    @property
+    def messages(self):
+        return [record.getMessage() for record in self.records]
+
+
+class TestRequestBufferHandler(object):
+    """Tests `RequestBufferHandler` class."""
+
+    def setup_method(self, method):
+        self.target = HandlerMock()
+        self.logger = logging.getLogger('test_handlers')
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.propagate = False
+
+    def teardown_method(self, method):
+        self.logger.handlers = []
+        self.logger.setLevel(logging.NOTSET)
+        self.logger.propagate = True
+        RequestContext.reset()
+
+    def add_handler(self, **kwargs):
+        handler = RequestBufferHandler(self.target, **kwargs)
+        self.logger.addHandler(handler)
+        return handler
+
+    def make_app(self, fail=False):
+        logger = self.logger
+        def app(environ, start_response):
+            logger.debug('debug %s', environ['PATH_INFO'])
+            logger.info('info')
+            if fail:
+                logger.error('error')
+            logger.debug('after')
+            start_response('200 OK', [])
+            return [b'']
+        return RequestContextMiddleware(app)
+
+    def run_app(self, app, rid='abc', path='/'):
+        builder = EnvironBuilder(path=path, headers={'X-Request-ID': rid})
+        app(builder.get_environ(), lambda *args: None).close()
+
+    def test_records_discarded(self):
+        handler = self.add_handler()
+        self.run_app(self.make_app())
+        assert self.target.messages == ['info']
+        assert not handler._buffers
+
+    def test_records_flushed_on_error(self):
+        handler = self.add_handler()
+        self.run_app(self.make_app(fail=True))
+        assert self.target.messages == ['info', 'debug /', 'error', 'after']
+        assert not handler._buffers
+
+    def test_records_flushed_on_latency(self):
+        handler = self.add_handler(latency_threshold=0)
+        self.run_app(self.make_app())
+        assert self.target.messages == ['info', 'debug /', 'after']
+        assert not handler._buffers
+
+    def test_records_outside_request(self):
+        self.add_handler()
+        self.logger.debug('debug')
+        assert self.target.messages == ['debug']
+
+    def test_buffer_capacity(self):
+        self.add_handler(capacity=2)
+        builder = EnvironBuilder(headers={'X-Request-ID': 'abc'})
+        with RequestContext(builder.get_environ()):
+            for i in range(5):
+                self.logger.debug('%s', i)
+            self.logger.error('error')
+        assert self.target.messages == ['3', '4', 'error']
+
+    def test_max_requests(self):
+        handler = self.add_handler(max_requests=2)
+        contexts = []
+        for rid in ['a', 'b', 'c']:
+            builder = EnvironBuilder(headers={'X-Request-ID': rid})
+            contexts.append(RequestContext(builder.get_environ()))
+            with contexts[-1]:
+                self.logger.debug(rid)
+        assert list(handler._buffers) == [id(c) for c in contexts[1:]]
+        for context in contexts:
+            context.close()
+        assert not handler._buffers
+
+    def test_requests_with_same_id(self):
+        handler = self.add_handler()
+        builder = EnvironBuilder(headers={'X-Request-ID': 'abc'})
+        context1 = RequestContext(builder.get_environ())
+        context2 = RequestContext(builder.get_environ())
+        with context1:
+            self.logger.debug('first')
+        with context2:
+            self.logger.debug('second')
+        context1.close()
+        with context2:
+            self.logger.error('error')
+        assert self.target.messages == ['second', 'error']
+        assert self.target.records[0].kudzu_context is context2
+        context2.close()
+        assert not handler._buffers
+
+    def test_unclosed_context_is_released(self):
+        handler = self.add_handler()
+        builder = EnvironBuilder(headers={'X-Request-ID': 'abc'})
+        with RequestContext(builder.get_environ()):
+            self.logger.debug('debug')
+        gc.collect()
+        assert not handler._buffers
+
+    def test_records_keep_context(self):
+        self.add_handler()
+        self.run_app(self.make_app(fail=True), path='/foo')
+        context = self.target.records[1].kudzu_context
+        assert context.request_id == 'abc'
+        assert context.log_vars['uri'] == '/foo'
+
+
+class TestBatchingSocketHandler(object):
+    """Tests `BatchingSocketHandler` class against local sockets."""
+
+    def setup_method(self, method):
+        self.logger = logging.getLogger('test_handlers.socket')
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        self.sockets = []
+
+    def teardown_method(self, method):
+        for handler in self.logger.handlers:
+            handler.close()
+        self.logger.handlers = []
+        self.logger.setLevel(logging.NOTSET)
+        self.logger.propagate = True
+        for sock in self.sockets:
+            sock.close()
+
+    def add_handler(self, *args, **kwargs):
+        handler = BatchingSocketHandler(*args, **kwargs)
+        self.logger.addHandler(handler)
+        return handler
+
+    def bind(self, family, socktype, address):
+        sock = socket.socket(family, socktype)
+        self.sockets.append(sock)
+        sock.settimeout(5)
+        sock.bind(address)
+        return sock
+
+    def test_udp_batches(self):
+        server = self.bind(socket.AF_INET, socket.SOCK_DGRAM,
+                           ('127.0.0.1', 0))
+        handler = self.add_handler(server.getsockname(), max_size=25,
+                                   flush_interval=10)
+        for i in range(5):
+            self.logger.info('message %s', i)
+        handler.close()
+        datagrams = [server.recv(1024) for i in range(3)]
+        assert datagrams == [b'message 0\nmessage 1\n',
+                             b'message 2\nmessage 3\n', b'message 4\n']
+
+    def test_flush_interval(self):
+        server = self.bind(socket.AF_INET, socket.SOCK_DGRAM,
+                           ('127.0.0.1', 0))
+        self.add_handler(server.getsockname(), flush_interval=0.01)
+        self.logger.info('foo')
+        assert server.recv(1024) == b'foo\n'
+        self.logger.info('bar')
+        assert server.recv(1024) == b'bar\n'
+
+    def test_long_record_truncated(self):
+        server = self.bind(socket.AF_INET, socket.SOCK_DGRAM,
+                           ('127.0.0.1', 0))
+        handler = self.add_handler(server.getsockname(), max_size=10)
+        self.logger.info('x' * 20)
+        # Two-byte characters must not be split
+        self.logger.info(u'\u017e' * 10)
+        handler.close()
+        assert server.recv(1024) == b'x' * 9 + b'\n'
+        assert server.recv(1024) == (u'\u017e' * 4 + u'\n').encode('utf-8')
+
+    def test_emit_after_close(self):
+        server = self.bind(socket.AF_INET, socket.SOCK_DGRAM,
+                           ('127.0.0.1', 0))
+        handler = self.add_handler(server.getsockname())
+        self.logger.info('foo')
+        handler.close()
+        self.logger.info('bar')
+        assert handler._thread is not None
+        assert not handler._thread.is_alive()
+        assert handler.queue.empty()
+        assert server.recv(1024) == b'foo\n'
+
+    @pytest.mark.skipif(not hasattr(socket, 'AF_UNIX'),
+                        reason='requires Unix sockets')
+    def test_unix_datagram(self, tmpdir):
+        path = str(tmpdir.join('log.sock'))
+        server = self.bind(socket.AF_UNIX, socket.SOCK_DGRAM, path)
+        handler = self.add_handler(path)
+        assert handler.max_size == 8192
+        self.logger.info('foo')
+        self.logger.info('bar')
+        handler.close()
+        assert server.recv(1024) == b'foo\nbar\n'
+
+    @pytest.mark.skipif(not hasattr(socket, 'AF_UNIX'),
+                        reason='requires Unix sockets')
+    def test_unix_stream_reconnect(self, tmpdir):
+        path = str(tmpdir.join('log.sock'))
+        handler = self.add_handler(path, socktype=socket.SOCK_STREAM,
+                                   flush_interval=0.01, reconnect_delay=0.05)
+        self.logger.info('lost')
+        deadline = time.time() + 5
+        while handler.dropped < 1 and time.time() < deadline:
+            time.sleep(0.01)
+        assert handler.dropped == 1
+        server = self.bind(socket.AF_UNIX, socket.SOCK_STREAM, path)
+        server.listen(1)
+        time.sleep(0.1)
+        self.logger.info('foo')
+        self.logger.info('bar')
+        handler.close()
+        connection, __ = server.accept()
+        connection.settimeout(5)
+        data = b''
+        while True:
+            chunk = connection.recv(1024)
+            if not chunk:
+                break
+            data += chunk
+        connection.close()
+        assert data == b'foo\nbar\n'
+
+    def test_full_queue(self):
+        server = self.bind(socket.AF_INET, socket.SOCK_DGRAM,
+                           ('127.0.0.1', 0))
+        handler = self.add_handler(server.getsockname())
+        # Queue without sender thread
+        handler._pid = os.getpid()
+        handler.queue = queue.Queue(1)
+        self.logger.info('foo')
+        self.logger.info('dropped')
+        assert handler.dropped == 1
+        assert handler.queue.get() == b'foo\n'
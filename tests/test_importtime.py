@@ -0,0 +1,75 @@
+"""Import-time benchmark of the package.
+
+Imports are executed in fresh interpreters with `python -X importtime`,
+so modules imported by other tests do not affect the results.
+"""
+
+from __future__ import absolute_import
+
+import subprocess
+import sys
+
+import pytest
+
+
+pytestmark = pytest.mark.skipif(sys.version_info < (3, 7),
+                                reason='requires -X importtime')
+
+
+def import_times(code):
+    """Returns cumulative import times in microseconds by module names.
+
+    Top-level imports are also summed under `None`, except imports
+    of the interpreter startup.
+    """
+    output = subprocess.check_output(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        stderr=subprocess.STDOUT)
+    rv = {None: 0}
+    startup = True
+    for line in output.decode('utf-8').splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        __, cumulative, name = line.split('|')
+        if not cumulative.strip().isdigit():
+            continue
+        rv[name.strip()] = int(cumulative)
+        if name.strip() == 'site':
+            startup = False  # Site is the last module imported at startup
+        elif not startup and not name.startswith('  '):
+            rv[None] += int(cumulative)
+    return rv
+
+
+class TestImportTime(object):
+
+    def test_package(self):
+        times = import_times('import kudzu')
+        assert 'kudzu' in times
+        assert not [name for name in times
+                    if name and name.startswith('kudzu.')]
+
+    def test_context(self):
+        times = import_times('import kudzu; kudzu.get_request_id')
+        assert 'kudzu.context' in times
+        for name in ('kudzu.middleware', 'kudzu.logging', 'tracemalloc',
+                     'socket'):
+            assert name not in times
+
+    def test_middleware(self):
+        times = import_times('from kudzu import kudzify_app')
+        assert 'kudzu.middleware' in times
+        # Imported only when features which need them are used
+        for name in ('kudzu.proxy', 'kudzu.logging', 'tracemalloc',
+                     'uuid', 'cProfile', 'socket'):
+            assert name not in times
+
+    @pytest.mark.benchmark
+    def test_benchmark(self, capsys):
+        lazy = import_times('import kudzu')[None]
+        used = import_times('from kudzu import kudzify_app')[None]
+        full = import_times('from kudzu import *')[None]
+        with capsys.disabled():
+            print('\nImport time: lazy %d us, kudzify_app %d us, '
+                  'all %d us' % (lazy, used, full))
+        assert lazy < full
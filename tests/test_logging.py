@@ -2,10 +2,14 @@
 from __future__ import absolute_import
 
 import logging
+import re
 
+import pytest
 from werkzeug.test import EnvironBuilder
 
 from kudzu import RequestContext, kudzify_handler, kudzify_logger
+from kudzu.logging import ContextLogRecord, install_record_factory, \
+    RequestContextFilter, RequestContextFormatter, uninstall_record_factory
 
 
 class HandlerMock(logging.Handler):
@@ -13,9 +17,11 @@ class HandlerMock(logging.Handler):
 
     def __init__(self):
         logging.Handler.__init__(self)
+        self.records = []
         self.messages = []
 
     def emit(self, record):
+        self.records.append(record)
         self.messages.append(self.format(record))
 
 
@@ -74,3 +80,164 @@ class TestRequestContextFilter(object):
         assert len(self.handler.messages) == 1
         assert self.handler.messages[0] == \
             '["GET HTTP/1.1 /foo" from 127.0.0.1] Hello Kudzu'
+
+
+class TestRecordEnrichment(object):
+    """Tests that records are enriched by request context only once."""
+
+    def setup_method(self, method):
+        self.handlers = [HandlerMock(), HandlerMock()]
+        self.logger = logging.getLogger('test_logging')
+        for handler in self.handlers:
+            self.logger.addHandler(handler)
+        self.logger.level = logging.DEBUG
+
+    def teardown_method(self, method):
+        for handler in self.handlers:
+            self.logger.removeHandler(handler)
+        uninstall_record_factory()
+
+    def log(self, message):
+        builder = EnvironBuilder(path='/foo',
+                                 headers={'X-Request-ID': 'xyz'})
+        with RequestContext(builder.get_environ()) as context:
+            self.logger.info(message)
+        return context
+
+    def test_filter_sets_keys_once(self, monkeypatch):
+        calls = []
+        get_log_var = RequestContext.get_log_var
+        def counting_get_log_var(context, key):
+            calls.append(key)
+            return get_log_var(context, key)
+        monkeypatch.setattr(RequestContext, 'get_log_var',
+                            counting_get_log_var)
+        self.handlers[0].addFilter(RequestContextFilter(['rid', 'uri']))
+        self.handlers[1].addFilter(RequestContextFilter(['rid', 'addr']))
+        context = self.log('Hello')
+        assert sorted(calls) == ['addr', 'rid', 'uri']
+        record = self.handlers[1].records[0]
+        assert record is self.handlers[0].records[0]
+        assert record.kudzu_context is context
+        assert (record.rid, record.uri, record.addr) == ('xyz', '/foo', '-')
+
+    def test_filter_wo_keys_attaches_context(self):
+        self.handlers[0].addFilter(RequestContextFilter())
+        self.handlers[0].formatter = RequestContextFormatter('%(rid)s')
+        context = self.log('Hello')
+        record = self.handlers[0].records[0]
+        assert record.kudzu_context is context
+        assert 'rid' not in record.__dict__
+        # Context is taken from the record when the request is over
+        assert self.handlers[0].format(record) == 'xyz'
+
+    def test_record_factory(self):
+        install_record_factory()
+        install_record_factory()
+        context = self.log('Hello')
+        record = self.handlers[0].records[0]
+        assert isinstance(record, ContextLogRecord)
+        assert record.kudzu_context is context
+        assert record.rid == 'xyz'
+        assert 'rid' not in record.__dict__
+        uninstall_record_factory()
+        assert logging.getLogRecordFactory() is logging.LogRecord
+
+    def test_record_factory_wo_context(self):
+        install_record_factory()
+        self.logger.info('Hello')
+        record = self.handlers[0].records[0]
+        assert record.kudzu_context is None
+        assert record.rid == '-'
+        with pytest.raises(AttributeError):
+            record.foo
+
+    def test_custom_record_factory_is_wrapped(self):
+        def factory(*args, **kwargs):
+            record = logging.LogRecord(*args, **kwargs)
+            record.custom = True
+            return record
+        logging.setLogRecordFactory(factory)
+        try:
+            install_record_factory()
+            context = self.log('Hello')
+            record = self.handlers[0].records[0]
+            assert record.custom
+            assert record.kudzu_context is context
+            uninstall_record_factory()
+            assert logging.getLogRecordFactory() is factory
+        finally:
+            logging.setLogRecordFactory(logging.LogRecord)
+
+
+class TestRequestContextFormatter(object):
+
+    def setup_method(self, method):
+        self.handler = HandlerMock()
+        self.logger = logging.getLogger('test_logging')
+        self.logger.addHandler(self.handler)
+        self.logger.level = logging.DEBUG
+
+    def teardown_method(self, method):
+        self.logger.removeHandler(self.handler)
+
+    def log(self, formatter, *args, **kwargs):
+        self.handler.formatter = formatter
+        builder = EnvironBuilder(path='/foo',
+                                 headers={'X-Request-ID': 'xyz'})
+        with RequestContext(builder.get_environ()):
+            self.logger.info(*args, **kwargs)
+        return self.handler.messages[-1]
+
+    def test_percent_style(self):
+        formatter = RequestContextFormatter(
+            '%(rid)s %(levelname)-5s|%(levelno)03d 100%% %(uri)s %(message)s')
+        message = self.log(formatter, 'Hello %s', 'Kudzu')
+        assert message == 'xyz INFO |020 100% /foo Hello Kudzu'
+
+    def test_brace_style(self):
+        formatter = RequestContextFormatter(
+            '{rid} {levelname:>5}|{name!r} {{ {message}', style='{')
+        message = self.log(formatter, 'Hello %s', 'Kudzu')
+        assert message == "xyz  INFO|'test_logging' { Hello Kudzu"
+
+    def test_template_style(self):
+        formatter = RequestContextFormatter('$rid ${uri}x $$ $message',
+                                            style='$')
+        message = self.log(formatter, 'Hello %s', 'Kudzu')
+        assert message == 'xyz /foox $ Hello Kudzu'
+
+    def test_asctime(self):
+        formatter = RequestContextFormatter('%(asctime)s %(message)s',
+                                            datefmt='%Y')
+        message = self.log(formatter, 'Hello')
+        assert re.match(r'^\d{4} Hello$', message)
+
+    def test_record_is_not_modified(self):
+        formatter = RequestContextFormatter('%(rid)s %(message)s')
+        self.log(formatter, 'Hello')
+        record = self.handler.records[-1]
+        assert not hasattr(record, 'rid')
+
+    def test_extra_is_formatted(self):
+        formatter = RequestContextFormatter('%(rid)s %(foo)s')
+        message = self.log(formatter, 'Hello', extra={'foo': 'bar'})
+        assert message == 'xyz bar'
+
+    def test_unicode_message_is_formatted(self):
+        formatter = RequestContextFormatter('%(rid)s %(message)s %(foo)s')
+        message = self.log(formatter, u'caf\xe9', extra={'foo': (1, 2)})
+        assert message == u'xyz caf\xe9 (1, 2)'
+
+    def test_exception_is_formatted(self):
+        formatter = RequestContextFormatter('%(rid)s %(message)s')
+        try:
+            raise ZeroDivisionError
+        except ZeroDivisionError:
+            message = self.log(formatter, 'Failed', exc_info=True)
+        assert message.startswith('xyz Failed\nTraceback')
+        assert message.endswith('ZeroDivisionError')
+
+    def test_unsupported_placeholder_raises(self):
+        with pytest.raises(ValueError):
+            RequestContextFormatter('{args[0]}', style='{')
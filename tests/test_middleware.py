@@ -2,14 +2,27 @@
 from __future__ import absolute_import
 
 import logging
+import os
+import pstats
 import re
+import signal
+import sys
+import types
 
 import pytest
 from werkzeug.test import EnvironBuilder, run_wsgi_app
 from werkzeug.wrappers import BaseResponse
 
-from kudzu import kudzify_app, RequestContext, LoggingMiddleware, \
+from kudzu import ConcurrencyGauge, kudzify_app, RequestContext, \
+    LoggingMiddleware, LoggingRule, ProfilingMiddleware, \
     RequestContextMiddleware, RequestIDMiddleware
+from kudzu.context import GreenletLocal, import_tracemalloc
+from kudzu.middleware import configure_logging, disable, enable, \
+    ExceptionLimiter, HeaderScanner, install_signal_toggle, is_enabled, \
+    LoadController, LoggingRules
+
+
+tracemalloc = import_tracemalloc()
 
 
 class HandlerMock(logging.Handler):
@@ -40,6 +53,21 @@ def error_app(environ, start_response):
     raise ZeroDivisionError
 
 
+def generator_app(environ, start_response):
+    """WSGI application which returns generator and fails on demand."""
+    start_response('200 OK', [('Content-type', 'text/plain')])
+    yield b'Hello '
+    if environ['PATH_INFO'] == '/error':
+        raise ZeroDivisionError
+    yield b'world!'
+
+
+def call_app(app, *args, **kwargs):
+    """Calls WSGI application and returns response iterable."""
+    environ = EnvironBuilder(*args, **kwargs).get_environ()
+    return app(environ, lambda status, headers, exc_info=None: None)
+
+
 def run_app(app, *args, **kwargs):
     """Executes WSGI application and returns response instance."""
     environ = EnvironBuilder(*args, **kwargs).get_environ()
@@ -97,12 +125,431 @@ class TestLoggingMiddleware(object):
         assert self.handler.records[1].msg == 'Exception in 7 ms'
         assert self.handler.records[1].exc_info is not None
 
+    def test_generator_response_is_logged_after_iteration(self):
+        app = RequestContextMiddleware(LoggingMiddleware(generator_app,
+                                                         self.logger))
+        response = call_app(app)
+        assert len(self.handler.records) == 1
+        assert list(response) == [b'Hello ', b'world!']
+        response.close()
+        assert len(self.handler.records) == 2
+        assert self.handler.records[1].msg.startswith(
+            'Response status 200 in ')
+
+    def test_iteration_exception_is_logged(self):
+        app = self.wrap_app(generator_app)
+        app.app.iteration_exception_format = \
+            app.app.iteration_exception_format.replace('%(msecs)s', '7')
+        response = call_app(app, '/error')
+        with pytest.raises(ZeroDivisionError):
+            list(response)
+        response.close()
+        assert self.handler.records[-1].msg == \
+            'Exception after 6 bytes in 7 ms, status 200'
+        assert self.handler.records[-1].exc_info is not None
+        assert RequestContext.get() is None
+
+    def test_abort_is_logged(self):
+        app = self.wrap_app(generator_app)
+        app.app.abort_format = app.app.abort_format.replace('%(msecs)s', '7')
+        response = call_app(app)
+        assert next(response) == b'Hello '
+        response.close()
+        assert self.handler.records[-1].msg == \
+            'Response aborted after 6 bytes in 7 ms, status 200'
+        assert self.handler.records[-1].levelno == logging.WARNING
+
+    def test_head_response_is_not_aborted(self):
+        app = self.wrap_app(simple_app)
+        call_app(app, method='HEAD').close()
+        assert len(self.handler.records) == 2
+
+    def test_close_exception_is_logged(self):
+        class Body(object):
+            def __iter__(self):
+                return iter([b'x'])
+            def close(self):
+                raise ZeroDivisionError
+        def app(environ, start_response):
+            start_response('200 OK', [])
+            return Body()
+        response = call_app(self.wrap_app(app))
+        assert list(response) == [b'x']
+        with pytest.raises(ZeroDivisionError):
+            response.close()
+        assert self.handler.records[-1].msg.startswith(
+            'Exception after 1 bytes')
+
     def test_missing_request_context_raises(self):
         app = LoggingMiddleware(simple_app, self.logger)
         with pytest.raises(RuntimeError):
             run_app(app)
 
 
+class TestLoggingRules(object):
+    """Tests `LoggingRule` and `LoggingRules` classes."""
+
+    def setup_method(self, method):
+        self.handler = HandlerMock()
+        self.logger = logging.getLogger('test_middleware')
+        self.logger.addHandler(self.handler)
+        self.logger.level = logging.DEBUG
+
+    def teardown_method(self, method):
+        self.logger.removeHandler(self.handler)
+        self.logger.setLevel(logging.DEBUG)
+
+    def wrap_app(self, app, rules):
+        return RequestContextMiddleware(LoggingMiddleware(app, self.logger,
+                                                          rules=rules))
+
+    def test_rules_are_matched_in_order(self):
+        rules = [LoggingRule('/static/', methods=['post']),
+                 LoggingRule('/static/img/'),
+                 LoggingRule('/static/'),
+                 LoggingRule('/health')]
+        compiled = LoggingRules(rules)
+        assert compiled.match('GET', '/static/img/a.png') == \
+            (rules[1], rules[2])
+        assert compiled.match('POST', '/static/a.css') == \
+            (rules[0], rules[2])
+        assert compiled.match('GET', '/healthz') == (rules[3],)
+        assert compiled.match('GET', '/api') == ()
+
+    def test_status_classes_are_matched(self):
+        rule = LoggingRule(statuses=[404, '5xx'])
+        assert rule.match_status('404')
+        assert rule.match_status('503')
+        assert not rule.match_status('200')
+        assert not rule.match_status('-')
+
+    def test_request_is_excluded(self):
+        app = self.wrap_app(simple_app, [LoggingRule('/health',
+                                                     exclude=True)])
+        run_app(app, '/health')
+        assert len(self.handler.records) == 0
+        run_app(app, '/foo')
+        assert len(self.handler.records) == 2
+
+    def test_level_is_changed(self):
+        app = self.wrap_app(simple_app, [LoggingRule('/static/',
+                                                     level=logging.DEBUG)])
+        run_app(app, '/static/a.css')
+        assert [r.levelno for r in self.handler.records] == \
+            [logging.DEBUG, logging.DEBUG]
+
+    def test_response_is_excluded_by_status(self):
+        app = self.wrap_app(simple_app, [
+            LoggingRule(statuses=['2xx'], exclude=True),
+            LoggingRule(level=logging.DEBUG)])
+        run_app(app, '/foo')
+        assert len(self.handler.records) == 1
+        assert self.handler.records[0].levelno == logging.DEBUG
+        assert self.handler.records[0].msg.startswith('Request')
+
+    def test_format_is_changed(self):
+        app = self.wrap_app(simple_app, [LoggingRule(
+            '/foo', request_format='%(method)s %(uri)s',
+            response_format='%(status)s')])
+        run_app(app, '/foo')
+        assert [r.msg for r in self.handler.records] == ['GET /foo', '200']
+
+    def test_disabled_level_is_not_formatted(self):
+        self.logger.setLevel(logging.INFO)
+        app = self.wrap_app(simple_app, [LoggingRule(
+            level=logging.DEBUG, request_format='%(missing)s')])
+        run_app(app, '/foo')
+        assert len(self.handler.records) == 0
+
+    def test_exception_is_logged_if_excluded(self):
+        app = self.wrap_app(error_app, [LoggingRule(exclude=True)])
+        with pytest.raises(ZeroDivisionError):
+            run_app(app, '/foo')
+        assert len(self.handler.records) == 1
+        assert self.handler.records[0].exc_info is not None
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestConcurrencyGauge(object):
+    """Tests `ConcurrencyGauge` class and its use in middleware."""
+
+    def test_counts(self):
+        gauge = ConcurrencyGauge()
+        assert gauge.enter() == 1
+        assert gauge.enter() == 2
+        gauge.exit()
+        assert gauge.enter() == 2
+        gauge.exit()
+        gauge.exit()
+        snapshot = gauge.snapshot(reset=True)
+        assert snapshot['inflight'] == 0
+        assert snapshot['max_inflight'] == 2
+        assert snapshot['requests'] == 3
+        assert snapshot['threads'] >= 1
+        assert gauge.snapshot()['max_inflight'] == 0
+
+    def test_periodic_report(self):
+        clock = FakeClock()
+        snapshots = []
+        gauge = ConcurrencyGauge(interval=10, callback=snapshots.append,
+                                 clock=clock)
+        gauge.enter()
+        gauge.exit()
+        assert snapshots == []
+        clock.now += 10
+        gauge.enter()
+        gauge.enter()
+        gauge.exit()
+        assert [s['max_inflight'] for s in snapshots] == [2]
+        gauge.exit()
+        assert len(snapshots) == 1
+
+    def test_report_is_logged(self):
+        handler = HandlerMock()
+        logger = logging.getLogger('test_middleware.gauge')
+        logger.addHandler(handler)
+        try:
+            gauge = ConcurrencyGauge(interval=0, logger=logger)
+            gauge.enter()
+            gauge.exit()
+        finally:
+            logger.removeHandler(handler)
+        assert handler.records[0].getMessage().startswith(
+            'Concurrency 0, max 1, 1 requests, ')
+
+    def test_middleware(self):
+        gauge = ConcurrencyGauge()
+        contexts = []
+        def app(environ, start_response):
+            contexts.append(environ['kudzu.context'])
+            assert gauge.inflight == 1
+            return generator_app(environ, start_response)
+        app = RequestContextMiddleware(app, gauge=gauge)
+        response = call_app(app)
+        assert list(response) == [b'Hello ', b'world!']
+        response.close()
+        response.close()
+        assert gauge.inflight == 0
+        assert contexts[0].log_vars['inflight'] == '1'
+        with pytest.raises(ZeroDivisionError):
+            call_app(RequestContextMiddleware(error_app, gauge=gauge))
+        assert gauge.inflight == 0
+        assert gauge.requests == 2
+
+
+class QueueMock(object):
+
+    def __init__(self, size=0):
+        self.size = size
+
+    def qsize(self):
+        return self.size
+
+
+class TestLoadController(object):
+    """Tests `LoadController` class and its use in `LoggingMiddleware`."""
+
+    def setup_method(self, method):
+        self.handler = HandlerMock()
+        self.logger = logging.getLogger('test_middleware.load')
+        self.logger.addHandler(self.handler)
+        self.logger.setLevel(logging.DEBUG)
+        self.clock = FakeClock()
+        self.queue = QueueMock()
+
+    def teardown_method(self, method):
+        self.logger.removeHandler(self.handler)
+        self.logger.setLevel(logging.NOTSET)
+
+    def make_controller(self, **kwargs):
+        kwargs.setdefault('max_rate', 10)
+        kwargs.setdefault('max_queue', 100)
+        return LoadController(queues=[self.queue], clock=self.clock,
+                              logger=self.logger, **kwargs)
+
+    def observe(self, controller, requests, inflight='-'):
+        context = RequestContext(EnvironBuilder().get_environ())
+        context._log_vars['inflight'] = inflight
+        for __ in range(requests):
+            controller.observe(context)
+        self.clock.now += controller.interval
+        controller.observe(context)
+
+    def test_rate(self):
+        controller = self.make_controller()
+        self.observe(controller, 9)
+        assert not controller.degraded
+        self.observe(controller, 20)
+        assert controller.degraded
+        assert self.handler.records[0].getMessage() == \
+            'Access logs degraded: 21 requests/s, 0 in flight, queue 0'
+        assert self.handler.records[0].levelno == logging.WARNING
+        # Hysteresis
+        self.observe(controller, 8)
+        assert controller.degraded
+        self.observe(controller, 5)
+        assert not controller.degraded
+        assert len(self.handler.records) == 2
+        assert self.handler.records[1].getMessage().startswith(
+            'Access logs recovered: 6 requests/s')
+
+    def test_queue_and_inflight(self):
+        controller = self.make_controller(max_rate=None, max_inflight=4)
+        self.queue.size = 101
+        self.observe(controller, 1)
+        assert controller.degraded
+        self.queue.size = 0
+        self.observe(controller, 1, inflight='5')
+        assert controller.degraded
+        self.observe(controller, 1, inflight='3')
+        assert not controller.degraded
+
+    def test_zero_interval(self):
+        controller = self.make_controller(interval=0)
+        # Clock does not advance between requests
+        self.observe(controller, 20)
+        assert not controller.degraded
+        self.clock.now += 1
+        self.observe(controller, 1)
+        assert controller.degraded
+
+    def test_sheds(self):
+        controller = self.make_controller()
+        context = RequestContext(EnvironBuilder().get_environ())
+        assert not controller.sheds(context, logging.INFO)
+        controller.degraded = True
+        assert controller.sheds(context, logging.INFO)
+        assert not controller.sheds(context, logging.WARNING)
+
+    def test_sampling(self):
+        controller = self.make_controller(sample_rate=0.5)
+        controller.degraded = True
+        shed = []
+        for i in range(1000):
+            builder = EnvironBuilder(headers={'X-Request-ID': str(i)})
+            context = RequestContext(builder.get_environ())
+            shed.append(controller.sheds(context, logging.INFO))
+            assert controller.sheds(context, logging.DEBUG) == shed[-1]
+        assert 400 < shed.count(True) < 600
+
+    def test_sampling_without_request_id(self):
+        controller = self.make_controller(sample_rate=0.5)
+        controller.degraded = True
+        context = RequestContext(EnvironBuilder().get_environ())
+        shed = [controller.sheds(context, logging.INFO) for i in range(1000)]
+        assert 400 < shed.count(True) < 600
+
+    def test_middleware(self):
+        access_logger = logging.getLogger('test_middleware.load.access')
+        controller = self.make_controller()
+        app = RequestContextMiddleware(LoggingMiddleware(
+            simple_app, access_logger, load_controller=controller))
+        run_app(app)
+        assert len(self.handler.records) == 2
+        controller.degraded = True
+        run_app(app)
+        assert len(self.handler.records) == 2
+        with pytest.raises(ZeroDivisionError):
+            run_app(RequestContextMiddleware(LoggingMiddleware(
+                error_app, access_logger, load_controller=controller)))
+        assert [r.levelno for r in self.handler.records[2:]] == \
+            [logging.ERROR]
+
+
+class TestExceptionLimiter(object):
+    """Tests `ExceptionLimiter` class and its use in `LoggingMiddleware`."""
+
+    def setup_method(self, method):
+        self.handler = HandlerMock()
+        self.logger = logging.getLogger('test_middleware')
+        self.logger.addHandler(self.handler)
+        self.logger.level = logging.DEBUG
+        self.clock = FakeClock()
+        self.limiter = ExceptionLimiter(tracebacks=2, window=10.0,
+                                        clock=self.clock)
+
+    def teardown_method(self, method):
+        self.logger.removeHandler(self.handler)
+
+    def test_fingerprint(self):
+        try:
+            line = sys._getframe().f_lineno + 1
+            1 / 0
+        except ZeroDivisionError:
+            fingerprint = self.limiter.fingerprint(sys.exc_info())
+        assert fingerprint.startswith('ZeroDivisionError at ')
+        assert fingerprint.endswith('test_middleware.py:%s' % line)
+
+    def test_tracebacks_are_limited(self):
+        results = [self.limiter.check('x') for i in range(4)]
+        assert results == [True, True, False, False]
+        # Other fingerprints have their own buckets
+        assert self.limiter.check('y') is True
+
+    def test_tokens_are_refilled(self):
+        for i in range(3):
+            self.limiter.check('x')
+        self.clock.now += 5.0
+        assert self.limiter.check('x') is True
+        assert self.limiter.check('x') is False
+        self.clock.now += 100.0
+        assert self.limiter.check('x') is True
+        assert self.limiter.check('x') is True
+        assert self.limiter.check('x') is False
+
+    def test_summaries(self):
+        for i in range(5):
+            self.limiter.check('x', 'r%s' % i)
+        self.limiter.check('y', 'r5')
+        assert self.limiter.summaries() == []
+        self.clock.now += 9.0
+        assert self.limiter.summaries() == []
+        self.clock.now += 1.0
+        # Summary is due even if no more exceptions come
+        assert self.limiter.summaries() == [('x', 3, 'r4')]
+        assert self.limiter.summaries() == []
+
+    def test_fingerprints_are_limited(self):
+        limiter = ExceptionLimiter(max_fingerprints=2)
+        for fingerprint in 'abc':
+            limiter.check(fingerprint)
+        assert len(limiter._buckets) == 2
+
+    def test_middleware_limits_tracebacks(self):
+        app = RequestContextMiddleware(LoggingMiddleware(
+            error_app, self.logger, exception_limiter=self.limiter))
+        for i in range(5):
+            with pytest.raises(ZeroDivisionError):
+                run_app(app, headers={'X-Request-ID': 'r%s' % i})
+        exceptions = [r for r in self.handler.records
+                      if r.levelno == logging.ERROR]
+        assert len(exceptions) == 5
+        assert all(r.exc_info for r in exceptions[:2])
+        for i, record in enumerate(exceptions[2:], 2):
+            assert record.exc_info is None
+            assert ', request r%s, traceback of ZeroDivisionError at ' % i \
+                in record.msg
+        self.clock.now += 10.0
+        # Summary is logged by the next request
+        with pytest.raises(ZeroDivisionError):
+            run_app(app, headers={'X-Request-ID': 'r5'})
+        summary = [r for r in self.handler.records
+                   if r.msg.startswith('Suppressed ')]
+        assert len(summary) == 1
+        assert summary[0].exc_info is None
+        assert summary[0].msg.startswith('Suppressed 3 tracebacks of '
+                                         'ZeroDivisionError at ')
+        assert summary[0].msg.endswith(', last in request r4')
+
+
 class TestRequestContextMiddleware(object):
     """Tests `RequestContextMiddleware` class."""
 
@@ -119,6 +566,140 @@ class TestRequestContextMiddleware(object):
             run_app(app, '/')
         assert RequestContext.get() is None
 
+    def test_greenlet_storage_is_selected(self, monkeypatch):
+        storage = RequestContext._local
+        monkey = types.ModuleType('gevent.monkey')
+        monkey.is_module_patched = lambda name: True
+        greenlet = types.ModuleType('greenlet')
+        greenlet.getcurrent = lambda: monkey
+        monkeypatch.setitem(sys.modules, 'gevent.monkey', monkey)
+        monkeypatch.setitem(sys.modules, 'greenlet', greenlet)
+        try:
+            app = RequestContextMiddleware(simple_app)
+            assert isinstance(RequestContext._local, GreenletLocal)
+            response = run_app(app, '/')
+            assert response.status_code == 200
+            assert RequestContext.get() is None
+        finally:
+            RequestContext.set_storage(storage)
+
+    def test_context_is_set_during_iteration(self):
+        contexts = []
+        class Body(object):
+            def __iter__(self):
+                contexts.append(RequestContext.get())
+                yield b'Hello'
+                contexts.append(RequestContext.get())
+            def close(self):
+                contexts.append(RequestContext.get())
+        @RequestContextMiddleware
+        def app(environ, start_response):
+            contexts.append(environ['kudzu.context'])
+            start_response('200 OK', [])
+            return Body()
+        response = call_app(app)
+        assert RequestContext.get() is None
+        assert list(response) == [b'Hello']
+        assert RequestContext.get() is None
+        response.close()
+        assert RequestContext.get() is None
+        assert contexts == [contexts[0]] * 4
+        assert contexts[0].log_vars['bsent'] == '5'
+
+    def test_trusted_proxies(self):
+        addrs = []
+        def app(environ, start_response):
+            addrs.append(environ['kudzu.context'].remote_addr)
+            start_response('200 OK', [])
+            return [b'']
+        app = RequestContextMiddleware(app, trusted_proxies=['10.0.0.0/8'])
+        run_app(app, headers={'X-Forwarded-For': '1.2.3.4'},
+                environ_base={'REMOTE_ADDR': '10.0.0.1'})
+        assert addrs == ['1.2.3.4']
+
+    @pytest.mark.skipif(tracemalloc is None, reason='requires tracemalloc')
+    def test_memory_tracking(self):
+        contexts = []
+        def app(environ, start_response):
+            contexts.append(environ['kudzu.context'])
+            return generator_app(environ, start_response)
+        app = RequestContextMiddleware(app, track_memory=True, alloc_rate=1)
+        response = call_app(app)
+        assert tracemalloc.is_tracing()
+        assert list(response) == [b'Hello ', b'world!']
+        response.close()
+        assert not tracemalloc.is_tracing()
+        log_vars = contexts[0].log_vars
+        assert log_vars['mem_kb'].lstrip('-').isdigit()
+        assert log_vars['alloc_kb'].lstrip('-').isdigit()
+
+    @pytest.mark.skipif(tracemalloc is None, reason='requires tracemalloc')
+    def test_concurrent_memory_tracking(self):
+        contexts = []
+        def app(environ, start_response):
+            contexts.append(environ['kudzu.context'])
+            return generator_app(environ, start_response)
+        sampled = RequestContextMiddleware(app, alloc_rate=1)
+        unsampled = RequestContextMiddleware(app, track_memory=True)
+        response1 = call_app(sampled)
+        response2 = call_app(sampled)
+        response3 = call_app(unsampled)
+        response1.close()
+        # Tracing is kept while any sampled request is in progress
+        assert tracemalloc.is_tracing()
+        data = [object() for i in range(10000)]
+        response2.close()
+        response3.close()
+        assert not tracemalloc.is_tracing()
+        assert int(contexts[1].get_log_var('alloc_kb')) >= 100
+        # Tracing may stop during unsampled requests
+        assert contexts[2].get_log_var('alloc_kb') == '-'
+        del data
+
+    @pytest.mark.skipif(tracemalloc is None, reason='requires tracemalloc')
+    def test_memory_tracking_error(self):
+        app = RequestContextMiddleware(error_app, alloc_rate=1)
+        with pytest.raises(ZeroDivisionError):
+            call_app(app)
+        assert not tracemalloc.is_tracing()
+
+    def test_file_wrapper_is_not_wrapped(self):
+        class FileWrapper(object):
+            def __init__(self, filelike, block_size=8192):
+                self.filelike = filelike
+        @RequestContextMiddleware
+        def app(environ, start_response):
+            start_response('200 OK', [])
+            return environ['wsgi.file_wrapper'](None)
+        response = call_app(app, environ_base={
+            'wsgi.file_wrapper': FileWrapper})
+        assert isinstance(response, FileWrapper)
+
+    def test_file_wrapper_function_is_not_wrapped(self, tmpdir):
+        responses = []
+        def file_wrapper(filelike, block_size=8192):
+            responses.append(iter([b'']))
+            return responses[-1]
+        def app(environ, start_response):
+            start_response('200 OK', [])
+            return environ['wsgi.file_wrapper'](None)
+        app = RequestContextMiddleware(LoggingMiddleware(
+            ProfilingMiddleware(app, str(tmpdir), rate=1)))
+        response = call_app(app, environ_base={
+            'wsgi.file_wrapper': file_wrapper})
+        assert response is responses[0]
+
+    def test_response_length_is_forwarded(self, tmpdir):
+        app = RequestContextMiddleware(LoggingMiddleware(
+            ProfilingMiddleware(simple_app, str(tmpdir), rate=1)))
+        response = call_app(app)
+        assert len(response) == 1
+        response.close()
+        app = RequestContextMiddleware(LoggingMiddleware(generator_app))
+        response = call_app(app)
+        assert not hasattr(response, '__len__')
+        response.close()
+
     def test_context_is_set_during_request(self):
         @RequestContextMiddleware
         def app(environ, start_response):
@@ -134,6 +715,38 @@ class TestRequestContextMiddleware(object):
         with pytest.raises(RuntimeError):
             run_app(app, '/')
 
+    def test_response_headers_are_set(self):
+        contexts = []
+        def test_app(environ, start_response):
+            contexts.append(environ['kudzu.context'])
+            extra_headers = [('x-cache', 'HIT'), ('X-CACHE', 'MISS')]
+            return simple_app(environ, start_response,
+                              extra_headers=extra_headers)
+        app = RequestContextMiddleware(test_app, response_headers=['X-Cache'])
+        run_app(app, '/')
+        context = contexts[0]
+        assert context.log_vars['rsize'] == '13'
+        assert context.log_vars['ctype'] == 'text/plain'
+        assert context.response_headers['x-cache'] == ['HIT', 'MISS']
+        assert 'x-request-id' not in context.response_headers
+
+
+class TestHeaderScanner(object):
+    """Tests `HeaderScanner` class."""
+
+    def test_headers_are_scanned(self):
+        scanner = HeaderScanner(['Content-Length', 'X-Request-ID'])
+        headers = [('Content-length', '1'), ('CONTENT-TYPE', 'text/plain'),
+                   ('x-request-id', 'a'), ('X-ReQuEsT-Id', 'b'),
+                   ('Content-Lengths', '3'), ('Cache-Control', 'no-cache')]
+        rv = scanner.scan(headers)
+        assert rv == {'content-length': ['1'], 'x-request-id': ['a', 'b']}
+        assert rv.is_scan_of(headers, 'x-request-id')
+        assert not rv.is_scan_of(headers, 'content-type')
+        assert not rv.is_scan_of(list(headers), 'x-request-id')
+        headers.append(('X-Request-ID', 'c'))
+        assert not rv.is_scan_of(headers, 'x-request-id')
+
 
 class TestRequestIDMiddleware(object):
     """Tests `RequestIDMiddleware` class."""
@@ -213,6 +826,16 @@ class TestRequestIDMiddleware(object):
         assert response.status_code == 200
         assert len(response.headers.getlist('X-Request-ID')) == 1
 
+    def test_request_id_is_sent_only_once_wo_context(self):
+        def test_app(environ, start_response):
+            extra_headers = [('x-request-id', environ['HTTP_X_REQUEST_ID'])]
+            return simple_app(environ, start_response,
+                              extra_headers=extra_headers)
+        app = RequestIDMiddleware(test_app)
+        response = run_app(app)
+        assert response.status_code == 200
+        assert len(response.headers.getlist('X-Request-ID')) == 1
+
     def test_request_id_is_sent_twice_if_different(self):
         def test_app(environ, start_response):
             extra_headers = [('X-Request-ID', 'xxx')]
@@ -224,6 +847,90 @@ class TestRequestIDMiddleware(object):
         assert len(response.headers.getlist('X-Request-ID')) == 2
 
 
+class TestProfilingMiddleware(object):
+    """Tests `ProfilingMiddleware` class."""
+
+    rid = '00000000-0000-0000-0000-000000000001'
+
+    def run_profiled(self, app, **kwargs):
+        kwargs.setdefault('headers', {'X-Request-ID': self.rid})
+        response = call_app(RequestContextMiddleware(app), **kwargs)
+        assert b''.join(response) == b'Hello world!'
+        response.close()
+
+    def test_not_selected(self, tmpdir):
+        app = ProfilingMiddleware(generator_app, str(tmpdir), rate=0)
+        self.run_profiled(app)
+        assert tmpdir.listdir() == []
+
+    def test_sampled(self, tmpdir):
+        app = ProfilingMiddleware(generator_app, str(tmpdir), rate=1)
+        self.run_profiled(app)
+        profiles = tmpdir.listdir()
+        assert len(profiles) == 1
+        assert profiles[0].basename.startswith(self.rid + '-')
+        assert profiles[0].basename.endswith('.prof')
+        stats = pstats.Stats(str(profiles[0]))
+        functions = [key[2] for key in stats.stats]
+        assert 'generator_app' in functions
+
+    def test_trigger_header(self, tmpdir):
+        app = ProfilingMiddleware(generator_app, str(tmpdir), rate=0,
+                                  trigger_header='X-Profile')
+        self.run_profiled(app)
+        assert tmpdir.listdir() == []
+        self.run_profiled(app, headers={'X-Request-ID': 'a/b',
+                                        'X-Profile': '1'})
+        profiles = tmpdir.listdir()
+        assert len(profiles) == 1
+        assert profiles[0].basename.startswith('a_b-')
+
+    def test_exception(self, tmpdir):
+        app = ProfilingMiddleware(error_app, str(tmpdir), rate=1)
+        with pytest.raises(ZeroDivisionError):
+            run_app(app)
+        profiles = tmpdir.listdir()
+        assert len(profiles) == 1
+        assert profiles[0].basename.startswith('unknown-')
+
+    def test_rotation(self, tmpdir):
+        app = ProfilingMiddleware(generator_app, str(tmpdir), rate=1,
+                                  max_size=1)
+        tmpdir.join('other.txt').write('foo')
+        old = tmpdir.join('old.prof')
+        old.write('foo')
+        old.setmtime(old.mtime() - 10)
+        self.run_profiled(app)
+        names = sorted(p.basename for p in tmpdir.listdir())
+        assert len(names) == 2
+        assert names[0].startswith(self.rid)
+        assert names[1] == 'other.txt'
+
+    def test_save_errors_are_logged(self, tmpdir):
+        handler = HandlerMock()
+        logger = logging.getLogger('test_middleware.profiling')
+        logger.addHandler(handler)
+        try:
+            app = ProfilingMiddleware(generator_app, str(tmpdir), rate=1,
+                                      logger=logger)
+            error = ProfilingMiddleware(error_app, str(tmpdir), rate=1,
+                                        logger=logger)
+            tmpdir.remove()
+            self.run_profiled(app)
+            with pytest.raises(ZeroDivisionError):
+                run_app(error)
+        finally:
+            logger.removeHandler(handler)
+        assert len(handler.records) == 2
+        assert all(r.exc_info for r in handler.records)
+
+    def test_another_profiler_active(self, tmpdir):
+        app = ProfilingMiddleware(generator_app, str(tmpdir), rate=1)
+        app = ProfilingMiddleware(app, str(tmpdir.join('outer')), rate=1)
+        self.run_profiled(app)
+        assert len(tmpdir.join('outer').listdir()) == 1
+
+
 class TestKudzifyApp(object):
     """Tests `kudzify_app` function"""
 
@@ -243,3 +950,85 @@ class TestKudzifyApp(object):
         assert response.status_code == 200
         assert len(self.handler.records) == 2
         assert 'X-Request-ID' in response.headers
+
+    def teardown_method(self, method):
+        enable()
+        self.logger.removeHandler(self.handler)
+
+    def test_disabled(self):
+        environs = []
+        def test_app(environ, start_response):
+            environs.append(environ)
+            return simple_app(environ, start_response)
+        app = kudzify_app(test_app, logger=self.logger)
+        disable()
+        assert not is_enabled()
+        response = run_app(app)
+        assert response.status_code == 200
+        assert 'X-Request-ID' not in response.headers
+        assert 'kudzu.context' not in environs[0]
+        assert self.handler.records == []
+        enable()
+        run_app(app)
+        assert 'kudzu.context' in environs[1]
+        assert len(self.handler.records) == 2
+
+    @pytest.mark.skipif(not hasattr(signal, 'SIGUSR2'),
+                        reason='requires SIGUSR2')
+    def test_signal_toggle(self):
+        previous = install_signal_toggle()
+        try:
+            os.kill(os.getpid(), signal.SIGUSR2)
+            assert not is_enabled()
+            os.kill(os.getpid(), signal.SIGUSR2)
+            assert is_enabled()
+        finally:
+            signal.signal(signal.SIGUSR2, previous)
+
+
+class TestLoggingConfiguration(object):
+    """Tests runtime configuration of `LoggingMiddleware`."""
+
+    def setup_method(self, method):
+        self.handler = HandlerMock()
+        self.logger = logging.getLogger('test_middleware')
+        self.logger.addHandler(self.handler)
+        self.logger.setLevel(logging.INFO)
+        self.app = LoggingMiddleware(simple_app, logger=self.logger)
+
+    def teardown_method(self, method):
+        self.logger.removeHandler(self.handler)
+        self.logger.setLevel(logging.NOTSET)
+
+    def test_configure(self):
+        self.app.configure(level='debug')
+        run_app(RequestContextMiddleware(self.app))
+        assert self.handler.records == []
+        self.app.configure(level=logging.INFO, response_format='%(status)s')
+        run_app(RequestContextMiddleware(self.app))
+        assert self.handler.records[-1].getMessage() == '200'
+
+    def test_configure_rules(self):
+        self.app.configure(rules=[LoggingRule('/', exclude=True)])
+        run_app(RequestContextMiddleware(self.app))
+        assert self.handler.records == []
+        self.app.configure(rules=())
+        run_app(RequestContextMiddleware(self.app))
+        assert len(self.handler.records) == 2
+
+    def test_configure_invalid(self):
+        with pytest.raises(TypeError):
+            self.app.configure(app=None)
+        with pytest.raises(ValueError):
+            self.app.configure(level='foo')
+
+    def test_configure_logging(self):
+        assert self.app in LoggingMiddleware.instances.values()
+        configure_logging(level=logging.WARNING)
+        try:
+            assert self.app.level == logging.WARNING
+            run_app(RequestContextMiddleware(self.app))
+            assert [r.levelno for r in self.handler.records] == \
+                [logging.WARNING] * 2
+        finally:
+            configure_logging(level=logging.INFO)
@@ -0,0 +1,134 @@
+
+from __future__ import absolute_import
+
+import pytest
+from werkzeug.test import EnvironBuilder
+
+from kudzu import RequestContext, TrustedProxies
+from kudzu.proxy import parse_forwarded
+
+
+class TestTrustedProxies(object):
+    """Tests `TrustedProxies` class."""
+
+    def test_ipv4_networks(self):
+        proxies = TrustedProxies(['10.0.0.0/8', '192.168.1.1'])
+        assert '10.1.2.3' in proxies
+        assert '10.255.255.255' in proxies
+        assert '11.0.0.0' not in proxies
+        assert '192.168.1.1' in proxies
+        assert '192.168.1.2' not in proxies
+        assert '9.255.255.255' not in proxies
+
+    def test_ipv6_networks(self):
+        proxies = TrustedProxies(['2001:db8::/32', '::1'])
+        assert '2001:db8::17' in proxies
+        assert '2001:db9::' not in proxies
+        assert '::1' in proxies
+        assert '::2' not in proxies
+        assert '10.0.0.1' not in proxies
+
+    def test_mapped_ipv4(self):
+        proxies = TrustedProxies(['10.0.0.0/8', '::ffff:172.16.0.0/108'])
+        assert '::ffff:10.0.0.1' in proxies
+        assert '172.16.5.5' in proxies
+        assert '172.32.0.0' not in proxies
+
+    def test_merged_ranges(self):
+        proxies = TrustedProxies(['10.0.0.0/24', '10.0.1.0/24',
+                                  '10.0.0.128/25'])
+        assert proxies._tables[4][0] == [0x0a000000]
+        assert '10.0.1.255' in proxies
+        assert '10.0.2.0' not in proxies
+
+    def test_invalid_address(self):
+        proxies = TrustedProxies(['0.0.0.0/0'])
+        assert 'unknown' not in proxies
+        assert '' not in proxies
+
+    @pytest.mark.parametrize('network', ['foo', '10.0.0.0/33', '::/129'])
+    def test_invalid_network(self, network):
+        with pytest.raises(ValueError):
+            TrustedProxies([network])
+
+    def test_resolve_untrusted_remote(self):
+        proxies = TrustedProxies(['10.0.0.0/8'])
+        assert proxies.resolve('1.2.3.4', None, '5.6.7.8') == '1.2.3.4'
+
+    def test_resolve_forwarded_for(self):
+        proxies = TrustedProxies(['10.0.0.0/8'])
+        assert proxies.resolve('10.0.0.1', None,
+                               '6.6.6.6, 1.2.3.4, 10.0.0.2') == '1.2.3.4'
+
+    def test_resolve_all_trusted(self):
+        proxies = TrustedProxies(['10.0.0.0/8'])
+        assert proxies.resolve('10.0.0.1', None,
+                               '10.0.0.3, 10.0.0.2') == '10.0.0.3'
+
+    def test_resolve_empty_hop(self):
+        proxies = TrustedProxies(['10.0.0.0/8'])
+        assert proxies.resolve('10.0.0.1', None, ', 10.0.0.2') == '10.0.0.2'
+
+    def test_resolve_forwarded(self):
+        proxies = TrustedProxies(['10.0.0.0/8'])
+        header = 'for=1.2.3.4;proto=http, For="[2001:db8::17]:4711"'
+        assert proxies.resolve('10.0.0.1', header, '6.6.6.6') == \
+            '2001:db8::17'
+
+    def test_parse_forwarded(self):
+        header = 'for=1.2.3.4:80;by=10.0.0.1, proto=https, for=unknown'
+        assert parse_forwarded(header) == ['1.2.3.4', '', 'unknown']
+
+
+class TestRequestContextProxies(object):
+    """Tests resolution of remote address in `RequestContext`."""
+
+    def make_context(self, headers, remote_addr='10.0.0.1'):
+        builder = EnvironBuilder(headers=headers,
+                                 environ_base={'REMOTE_ADDR': remote_addr})
+        proxies = TrustedProxies(['10.0.0.0/8'])
+        return RequestContext(builder.get_environ(), proxies)
+
+    def test_lazy_resolution(self):
+        context = self.make_context({'X-Forwarded-For': '1.2.3.4'})
+        assert context._forwarded is not None
+        assert context._log_vars['addr'] == '10.0.0.1'
+        assert context.remote_addr == '1.2.3.4'
+        assert context._forwarded is None
+
+    def test_address_is_set_before_headers_are_cleared(self):
+        context = self.make_context({'X-Forwarded-For': '1.2.3.4'})
+        seen = []
+        class Proxies(object):
+            def resolve(self, *args):
+                # Another thread reading the context during resolution
+                seen.append(context._forwarded)
+                return '1.2.3.4'
+        context._forwarded = (Proxies(),) + context._forwarded[1:]
+        assert context.remote_addr == '1.2.3.4'
+        assert seen[0] is not None
+        assert context._forwarded is None
+
+    def test_log_vars(self):
+        context = self.make_context({'X-Forwarded-For': '1.2.3.4'})
+        assert context.log_vars['addr'] == '1.2.3.4'
+
+    def test_get_log_var(self):
+        context = self.make_context({'Forwarded': 'for=1.2.3.4'})
+        assert context.get_log_var('addr') == '1.2.3.4'
+
+    def test_no_headers(self):
+        context = self.make_context({})
+        assert context._forwarded is None
+        assert context.remote_addr == '10.0.0.1'
+
+    def test_untrusted_remote(self):
+        context = self.make_context({'X-Forwarded-For': '1.2.3.4'},
+                                    remote_addr='5.6.7.8')
+        assert context.remote_addr == '5.6.7.8'
+
+    def test_without_proxies(self):
+        builder = EnvironBuilder(headers={'X-Forwarded-For': '1.2.3.4'},
+                                 environ_base={'REMOTE_ADDR': '10.0.0.1'})
+        context = RequestContext(builder.get_environ())
+        assert context.remote_addr == '10.0.0.1'
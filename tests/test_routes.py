@@ -0,0 +1,67 @@
+
+from __future__ import absolute_import
+
+import pytest
+from werkzeug.test import EnvironBuilder
+
+from kudzu import RequestContextMiddleware
+from kudzu.routes import RouteNormalizer
+
+
+class TestRouteNormalizer(object):
+    """Tests `RouteNormalizer` class."""
+
+    @pytest.mark.parametrize('path,route', [
+        ('/', '/'),
+        ('', ''),
+        ('/users/42/orders', '/users/{id}/orders'),
+        ('/users/42/orders/7/', '/users/{id}/orders/{id}/'),
+        ('/items/0f8fad5b-d9cb-469f-a165-70867728950e',
+         '/items/{uuid}'),
+        ('/items/0F8FAD5BD9CB469FA16570867728950E', '/items/{uuid}'),
+        ('/commits/3f786850e387550fdab836ed7e6dc881de23001b',
+         '/commits/{hex}'),
+        ('/v2/api', '/v2/api'),
+        ('/beef', '/beef'),
+        ('/users/42abc', '/users/42abc'),
+    ])
+    def test_default_patterns(self, path, route):
+        assert RouteNormalizer().normalize(path) == route
+
+    def test_custom_patterns(self):
+        normalizer = RouteNormalizer([(r'[a-z]+-[0-9]+', '{slug}'),
+                                      (r'[0-9]+', '{n}')])
+        assert normalizer.normalize('/posts/hello-1/2') == \
+            '/posts/{slug}/{n}'
+
+    def test_cache(self):
+        normalizer = RouteNormalizer(cache_size=2)
+        normalizer.normalize('/a/1')
+        normalizer.normalize('/b/2')
+        assert normalizer.normalize('/a/1') == '/a/{id}'
+        normalizer.normalize('/c/3')
+        assert list(normalizer._cache) == ['/a/1', '/c/3']
+
+
+class TestRouteContextVar(object):
+    """Tests `route` variable set by `RequestContextMiddleware`."""
+
+    def run_app(self, **kwargs):
+        contexts = []
+        def app(environ, start_response):
+            contexts.append(environ['kudzu.context'])
+            start_response('200 OK', [])
+            return [b'']
+        app = RequestContextMiddleware(app, **kwargs)
+        environ = EnvironBuilder('/users/42?page=3',
+                                 base_url='http://localhost/app'
+                                 ).get_environ()
+        app(environ, lambda *args: None).close()
+        return contexts[0].log_vars
+
+    def test_route(self):
+        log_vars = self.run_app(route_normalizer=RouteNormalizer())
+        assert log_vars['route'] == '/app/users/{id}'
+
+    def test_without_normalizer(self):
+        assert self.run_app()['route'] == '-'
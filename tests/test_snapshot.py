@@ -0,0 +1,73 @@
+
+from __future__ import absolute_import
+
+import pytest
+from werkzeug.test import EnvironBuilder
+
+from kudzu import get_request_id, RequestContext
+from kudzu.snapshot import dumps, loads, restore_snapshot, take_snapshot
+
+
+@pytest.fixture
+def context():
+    builder = EnvironBuilder(path='/foo', headers={'X-Request-ID': 'abc'},
+                             environ_base={'REMOTE_ADDR': '1.2.3.4'})
+    context = RequestContext(builder.get_environ())
+    context.push()
+    yield context
+    RequestContext.reset()
+
+
+class TestSnapshot(object):
+    """Tests snapshots of request context."""
+
+    def test_without_context(self):
+        assert take_snapshot() is None
+
+    def test_take_snapshot(self, context):
+        assert take_snapshot() == {
+            'rid': 'abc', 'addr': '1.2.3.4', 'uri': '/foo',
+            'method': 'GET', 'host': 'localhost',
+        }
+
+    def test_unknown_vars_omitted(self, context):
+        assert take_snapshot(keys=['rid', 'status']) == {'rid': 'abc'}
+
+    def test_explicit_context(self, context):
+        RequestContext.reset()
+        assert take_snapshot(context, keys=['rid']) == {'rid': 'abc'}
+
+    def test_restore(self, context):
+        snapshot = take_snapshot()
+        RequestContext.reset()
+        with restore_snapshot(snapshot) as restored:
+            assert get_request_id() == 'abc'
+            assert restored.remote_addr == '1.2.3.4'
+            log_vars = restored.log_vars
+            assert log_vars['uri'] == '/foo'
+            assert log_vars['status'] == '-'
+            assert log_vars['msecs'] == '0'
+        assert RequestContext.get() is None
+
+    def test_restore_bytes(self, context):
+        data = dumps(take_snapshot(keys=['rid', 'uri']))
+        assert data == b'{"rid":"abc","uri":"/foo"}'
+        restored = restore_snapshot(data)
+        assert restored.request_id == 'abc'
+
+    def test_restore_none(self):
+        restored = restore_snapshot(None)
+        assert restored.request_id is None
+        assert restored.remote_addr is None
+
+    def test_restore_ignores_unknown_vars(self):
+        restored = restore_snapshot({'rid': 'abc', 'foo': 'bar',
+                                     'msecs': '100'})
+        assert 'foo' not in restored.log_vars
+        assert restored.log_vars['msecs'] == '0'
+
+    def test_loads_invalid(self):
+        with pytest.raises(ValueError):
+            loads(b'[1, 2]')
+        with pytest.raises(ValueError):
+            loads(b'{')
@@ -0,0 +1,313 @@
+"""Stress tests of request context propagation under concurrency.
+
+Requests are executed by many threads at once through `kudzify_app`
+and every log record is checked to carry ID of the request which
+logged it. These tests validate changes of context storage.
+"""
+
+from __future__ import absolute_import
+
+import collections
+import logging
+import time
+import uuid
+
+try:
+    import threading
+except ImportError:
+    import dummy_threading as threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from werkzeug.test import EnvironBuilder
+
+from kudzu import get_request_id, kudzify_app, RequestContext
+from kudzu.logging import RequestContextFormatter
+from kudzu.threads import ContextExecutor
+
+
+REQUESTS = 2000
+THREADS = 16
+
+
+class RecordingHandler(logging.Handler):
+    """Thread-safe handler which formats records when they are emitted."""
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.setFormatter(RequestContextFormatter('%(rid)s %(message)s'))
+        self.lines = []
+
+    def emit(self, record):
+        # list.append is atomic, formatting must happen in the logging thread
+        self.lines.append(self.format(record))
+
+    def by_request(self):
+        """Returns messages grouped by request ID of their records."""
+        rv = collections.defaultdict(list)
+        for line in self.lines:
+            rid, message = line.split(' ', 1)
+            rv[rid].append(message)
+        return rv
+
+
+def make_environ(rid, path='/'):
+    builder = EnvironBuilder(path=path, headers={'X-Request-ID': rid})
+    return builder.get_environ()
+
+
+def make_rids(count=REQUESTS):
+    return [str(uuid.UUID(int=i + 1)) for i in range(count)]
+
+
+def consume(app, environ):
+    """Executes WSGI application and returns the response body."""
+    response = app(environ, lambda status, headers, exc_info=None: None)
+    try:
+        return b''.join(response)
+    finally:
+        response.close()
+
+
+class TestStress(object):
+    """Runs many concurrent requests through `kudzify_app`."""
+
+    def setup_method(self, method):
+        RequestContext.reset()
+        self.handler = RecordingHandler()
+        self.logger = logging.getLogger('test_stress')
+        self.logger.addHandler(self.handler)
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+
+    def teardown_method(self, method):
+        self.logger.removeHandler(self.handler)
+        self.logger.setLevel(logging.NOTSET)
+        self.logger.propagate = True
+        RequestContext.reset()
+
+    def kudzify(self, app):
+        return kudzify_app(app, logger=self.logger.getChild('wsgi'))
+
+    def app(self, environ, start_response):
+        """Logs request ID seen by the application several times."""
+        logger = self.logger
+        logger.info('app %s', get_request_id())
+        time.sleep(0)  # Let other threads run
+        logger.info('app %s', get_request_id())
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [get_request_id().encode('ascii')]
+
+    def check_records(self, rids, messages_per_request):
+        by_request = self.handler.by_request()
+        assert set(by_request) == set(rids)
+        for rid in rids:
+            messages = by_request[rid]
+            assert len(messages) == messages_per_request, rid
+            for message in messages:
+                if message.startswith('app '):
+                    assert message == 'app %s' % rid
+
+    def test_thread_pool(self):
+        app = self.kudzify(self.app)
+        rids = make_rids()
+        with ThreadPoolExecutor(THREADS) as executor:
+            bodies = list(executor.map(
+                lambda rid: consume(app, make_environ(rid)), rids))
+        assert bodies == [rid.encode('ascii') for rid in rids]
+        # Request, two application messages and response
+        self.check_records(rids, 4)
+        assert RequestContext.get() is None
+
+    def test_nested_contexts(self):
+        logger = self.logger
+
+        def app(environ, start_response):
+            rid = get_request_id()
+            # Internal redirect executed with its own context
+            inner_rid = 'inner-%s' % rid
+            with RequestContext(make_environ(inner_rid, '/inner')):
+                logger.info('app %s', get_request_id())
+                with RequestContext(make_environ('deep-%s' % rid)):
+                    logger.info('app %s', get_request_id())
+                logger.info('app %s', get_request_id())
+            logger.info('app %s', get_request_id())
+            start_response('200 OK', [])
+            return [b'']
+
+        app = self.kudzify(app)
+        rids = make_rids(REQUESTS // 2)
+        with ThreadPoolExecutor(THREADS) as executor:
+            list(executor.map(lambda rid: consume(app, make_environ(rid)),
+                              rids))
+        by_request = self.handler.by_request()
+        for rid in rids:
+            assert by_request[rid][1:-1] == ['app %s' % rid]
+            assert by_request['inner-%s' % rid] == ['app inner-%s' % rid] * 2
+            assert by_request['deep-%s' % rid] == ['app deep-%s' % rid]
+
+    def test_interleaved_generators(self):
+        logger = self.logger
+
+        def app(environ, start_response):
+            start_response('200 OK', [])
+            for i in range(3):
+                logger.info('app %s', get_request_id())
+                yield b'x'
+
+        app = self.kudzify(app)
+        rids = make_rids()
+
+        def run_batch(batch):
+            # One thread iterates several responses alternately
+            responses = [app(make_environ(rid), lambda *args: None)
+                         for rid in batch]
+            iterators = [iter(response) for response in responses]
+            for __ in range(3):
+                for iterator in iterators:
+                    assert next(iterator) == b'x'
+                    assert RequestContext.get() is None
+            for response in responses:
+                assert list(response) == []
+                response.close()
+
+        batches = [rids[i:i + 10] for i in range(0, len(rids), 10)]
+        with ThreadPoolExecutor(THREADS) as executor:
+            list(executor.map(run_batch, batches))
+        self.check_records(rids, 5)
+
+    def test_asyncio_executor(self):
+        asyncio = pytest.importorskip('asyncio')
+        app = self.kudzify(self.app)
+        rids = make_rids()
+        loop = asyncio.new_event_loop()
+        try:
+            with ThreadPoolExecutor(THREADS) as executor:
+                futures = [loop.run_in_executor(executor, consume, app,
+                                                make_environ(rid))
+                           for rid in rids]
+                bodies = loop.run_until_complete(asyncio.gather(*futures))
+        finally:
+            loop.close()
+        assert bodies == [rid.encode('ascii') for rid in rids]
+        self.check_records(rids, 4)
+
+    @pytest.mark.xfail(strict=True, reason='Context stacks are local to '
+                       'threads or greenlets, not to asyncio tasks')
+    def test_asyncio_tasks(self):
+        asyncio = pytest.importorskip('asyncio')
+        logger = self.logger
+
+        class Request(object):
+            """Awaitable which keeps a context pushed across suspensions."""
+
+            def __init__(self, rid):
+                self.rid = rid
+
+            def __await__(self):
+                with RequestContext(make_environ(self.rid)):
+                    logger.info('app %s', get_request_id())
+                    yield  # Let other tasks run, like asyncio.sleep(0)
+                    logger.info('app %s', get_request_id())
+
+        rids = make_rids(REQUESTS // 4)
+        loop = asyncio.new_event_loop()
+        try:
+            tasks = [asyncio.ensure_future(Request(rid), loop=loop)
+                     for rid in rids]
+            loop.run_until_complete(asyncio.gather(*tasks))
+        finally:
+            loop.close()
+        self.check_records(rids, 2)
+
+    def test_background_work(self):
+        asyncio = pytest.importorskip('asyncio')
+        logger = self.logger
+        pool = ThreadPoolExecutor(THREADS)
+
+        def work():
+            logger.info('app %s', get_request_id())
+
+        def app(environ, start_response):
+            # Work offloaded from a request to a shared pool by an event loop
+            loop = asyncio.new_event_loop()
+            try:
+                executor = ContextExecutor(pool)
+                futures = [loop.run_in_executor(executor, work)
+                           for __ in range(3)]
+                loop.run_until_complete(asyncio.gather(*futures))
+            finally:
+                loop.close()
+            start_response('200 OK', [])
+            return [b'']
+
+        app = self.kudzify(app)
+        rids = make_rids(REQUESTS // 4)
+        try:
+            with ThreadPoolExecutor(THREADS) as executor:
+                list(executor.map(
+                    lambda rid: consume(app, make_environ(rid)), rids))
+        finally:
+            pool.shutdown()
+        self.check_records(rids, 5)
+
+
+@pytest.mark.benchmark
+class TestScaling(object):
+    """Measures throughput of `kudzify_app` with increasing threads.
+
+    Timing depends on the machine, run with `--benchmark`.
+    """
+
+    thread_counts = (1, 2, 4, 8)
+
+    def setup_method(self, method):
+        self.logger = logging.getLogger('test_stress.scaling')
+        self.logger.addHandler(logging.NullHandler())
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+
+    def teardown_method(self, method):
+        self.logger.handlers = []
+        self.logger.setLevel(logging.NOTSET)
+        self.logger.propagate = True
+
+    def measure(self, app, threads, requests):
+        """Returns requests per second and request IDs seen by the app."""
+        environs = [make_environ(rid) for rid in make_rids(requests)]
+        barrier = threading.Event()
+
+        def run(chunk):
+            barrier.wait()
+            return [consume(app, environ) for environ in chunk]
+
+        chunks = [environs[i::threads] for i in range(threads)]
+        with ThreadPoolExecutor(threads) as executor:
+            results = [executor.submit(run, chunk) for chunk in chunks]
+            start = time.time()
+            barrier.set()
+            bodies = [body for result in results for body in result.result()]
+        elapsed = time.time() - start
+        expected = [environ['HTTP_X_REQUEST_ID'].encode('ascii')
+                    for chunk in chunks for environ in chunk]
+        assert bodies == expected
+        return requests / elapsed
+
+    def test_scaling(self, capsys):
+        def app(environ, start_response):
+            self.logger.info('app')
+            start_response('200 OK', [])
+            return [get_request_id().encode('ascii')]
+
+        app = kudzify_app(app, logger=self.logger)
+        throughputs = [self.measure(app, threads, REQUESTS)
+                       for threads in self.thread_counts]
+        with capsys.disabled():
+            print('\nThroughput: %s' % ', '.join(
+                '%s threads %d req/s' % (threads, throughput)
+                for threads, throughput in zip(self.thread_counts,
+                                               throughputs)))
+        # Throughput is bounded by the GIL, but contention of context
+        # storage must not make it collapse
+        assert min(throughputs) > throughputs[0] * 0.2
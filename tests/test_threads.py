@@ -0,0 +1,125 @@
+
+from __future__ import absolute_import
+
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from werkzeug.test import EnvironBuilder
+
+from kudzu import get_request_id, RequestContext
+from kudzu.threads import bind_context, ContextExecutor, ContextThread
+
+
+def make_context(request_id='xyz'):
+    builder = EnvironBuilder(headers={'X-Request-ID': request_id})
+    return RequestContext(builder.get_environ())
+
+
+class TestBindContext(object):
+    """Tests `bind_context` function."""
+
+    def setup_method(self, method):
+        RequestContext.reset()
+
+    def teardown_method(self, method):
+        RequestContext.reset()
+
+    def test_func_is_not_wrapped_wo_context(self):
+        assert bind_context(get_request_id) is get_request_id
+
+    def test_context_is_pushed(self):
+        with make_context() as context:
+            func = bind_context(RequestContext.get)
+        assert func() is context
+        assert RequestContext.get() is None
+
+    def test_given_context_is_pushed(self):
+        context = make_context()
+        assert bind_context(get_request_id, context)() == 'xyz'
+
+    def test_context_is_popped_on_error(self):
+        @bind_context
+        def func():
+            raise ZeroDivisionError
+        with make_context() as context:
+            with pytest.raises(ZeroDivisionError):
+                func()
+            assert RequestContext.get() is context
+        with pytest.raises(ZeroDivisionError):
+            func()
+        assert RequestContext.get() is None
+
+    def test_decorator(self):
+        with make_context():
+            @bind_context
+            def func(x):
+                """Docstring"""
+                return get_request_id(), x
+        assert func(1) == ('xyz', 1)
+        assert func.__doc__ == 'Docstring'
+
+
+class TestContextThread(object):
+    """Tests `ContextThread` class."""
+
+    def run_thread(self):
+        results = []
+        thread = ContextThread(target=lambda: results.append(
+            RequestContext.get()))
+        thread.start()
+        thread.join()
+        return results[0]
+
+    def test_thread_runs_with_context(self):
+        with make_context() as context:
+            assert self.run_thread() is context
+
+    def test_thread_runs_wo_context(self):
+        assert self.run_thread() is None
+
+
+class TestContextExecutor(object):
+    """Tests `ContextExecutor` class."""
+
+    def setup_method(self, method):
+        self.pool = ThreadPoolExecutor(max_workers=2)
+        self.executor = ContextExecutor(self.pool)
+
+    def teardown_method(self, method):
+        self.executor.shutdown()
+
+    def test_submit(self):
+        with make_context('abc'):
+            future = self.executor.submit(get_request_id)
+        assert future.result() == 'abc'
+
+    def test_submit_wo_context(self):
+        future = self.executor.submit(get_request_id)
+        assert future.result() is None
+
+    def test_map(self):
+        contexts = [make_context(str(i)) for i in range(2)]
+        results = []
+        for context in contexts:
+            with context:
+                results.append(self.executor.map(lambda x: (
+                    x, get_request_id()), range(3)))
+        assert list(results[0]) == [(0, '0'), (1, '0'), (2, '0')]
+        assert list(results[1]) == [(0, '1'), (1, '1'), (2, '1')]
+
+    def test_workers_are_clean_after_error(self):
+        def fail():
+            raise ZeroDivisionError
+        with make_context():
+            futures = [self.executor.submit(fail) for i in range(4)]
+        for future in futures:
+            with pytest.raises(ZeroDivisionError):
+                future.result()
+        results = [self.pool.submit(RequestContext.get) for i in range(4)]
+        assert [f.result() for f in results] == [None] * 4
+
+    def test_context_manager(self):
+        with ContextExecutor(ThreadPoolExecutor(max_workers=1)) as executor:
+            with make_context():
+                future = executor.submit(get_request_id)
+        assert future.result() == 'xyz'